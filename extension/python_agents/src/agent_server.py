@@ -4,7 +4,13 @@ Agent 服务器主入口
 """
 import os
 import sys
+import time
+import uuid
 import logging
+import argparse
+import threading
+from concurrent.futures import Future, wait as wait_futures
+from contextlib import contextmanager
 from pathlib import Path
 import io
 
@@ -30,62 +36,228 @@ if os.getenv('DEV_MODE') == 'true':
 # 添加 src 到路径
 sys.path.insert(0, str(Path(__file__).parent))
 
-from rpc import JSONRPCServer, AgentError, LLMError
+from rpc import JSONRPCServer, SpillStore, LatencyHistogram, JSONRPCError, AgentError, LLMError, InvalidParams, get_current_request, get_current_connection
+from rpc import TimeoutError as AgentTimeoutError
 from utils import (
     setup_logger,
     get_llm_client,
     LLMConfig,
     ContextBuilder,
-    SecurityChecker
+    SecurityChecker,
+    SecurityError,
+    ResourceError
 )
+from utils.resilience import CircuitOpenError, get_circuit_stats
+from utils.response_cache import ResponseCache, make_key
 from config import get_settings
-from agents import create_custom_tools
-from agents.unified_agent import create_unified_chat_agent
 from tools import ASTTools
-from langgraph.checkpoint.memory import MemorySaver  # 🔧 对话历史管理
+# agents（langchain / langgraph / deepagents）导入耗时数秒，在后台初始化时才导入（见 _initialize）
 
 
 logger = logging.getLogger(__name__)
 
 
 class AgentServer:
-    """Agent 服务器 - 基于 deepagents (正确方式)"""
+    """
+    Agent 服务器 - 基于 deepagents (正确方式)
     
-    def __init__(self, workspace_root: str = None):
+    stdio 模式服务单个编辑器窗口；守护进程模式（socket_path）在 Unix socket 上
+    服务多个窗口，共享 LLM 客户端、工具和已加载的依赖。窗口通过 $/configure 的 clientId
+    提供稳定标识（如工作区或会话 id）后，它的会话 ID 与其他窗口隔离，重启后仍对应同一份历史；
+    通过 switch_workspace 设置的工作区只对该窗口生效。
+    
+    启动分阶段进行：构造函数只创建 RPC 服务器、注册方法，run() 立即发送 server.ready；
+    导入 langchain 等依赖、创建 LLM 客户端和 Agent 在后台线程中完成。
+    需要 Agent 的请求在初始化完成前等待（见 _wait_ready），health_check 报告初始化阶段和耗时。
+    """
+    
+    def __init__(self, workspace_root: str = None, socket_path: str = None):
         self.workspace_root = workspace_root or os.getcwd()
-        self.rpc_server = JSONRPCServer()
+        self.socket_path = socket_path
+        
+        # 初始化进度：当前阶段、各阶段耗时（构造函数和后台初始化），完成（或失败）时 _ready 完成
+        self._started = time.monotonic()
+        self._ready = Future()
+        self._init_phase = "pending"
+        self._init_timings = {}
         
         # 加载配置
-        self.settings = get_settings()
+        with self._init_stage("settings"):
+            self.settings = get_settings()
+        
+        with self._init_stage("rpc_server"):
+            # 大结果溢出到缓存目录（客户端通过 $/configure 开启）
+            spill_store = None
+            if self.settings.rpc_spill_threshold_kb > 0:
+                spill_store = SpillStore(
+                    str(self.settings.get_cache_dir() / "spill"),
+                    threshold=self.settings.rpc_spill_threshold_kb * 1024,
+                    max_age=self.settings.rpc_spill_max_age
+                )
+            
+            # RPC 服务器（有界线程池并发处理请求）
+            self.rpc_server = JSONRPCServer(
+                max_workers=self.settings.rpc_max_workers,
+                framing=self.settings.rpc_framing,
+                use_asyncio=self.settings.rpc_asyncio,
+                max_pending_bytes=self.settings.rpc_output_buffer_mb * 1024 * 1024,
+                coalesce_window=self.settings.rpc_coalesce_ms / 1000,
+                spill_store=spill_store,
+                stats_log_interval=self.settings.rpc_stats_log_interval
+            )
+        
+        # 串行化模型/工作区切换（两者都会重建 agent）
+        self._agent_lock = threading.Lock()
+        
+        # chat 的首 token 延迟和各工具的耗时分布（通过 server.stats 查询）
+        self._chat_stats_lock = threading.Lock()
+        self._ttft = LatencyHistogram()
+        self._tool_latency = {}
+        self.rpc_server.add_stats_source("chat", self._chat_stats)
+        self.rpc_server.add_stats_source("tools", self._tool_stats)
+        
+        # explain_code / generate_code / refactor_code 的响应缓存
+        self.response_cache = None
+        if self.settings.agent_enable_cache:
+            self.response_cache = ResponseCache(
+                max_entries=self.settings.agent_cache_max_entries,
+                max_bytes=self.settings.agent_cache_max_mb * 1024 * 1024,
+                ttl=self.settings.agent_cache_ttl,
+                directory=str(self.settings.get_cache_dir() / "responses"),
+                max_disk_bytes=self.settings.agent_cache_disk_mb * 1024 * 1024
+            )
+            self.rpc_server.add_stats_source("cache", self.response_cache.get_stats)
+        
+        # 守护进程模式下为每个客户端准备独立的会话状态
+        if self.socket_path:
+            self.rpc_server.on_connect(self._on_client_connect)
         
         # 初始化 AST 工具（deepagents 未提供）
-        self.ast_tools = ASTTools()
+        with self._init_stage("ast_tools"):
+            self.ast_tools = ASTTools()
         
-        # 初始化 LLM 客户端
-        llm_config = LLMConfig(
-            provider=self.settings.llm_provider,
-            model=self.settings.llm_model,
-            api_key=self.settings.llm_api_key,
-            api_base=self.settings.llm_api_base,
-            temperature=self.settings.llm_temperature,
-            max_tokens=self.settings.llm_max_tokens
-        )
-        self.llm_client = get_llm_client(llm_config)
+        self.rpc_server.add_stats_source("circuits", get_circuit_stats)
+        self.rpc_server.add_stats_source("conversations", self._conversation_stats)
+        self.rpc_server.add_stats_source("history", self._history_stats)
         
         # 初始化上下文构建器和安全检查器
         self.context_builder = ContextBuilder(self.workspace_root)
         self.security_checker = SecurityChecker(self.workspace_root)
         
-        # 创建自定义工具（只包含 AST 分析，文件系统由 deepagents 提供）
-        self.custom_tools = create_custom_tools(
-            ast_tools=self.ast_tools
-        )
-        
-        # 创建 Deep Agents
-        self._initialize_agents()
+        # 以下由后台初始化填充
+        self.llm_client = None
+        self.custom_tools = []
+        self.checkpointer = None
+        self.history_compaction = None
+        self.unified_agent = None
+        # 单独切换过模型的会话：thread_id -> 模型名称
+        self._conversation_models = {}
+        self._prewarm_status = {}
         
         # 注册方法
         self.register_methods()
+        
+        self._init_timings["constructor"] = round((time.monotonic() - self._started) * 1000, 1)
+        self._init_phase = "pending"
+        threading.Thread(target=self._initialize, name="agent-init", daemon=True).start()
+    
+    def _initialize(self):
+        """
+        后台初始化（导入依赖 → 创建 LLM 客户端 → 创建 Agent → 预热模型）
+        
+        每个阶段的耗时记录在 _init_timings 中（total 从构造函数开始计算）。导入或创建客户端失败时
+        初始化失败，等待中的请求收到错误；创建 Agent 失败时与之前一样进入降级模式。
+        """
+        try:
+            with self._init_stage("imports"):
+                # 🔧 对话历史管理
+                from agents import create_custom_tools, BoundedMemorySaver, SqliteCheckpointer
+                import agents.unified_agent  # noqa: F401  预先导入 deepagents
+            
+            with self._init_stage("llm_client"):
+                self.llm_client = get_llm_client(self._llm_config(self.settings.llm_model))
+                # 创建自定义工具（只包含 AST 分析，文件系统由 deepagents 提供）
+                self.custom_tools = create_custom_tools(
+                    ast_tools=self.ast_tools
+                )
+            
+            with self._init_stage("checkpointer"):
+                # 🔧 对话历史（所有 Agent 共用，切换模型或工作区时保留）
+                # 限制内存中的对话数和总大小，超出时按 LRU 淘汰（溢出到磁盘或丢弃；sqlite 存储直接卸载）
+                if self.settings.conversation_store == "sqlite":
+                    self.checkpointer = SqliteCheckpointer(
+                        str(self.settings.get_cache_dir() / "conversations.sqlite3"),
+                        max_threads=self.settings.conversation_max_threads,
+                        max_bytes=self.settings.conversation_max_mb * 1024 * 1024,
+                        keep_checkpoints=self.settings.conversation_keep_checkpoints,
+                        compact_interval=self.settings.conversation_compact_interval
+                    )
+                else:
+                    self.checkpointer = BoundedMemorySaver(
+                        max_threads=self.settings.conversation_max_threads,
+                        max_bytes=self.settings.conversation_max_mb * 1024 * 1024,
+                        spill_dir=str(self.settings.get_cache_dir() / "conversations") if self.settings.conversation_spill else None
+                    )
+                # 会话被删除或丢弃时同时清除它单独切换的模型
+                self.checkpointer.add_delete_listener(self._forget_conversation)
+            
+            # 分为 backend 和 agent_graph 两个阶段（见 _create_agent）
+            self._initialize_agents()
+        except Exception as e:
+            logger.exception(f"Agent initialization failed during {self._init_phase}")
+            self._init_timings["total"] = round((time.monotonic() - self._started) * 1000, 1)
+            self._init_phase = "failed"
+            self._ready.set_exception(e)
+            return
+        
+        self._init_timings["total"] = round((time.monotonic() - self._started) * 1000, 1)
+        self._init_phase = "ready"
+        self._ready.set_result(None)
+        logger.info(f"✓ Agent server initialized in {self._init_timings['total']}ms ({self._init_timings})")
+        
+        # 后台预热默认模型和 PREWARM_MODELS 中的模型：创建客户端并建立 HTTP 连接
+        if self.unified_agent is not None:
+            self._prewarm_models()
+    
+    @contextmanager
+    def _init_stage(self, name: str):
+        """记录初始化阶段及其耗时（初始化完成后不再记录，如守护进程中为客户端创建 Agent）"""
+        if self._ready.done():
+            yield
+            return
+        self._init_phase = name
+        started = time.monotonic()
+        yield
+        self._init_timings[name] = round((time.monotonic() - started) * 1000, 1)
+    
+    def _wait_ready(self, params: dict = None):
+        """
+        等待后台初始化完成（需要 Agent 的方法在开始时调用）
+        
+        最多等到请求的截止时间（见 _budget），请求被取消时立即停止等待。
+        
+        Raises:
+            TimeoutError: 截止时间前没有完成
+            AgentError: 初始化失败
+        """
+        if not self._ready.done():
+            request = get_current_request()
+            timeout, deadline, _ = self._budget(params or {}, request)
+            logger.info(f"Request waiting for agent initialization ({self._init_phase})")
+            while not self._ready.done():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise AgentTimeoutError(
+                        f"Agent is still initializing ({self._init_phase})",
+                        {"phase": self._init_phase, "timeout": timeout}
+                    )
+                if request is not None:
+                    request.token.check()
+                wait_futures([self._ready], timeout=min(remaining, 0.1))
+        
+        error = self._ready.exception()
+        if error is not None:
+            raise AgentError(f"Agent initialization failed: {error}")
     
     def _initialize_agents(self):
         """初始化所有 Deep Agents"""
@@ -98,35 +270,21 @@ class AgentServer:
                 self.unified_agent = None
                 return
             
-            llm = self.llm_client._client
-            
-            # 🔧 创建 Checkpointer 用于对话历史管理
-            self.checkpointer = MemorySaver()
-            logger.info("✓ Memory checkpointer created")
-            
-            # 🔧 创建 FilesystemBackend 将文件保存到真实磁盘
-            from deepagents.backends import FilesystemBackend
             workspace_dir = self.settings.get_workspace_dir()
-            workspace_dir.mkdir(parents=True, exist_ok=True)
-            filesystem_backend = FilesystemBackend(
-                root_dir=str(workspace_dir),
-                virtual_mode=True  # 使用虚拟路径模式
-            )
-            logger.info(f"✓ Filesystem backend created: {workspace_dir}")
             if self.settings.workspace_dir:
                 logger.info(f"   Custom workspace configured: {self.settings.workspace_dir}")
             
             # 🎯 创建统一的 Chat Agent
-            self.unified_agent = create_unified_chat_agent(
-                llm,
-                self.custom_tools,
-                backend=filesystem_backend  # 使用真实文件系统
-            )
+            self.unified_agent = self._create_agent(workspace_dir)
             logger.info("✓ Unified agent created (single DeepAgent with all capabilities)")
             logger.info("   • Can generate, explain, and refactor code")
             logger.info(f"   • Files saved to: {workspace_dir}")
             logger.info("🎉 All operations unified through one intelligent agent!")
             
+            # 各客户端的 Agent 在下次使用时重建
+            for connection in self.rpc_server.get_connections():
+                connection.state.pop("agent", None)
+        
         except Exception as e:
             logger.error(f"Failed to initialize unified agent: {e}")
             import traceback
@@ -134,27 +292,244 @@ class AgentServer:
             # 降级到无 Agent 模式
             self.unified_agent = None
     
+    def _llm_config(self, model: str) -> LLMConfig:
+        """按当前配置为指定模型构造 LLM 配置"""
+        return LLMConfig(
+            provider=self.settings.llm_provider,
+            model=model,
+            api_key=self.settings.llm_api_key,
+            api_base=self.settings.llm_api_base,
+            temperature=self.settings.llm_temperature,
+            max_tokens=self.settings.llm_max_tokens,
+            timeout=self.settings.agent_timeout,
+            max_retries=self.settings.agent_max_retries,
+            circuit_failure_threshold=self.settings.llm_circuit_failure_threshold,
+            circuit_reset_timeout=self.settings.llm_circuit_reset_seconds
+        )
+    
+    def _chat_stats(self) -> dict:
+        """chat 的首 token 延迟统计"""
+        with self._chat_stats_lock:
+            return {"ttft": self._ttft.summary()}
+    
+    def _tool_stats(self) -> dict:
+        """各工具的调用耗时统计（总耗时最高的排在前面）"""
+        with self._chat_stats_lock:
+            tools = {name: histogram.summary() for name, histogram in self._tool_latency.items()}
+            totals = {name: histogram.total_ms for name, histogram in self._tool_latency.items()}
+        return {name: {**tools[name], "total_ms": round(totals[name], 1)}
+                for name in sorted(tools, key=totals.get, reverse=True)}
+    
+    def _conversation_stats(self) -> dict:
+        """内存中的对话数、各对话占用的字节数和淘汰统计"""
+        if self.checkpointer is None:
+            return {}
+        return self.checkpointer.get_stats()
+    
+    def _history_stats(self) -> dict:
+        """对话历史压缩的次数、节省的 token 数和各会话的 token 用量"""
+        if self.history_compaction is None:
+            return {}
+        return self.history_compaction.get_stats()
+    
+    def _create_agent(self, workspace_dir: Path):
+        """创建文件操作限定在 workspace_dir 的统一 Agent"""
+        from agents import HistoryCompactionMiddleware, ModelSwitchMiddleware, ResilientModelMiddleware
+        from agents.unified_agent import create_unified_chat_agent
+        if self.history_compaction is None:
+            # 所有 Agent 共用（切换工作区后统计仍然保留）
+            self.history_compaction = HistoryCompactionMiddleware(
+                self._resolve_model,
+                self.llm_client._client,
+                max_tokens=self.settings.agent_history_max_tokens,
+                keep_tokens=self.settings.agent_history_keep_tokens,
+                tool_output_chars=self.settings.agent_history_tool_chars
+            )
+        with self._init_stage("backend"):
+            # 🔧 创建 FilesystemBackend 将文件保存到真实磁盘
+            from deepagents.backends import FilesystemBackend
+            workspace_dir.mkdir(parents=True, exist_ok=True)
+            filesystem_backend = FilesystemBackend(
+                root_dir=str(workspace_dir),
+                virtual_mode=True  # 使用虚拟路径模式
+            )
+            logger.info(f"✓ Filesystem backend created: {workspace_dir}")
+        
+        with self._init_stage("agent_graph"):
+            return create_unified_chat_agent(
+                self.llm_client._client,
+                self.custom_tools,
+                backend=filesystem_backend,  # 使用真实文件系统
+                middleware=[
+                    # 对话历史超过 token 预算时截断旧的工具输出、把较早的轮次总结为摘要
+                    self.history_compaction,
+                    # 按运行配置的 configurable.model 选择模型（switch_model 不需要重建 Agent）
+                    ModelSwitchMiddleware(self._resolve_model),
+                    # 模型调用的重试和熔断，与 LLMClient 共用同一策略和提供商熔断器
+                    # 每次调用的 HTTP 超时不超过请求剩余的时间（见 _budget）
+                    ResilientModelMiddleware(
+                        self.llm_client.retry_policy,
+                        self.llm_client.circuit_breaker,
+                        timeout=self.settings.agent_timeout
+                    )
+                ],
+                checkpointer=self.checkpointer
+            )
+    
+    def _prewarm_models(self):
+        """
+        预热模型（后台线程）
+        
+        所有模型共用同一个 Agent 图（见 ModelSwitchMiddleware），预热只需要创建聊天客户端
+        并建立连接；之后按请求参数 model 或 switch_model 使用这些模型时不再有首次调用的额外延迟。
+        """
+        models = list(dict.fromkeys([self.settings.llm_model, *self.settings.prewarm_models]))
+        for model in models:
+            self._prewarm_status[model] = {"state": "warming"}
+            started = time.monotonic()
+            try:
+                client = get_llm_client(self._llm_config(model))
+                connected = client._client is not None and client.warm_up()
+            except Exception as e:
+                logger.warning(f"Failed to prewarm model {model}: {e}")
+                self._prewarm_status[model] = {"state": "failed", "error": str(e)}
+                continue
+            
+            elapsed_ms = round((time.monotonic() - started) * 1000, 1)
+            self._prewarm_status[model] = {"state": "ready", "connected": connected, "ms": elapsed_ms}
+            logger.info(f"✓ Model {model} prewarmed in {elapsed_ms}ms (connection {'ready' if connected else 'not established'})")
+    
+    def _resolve_model(self, name: str):
+        """模型名称 -> 聊天模型实例（按配置缓存）"""
+        return get_llm_client(self._llm_config(name))._client
+    
+    def _forget_conversation(self, thread_id: str):
+        """会话已从 checkpointer 中删除：清除与它关联的状态"""
+        self._conversation_models.pop(thread_id, None)
+    
+    def _model_for(self, thread_id: str = None) -> str:
+        """会话使用的模型：单独切换过的会话用自己的模型，否则用服务器的默认模型"""
+        return self._conversation_models.get(thread_id) or self.settings.llm_model
+    
+    def _cached(self, method: str, handler, inputs: tuple, fingerprint_code: bool = False):
+        """
+        为处理器加上响应缓存
+        
+        键由 inputs 中的参数（规范化后）、当前模型、温度、系统提示版本和工作区组成。
+        fingerprint_code 为 True 时 code 参数按 AST 指纹（忽略格式、注释和文档字符串）参与计算，
+        重新选中只改了缩进或注释的代码仍能命中。结果中含有原代码的方法（如重构）不能这样做。
+        请求参数 cache=false 时跳过查找，但仍写入新结果（用于强制刷新）。
+        命中时结果带 cached=true；部分回答和降级模式的结果不缓存。
+        """
+        def wrapper(params: dict) -> dict:
+            self._wait_ready(params)
+            if self.response_cache is None or self.unified_agent is None:
+                return handler(params)
+            from agents.unified_agent import SYSTEM_PROMPT_VERSION
+            
+            state = self._client_state()
+            workspace_dir = (state or {}).get("workspace_dir") or self.settings.get_workspace_dir()
+            values = {name: params.get(name) for name in inputs}
+            if fingerprint_code and isinstance(values.get("code"), str):
+                values["code"] = self.ast_tools.fingerprint(
+                    values["code"], params.get("language") or "python", strip_docstrings=True
+                ).digest
+            key = make_key(
+                method,
+                {**values, "workspace": str(workspace_dir)},
+                self._request_model(params) or self.settings.llm_model,
+                self.settings.llm_temperature,
+                SYSTEM_PROMPT_VERSION
+            )
+            
+            if params.get("cache", True) is False:
+                self.response_cache.record_bypass()
+            else:
+                cached = self.response_cache.get(key)
+                if cached is not None:
+                    logger.info(f"{method}: served from cache")
+                    return {**cached, "cached": True}
+            
+            result = handler(params)
+            if not result.get("partial"):
+                self.response_cache.put(key, result)
+            return result
+        
+        return wrapper
+    
+    def _on_client_connect(self, connection):
+        """守护进程模式：新客户端默认使用服务器的工作区，直到它调用 switch_workspace"""
+        connection.state["workspace_dir"] = None
+        connection.state["agent"] = None
+    
+    def _client_state(self):
+        """当前请求所属客户端的会话状态（stdio 模式下为 None）"""
+        if not self.socket_path:
+            return None
+        connection = get_current_connection()
+        return connection.state if connection is not None else None
+    
+    def _agent(self):
+        """当前请求使用的 Agent：客户端设置过自己的工作区时使用它独立的 Agent"""
+        state = self._client_state()
+        if state is None or state.get("workspace_dir") is None or self.unified_agent is None:
+            return self.unified_agent
+        
+        with self._agent_lock:
+            if state.get("agent") is None:
+                state["agent"] = self._create_agent(state["workspace_dir"])
+            return state["agent"]
+    
+    def _thread_id(self, conversation_id: str) -> str:
+        """
+        对话历史的 thread_id
+        
+        守护进程模式下以客户端在 $/configure 中提供的 clientId 作前缀，避免不同窗口的同名会话互相串话。
+        不能用连接编号：它在每次启动时从 1 开始，而 SQLite 历史跨重启保留，新窗口会继承别的窗口的会话。
+        客户端未提供 clientId 时直接使用会话 ID。
+        """
+        connection = get_current_connection() if self.socket_path else None
+        if connection is None or connection.client_id is None:
+            return conversation_id
+        return f"client-{connection.client_id}:{conversation_id}"
+    
     def register_methods(self):
         """注册所有 RPC 方法"""
-        self.rpc_server.register_method("health_check", self.health_check)
+        self.rpc_server.register_method("health_check", self.health_check, inline=True)
         self.rpc_server.register_method("chat", self.chat)
-        self.rpc_server.register_method("generate_code", self.generate_code)
-        self.rpc_server.register_method("explain_code", self.explain_code)
-        self.rpc_server.register_method("refactor_code", self.refactor_code)
+        self.rpc_server.register_method(
+            "generate_code", self._cached("generate_code", self.generate_code, ("prompt", "language", "context", "options")))
+        self.rpc_server.register_method(
+            "explain_code", self._cached("explain_code", self.explain_code, ("code", "language"), fingerprint_code=True))
+        self.rpc_server.register_method(
+            "refactor_code", self._cached("refactor_code", self.refactor_code, ("code", "language", "instructions")))
         self.rpc_server.register_method("review_code", self.review_code)
         self.rpc_server.register_method("search_code", self.search_code)
         self.rpc_server.register_method("switch_model", self.switch_model)  # 🆕 模型切换
         self.rpc_server.register_method("switch_workspace", self.switch_workspace)  # 🆕 工作区切换
-        self.rpc_server.register_method("shutdown", self.shutdown)
+        self.rpc_server.register_method("conversation.snapshot", self.snapshot_conversation)
+        self.rpc_server.register_method("conversation.fork", self.fork_conversation)
+        self.rpc_server.register_method("shutdown", self.shutdown, inline=True)
     
     def health_check(self, params: dict) -> dict:
         """健康检查"""
         logger.debug("Health check called")
+        state = self._client_state()
+        workspace_dir = state.get("workspace_dir") if state else None
         return {
             "status": "ok",
             "workspace": self.workspace_root,
-            "workspace_dir": str(self.settings.get_workspace_dir()),  # 实际文件保存路径
+            "workspace_dir": str(workspace_dir or self.settings.get_workspace_dir()),  # 实际文件保存路径
             "current_model": self.settings.llm_model,  # 包含当前模型
+            "models": dict(self._prewarm_status),  # 预热的模型及其状态
+            # 后台初始化：当前阶段（pending / imports / llm_client / agents / ready / failed）和各阶段耗时
+            "init": {
+                "phase": self._init_phase,
+                "ready": self._ready.done() and self._ready.exception() is None,
+                "timings_ms": dict(self._init_timings)
+            },
+            "mode": "daemon" if self.socket_path else "stdio",
+            "clients": len(self.rpc_server.get_connections()),
             "methods": list(self.rpc_server.methods.keys())
         }
     
@@ -162,8 +537,12 @@ class AgentServer:
         """
         动态切换 LLM 模型
         
+        只替换运行时使用的聊天模型，不重建 agent，对话历史（checkpointer）保留。
+        切换在下一次运行开始时生效，正在执行的请求继续使用原来的模型。
+        
         参数:
             model: str - 新的模型名称
+            conversation_id: str - 只为该会话切换（可选，默认切换服务器的默认模型）
         """
         logger.info(f"🔧 switch_model called with params: {params}")
         
@@ -171,49 +550,156 @@ class AgentServer:
         if not new_model:
             logger.error("Model name is missing in params")
             raise AgentError("Model name is required")
+        conversation_id = params.get("conversationId") or params.get("conversation_id")
+        self._wait_ready(params)
         
-        old_model = self.settings.llm_model
-        
+        started = time.monotonic()
         try:
-            logger.info(f"📝 Switching model from {old_model} to {new_model}")
-            
-            # 更新配置
-            self.settings.llm_model = new_model
-            
-            # 重新创建 LLM 客户端
-            llm_config = LLMConfig(
-                provider=self.settings.llm_provider,
-                api_key=self.settings.llm_api_key,
-                api_base=self.settings.llm_api_base,
-                model=new_model,  # 使用新模型
-                temperature=self.settings.llm_temperature,
-                max_tokens=self.settings.llm_max_tokens
-            )
-            self.llm_client = get_llm_client(llm_config)
-            
-            # 重新初始化 agents
-            self._initialize_agents()
-            
-            logger.info(f"✓ Model switched successfully: {old_model} → {new_model}")
-            
-            return {
-                "success": True,
-                "old_model": old_model,
-                "new_model": new_model,
-                "message": f"Model switched from {old_model} to {new_model}"
-            }
-            
+            # 同一配置的客户端只创建一次，切换回用过的模型几乎没有开销
+            client = get_llm_client(self._llm_config(new_model))
         except Exception as e:
             logger.error(f"Failed to switch model: {e}")
-            # 回滚到旧模型
-            self.settings.llm_model = old_model
             raise AgentError(f"Failed to switch model: {str(e)}")
+        if client._client is None:
+            raise AgentError(f"Failed to switch model: {new_model} is not available")
+        
+        with self._agent_lock:
+            if conversation_id:
+                thread_id = self._thread_id(conversation_id)
+                old_model = self._model_for(thread_id)
+                self._conversation_models[thread_id] = new_model
+            else:
+                old_model = self.settings.llm_model
+                self.settings.llm_model = new_model
+                self.llm_client = client
+                if self.unified_agent is None:
+                    # 之前没有可用的模型（降级模式），现在创建 agent
+                    self._initialize_agents()
+        
+        switch_ms = (time.monotonic() - started) * 1000
+        scope = f" for conversation {conversation_id}" if conversation_id else ""
+        logger.info(f"✓ Model switched{scope}: {old_model} → {new_model} ({switch_ms:.1f}ms)")
+        
+        return {
+            "success": True,
+            "old_model": old_model,
+            "new_model": new_model,
+            "conversationId": conversation_id,
+            "switch_ms": round(switch_ms, 2),
+            "message": f"Model switched from {old_model} to {new_model}{scope}"
+        }
+    
+    def snapshot_conversation(self, params: dict) -> dict:
+        """
+        保存会话当前（或指定检查点）的状态，之后可以用 conversation.fork 从快照分出新会话
+        
+        快照在内存中与会话共用序列化的消息数据，不复制消息内容（SQLite 存储中按行完整复制）；
+        快照是只读的（不能用于 chat），固定在 checkpointer 中不被淘汰或压缩，会话继续对话或被压缩后快照不变。
+        
+        参数:
+            conversation_id: str - 会话 ID
+            checkpoint_id: str - 快照的检查点（可选，默认最新）
+            rewind_turns: int - 回退的轮数（可选）：1 表示最后一条用户消息之前的状态
+        """
+        self._wait_ready(params)
+        snapshot_id = f"snapshot-{uuid.uuid4().hex[:12]}"
+        branch = self._branch(params, snapshot_id, pin=True)
+        return {"snapshotId": snapshot_id, **branch}
+    
+    def fork_conversation(self, params: dict) -> dict:
+        """
+        从会话或快照分出新会话，用于换一个模型或指令重试某一轮，而不用重新发送全部上下文
+        
+        新会话包含源会话分叉点及之前的检查点（内存中共用序列化的消息数据），之后各自独立。
+        新会话沿用源会话单独切换过的模型，也可以用 model 参数指定。
+        
+        参数:
+            conversation_id: str - 源会话 ID（与 snapshot_id 二选一）
+            snapshot_id: str - 源快照 ID
+            checkpoint_id: str - 分叉点（可选，默认最新）
+            rewind_turns: int - 回退的轮数（可选）：1 表示从最后一条用户消息之前分叉（重试最后一轮）
+            new_conversation_id: str - 新会话 ID（可选，默认自动生成）
+            model: str - 新会话使用的模型（可选）
+        """
+        self._wait_ready(params)
+        model = self._request_model(params)
+        new_conversation_id = (params.get("newConversationId") or params.get("new_conversation_id")
+                               or f"fork-{uuid.uuid4().hex[:12]}")
+        branch = self._branch(params, new_conversation_id)
+        
+        thread_id = self._thread_id(new_conversation_id)
+        source_model = self._conversation_models.get(self._thread_id(branch["source"]))
+        if model or source_model:
+            self._conversation_models[thread_id] = model or source_model
+        return {"conversationId": new_conversation_id, "model": self._model_for(thread_id), **branch}
+    
+    def _check_writable(self, conversation_id: str):
+        """快照（checkpointer 中固定的会话）是只读的，不能在快照上继续对话"""
+        if self.checkpointer is not None and self.checkpointer.is_pinned(self._thread_id(conversation_id)):
+            raise InvalidParams(f"{conversation_id} is a read-only snapshot; use conversation.fork to continue from it")
+    
+    def _branch(self, params: dict, target_id: str, pin: bool = False) -> dict:
+        """
+        把源会话（或快照）在分叉点的状态复制为 target_id（conversation.snapshot / conversation.fork 共用）
+        
+        pin 为 True 时固定新会话（快照），不被淘汰或压缩。
+        """
+        source = (params.get("snapshotId") or params.get("snapshot_id")
+                  or params.get("conversationId") or params.get("conversation_id"))
+        if not source:
+            raise InvalidParams("conversation_id or snapshot_id is required")
+        if self.checkpointer is None:
+            raise AgentError("Conversation history is not available")
+        
+        source_thread = self._thread_id(source)
+        checkpoint_id = params.get("checkpointId") or params.get("checkpoint_id")
+        rewind_turns = params.get("rewindTurns", params.get("rewind_turns", 0))
+        if not isinstance(rewind_turns, int) or rewind_turns < 0:
+            raise InvalidParams("rewind_turns must be a non-negative integer")
+        
+        history = self.checkpointer.list_checkpoints(source_thread)
+        if not history:
+            raise InvalidParams(f"Conversation {source} has no history")
+        if rewind_turns:
+            if checkpoint_id:
+                raise InvalidParams("checkpoint_id and rewind_turns are mutually exclusive")
+            checkpoint_id = self._rewind(history, rewind_turns, source)
+        
+        started = time.monotonic()
+        try:
+            chain = self.checkpointer.fork_thread(source_thread, self._thread_id(target_id), checkpoint_id, pin=pin)
+        except KeyError as e:
+            raise InvalidParams(str(e.args[0]))
+        except ValueError as e:
+            raise InvalidParams(str(e))
+        checkpoint_id = chain[0]
+        
+        step = next((c["step"] for c in history if c["checkpoint_id"] == checkpoint_id), None)
+        logger.info(f"Branched {source} at {checkpoint_id} into {target_id}")
+        return {
+            "source": source,
+            "checkpointId": checkpoint_id,
+            "step": step,
+            "checkpoints": len(chain),
+            "fork_ms": round((time.monotonic() - started) * 1000, 2)
+        }
+    
+    def _rewind(self, history: list, turns: int, source: str) -> str:
+        """倒数第 turns 轮开始之前的检查点（每轮从一个 source=input 的检查点开始）"""
+        starts = [c for c in history if c["source"] == "input"]
+        if len(starts) < turns:
+            raise InvalidParams(f"Conversation {source} has only {len(starts)} turn(s) in its checkpoint history")
+        parent_id = starts[turns - 1]["parent_id"]
+        if parent_id is None or not any(c["checkpoint_id"] == parent_id for c in history):
+            raise InvalidParams(f"Cannot rewind {turns} turn(s): no earlier state in the checkpoint history of {source}")
+        return parent_id
     
     def switch_workspace(self, params: dict) -> dict:
         """
         动态切换工作区目录
         
-        用于 VSCode 插件场景：当用户打开不同工程时，动态切换 Agent 的文件操作目标目录
+        用于 VSCode 插件场景：当用户打开不同工程时，动态切换 Agent 的文件操作目标目录。
+        守护进程模式下只切换调用方客户端的工作区。
         
         参数:
             workspace_dir: str - 新的工作区目录路径（绝对路径或相对于 workspace_root 的相对路径）
@@ -224,6 +710,11 @@ class AgentServer:
         if not new_workspace:
             logger.error("workspace_dir is missing in params")
             raise AgentError("workspace_dir is required")
+        self._wait_ready(params)
+        
+        state = self._client_state()
+        if state is not None:
+            return self._switch_client_workspace(state, new_workspace)
         
         old_workspace = str(self.settings.get_workspace_dir())
         
@@ -244,7 +735,8 @@ class AgentServer:
             new_workspace_path.mkdir(parents=True, exist_ok=True)
             
             # 重新初始化 agents（使用新的 workspace）
-            self._initialize_agents()
+            with self._agent_lock:
+                self._initialize_agents()
             
             logger.info(f"✓ Workspace switched successfully")
             logger.info(f"   Old: {old_workspace}")
@@ -256,13 +748,43 @@ class AgentServer:
                 "new_workspace": str(new_workspace_path),
                 "message": f"Workspace switched to {new_workspace_path}"
             }
-            
+        
         except Exception as e:
             logger.error(f"Failed to switch workspace: {e}")
             import traceback
             traceback.print_exc()
             raise AgentError(f"Failed to switch workspace: {str(e)}")
     
+    def _switch_client_workspace(self, state: dict, new_workspace: str) -> dict:
+        """守护进程模式：只为当前客户端切换工作区，其他客户端不受影响"""
+        old_workspace = str(state.get("workspace_dir") or self.settings.get_workspace_dir())
+        
+        new_workspace_path = Path(new_workspace)
+        if not new_workspace_path.is_absolute():
+            new_workspace_path = Path(self.settings.workspace_root) / new_workspace_path
+        new_workspace_path = new_workspace_path.resolve()
+        
+        if not new_workspace_path.parent.exists():
+            raise AgentError(f"Parent directory does not exist: {new_workspace_path.parent}")
+        
+        try:
+            agent = self._create_agent(new_workspace_path) if self.unified_agent is not None else None
+        except Exception as e:
+            logger.exception("Failed to switch client workspace")
+            raise AgentError(f"Failed to switch workspace: {str(e)}")
+        
+        with self._agent_lock:
+            state["workspace_dir"] = new_workspace_path
+            state["agent"] = agent
+        
+        logger.info(f"✓ Client workspace switched: {old_workspace} → {new_workspace_path}")
+        return {
+            "success": True,
+            "old_workspace": old_workspace,
+            "new_workspace": str(new_workspace_path),
+            "message": f"Workspace switched to {new_workspace_path}"
+        }
+    
     def chat(self, params: dict) -> dict:
         """
         AI 聊天 (使用统一的 Unified Agent)
@@ -273,10 +795,14 @@ class AgentServer:
         参数:
             message: str - 用户消息
             conversation_id: str - 会话 ID（可选）
-            context: dict - 上下文信息（可选）
+            context: dict - 编辑器上下文（可选，见 _prompt_context）
             stream: bool - 是否流式响应（可选）
+            timeout: float - 截止时间（秒，可选，默认 AGENT_TIMEOUT）
+            model: str - 本次调用使用的模型（可选，默认为当前模型，不改变默认模型）
+            max_steps: int - 图步数上限（可选，默认 AGENT_MAX_STEPS）
         """
         logger.info(f"Chat request: {params.get('message', '')[:50]}...")
+        self._wait_ready(params)
         
         try:
             if self.unified_agent is None:
@@ -287,53 +813,120 @@ class AgentServer:
                     "suggestions": []
                 }
             
-            # 🔧 获取会话 ID（用于对话历史管理）
+            # 🔧 获取会话 ID（用于对话历史管理），支持 camelCase (前端) 和 snake_case (Python) 两种命名
             conversation_id = params.get("conversationId") or params.get("conversation_id", "default")
+            self._check_writable(conversation_id)
+            stream = bool(params.get("stream"))
+            started = time.monotonic()
+            first_token_at = None
+            chunks = 0
+            
+            def on_token(text: str):
+                # 模型生成的文本立即以 chat.stream 通知转发（写线程会合并过密的片段）
+                nonlocal first_token_at, chunks
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                chunks += 1
+                self.rpc_server.send_notification("chat.stream", {
+                    "conversationId": conversation_id,  # 🔧 使用 camelCase 与前端保持一致
+                    "chunk": text,
+                    "done": False
+                })
+            
+            # 编辑器上下文（当前文件、选中的代码、光标位置）在预算内组装后放在消息前面
+            message = params.get("message", "")
+            prompt_context = self._prompt_context(params.get("context"))
+            if prompt_context:
+                message = f"{prompt_context}\n\n{message}"
             
             # 调用统一 Agent with thread_id 支持对话历史
-            result = self.unified_agent.invoke(
-                {"messages": [{"role": "user", "content": params.get("message", "")}]},
-                {"configurable": {"thread_id": conversation_id}}  # 🔧 使用 thread_id 管理对话历史
+            result = self._run_agent(
+                {"messages": [{"role": "user", "content": message}]},
+                {"configurable": {"thread_id": self._thread_id(conversation_id)}},  # 🔧 使用 thread_id 管理对话历史
+                on_token=on_token if stream else None,
+                conversation_id=conversation_id,
+                params=params
             )
             
             # 提取响应
-            messages = result.get("messages", [])
-            if messages:
-                last_message = messages[-1]
-                if hasattr(last_message, 'content'):
-                    response = last_message.content
-                else:
-                    response = str(last_message)
-            else:
-                response = str(result)
-            
-            # 如果是流式响应，发送通知
-            if params.get("stream"):
-                # 🔧 支持 camelCase (前端) 和 snake_case (Python) 两种命名
-                conversation_id = params.get("conversationId") or params.get("conversation_id", "default")
-                
-                # 模拟流式发送
-                chunks = response.split("。")
-                for i, chunk in enumerate(chunks):
-                    if chunk.strip():
-                        self.rpc_server.send_notification("chat.stream", {
-                            "conversationId": conversation_id,  # 🔧 使用 camelCase 与前端保持一致
-                            "chunk": chunk + "。",
-                            "done": i == len(chunks) - 1
-                        })
-            
-            # 🔧 支持 camelCase (前端) 和 snake_case (Python) 两种命名
-            conversation_id = params.get("conversationId") or params.get("conversation_id", "default")
+            response = self._extract_response(result)
+            
+            if stream:
+                # 模型未以流式返回任何文本时（如不支持流式输出），一次性发送完整响应
+                self.rpc_server.send_notification("chat.stream", {
+                    "conversationId": conversation_id,
+                    "chunk": "" if chunks else response,
+                    "done": True
+                })
+            
+            finished = time.monotonic()
+            # 只统计确实流式发出过 token 的请求：非流式请求的“首 token”就是完整响应，会拉高 TTFT 分布
+            ttft_ms = None
+            if stream and first_token_at is not None:
+                ttft_ms = (first_token_at - started) * 1000
+                with self._chat_stats_lock:
+                    self._ttft.record(ttft_ms)
+            
             return {
                 "conversationId": conversation_id,  # 🔧 使用 camelCase 与前端保持一致
                 "full_response": response,
-                "suggestions": []
+                "suggestions": [],
+                "metadata": {
+                    "streamed": stream,
+                    "stream_chunks": chunks,
+                    "ttft_ms": round(ttft_ms, 1) if ttft_ms is not None else None,
+                    "total_ms": round((finished - started) * 1000, 1)
+                },
+                **self._partial_info(result)
             }
         
+        except JSONRPCError:
+            raise
         except Exception as e:
             logger.exception("Error in chat")
             raise AgentError(str(e))
     
+    def _prompt_context(self, context) -> str:
+        """
+        chat 请求附带的编辑器上下文 -> 放在用户消息前面的提示文本
+        
+        context 由扩展端收集（currentFile 为相对工作区的路径，cursorPosition 的行号从 0 开始），
+        服务器读取文件后按 AGENT_CONTEXT_MAX_TOKENS 预算组装（见 ContextBuilder.assemble_context），
+        大文件只放入选中的代码、光标所在的符号和周围的代码。工作区外、敏感或过大的文件只使用选中的代码。
+        """
+        budget = self.settings.agent_context_max_tokens
+        if not budget or not isinstance(context, dict):
+            return ""
+        current_file = context.get("currentFile") or context.get("current_file")
+        selected_code = context.get("selectedCode") or context.get("selected_code")
+        if not isinstance(current_file, str) or not current_file:
+            current_file = None
+        if not isinstance(selected_code, str) or not selected_code.strip():
+            selected_code = None
+        if current_file is None and selected_code is None:
+            return ""
+        
+        if current_file is not None:
+            try:
+                self.security_checker.validate_file_path(current_file)
+                self.security_checker.check_file_size(current_file)
+            except (SecurityError, ResourceError) as e:
+                logger.warning(f"Ignoring chat context file: {e}")
+                current_file = None
+        
+        cursor_position = None
+        cursor = context.get("cursorPosition") or context.get("cursor_position")
+        if isinstance(cursor, dict) and isinstance(cursor.get("line"), int):
+            cursor_position = {"line": cursor["line"] + 1, "column": cursor.get("column", 0)}
+        
+        built = self.context_builder.build_context(
+            current_file=current_file,
+            selected_code=selected_code,
+            cursor_position=cursor_position,
+            include_workspace_info=False
+        )
+        return self.context_builder.format_context_for_prompt(built, max_tokens=budget)
+    
     def generate_code(self, params: dict) -> dict:
         """
         生成代码 (委派给统一 Agent)
@@ -349,6 +942,7 @@ class AgentServer:
         prompt = params.get('prompt', '')
         language = params.get('language', 'python')
         logger.info(f"Generate code request: {prompt[:50]}... (language: {language})")
+        self._wait_ready(params)
         
         try:
             if self.unified_agent is None:
@@ -367,20 +961,15 @@ def placeholder():
                 }
             
             # 调用统一 Agent（会自动委派给 code-generator subagent）
-            result = self.unified_agent.invoke({
+            result = self._run_agent({
                 "messages": [{
                     "role": "user",
                     "content": f"Generate {language} code: {prompt}"
                 }]
-            })
+            }, params=params)
             
             # 提取响应
-            messages = result.get("messages", [])
-            if messages:
-                last_message = messages[-1]
-                response = last_message.content if hasattr(last_message, 'content') else str(last_message)
-            else:
-                response = str(result)
+            response = self._extract_response(result)
             
             # 尝试从响应中提取代码块
             code_blocks = self._extract_code_blocks(response)
@@ -389,13 +978,139 @@ def placeholder():
             return {
                 "code": generated_code,
                 "explanation": "Code generated using DeepAgent",
-                "suggestions": ["Review the code", "Add tests", "Add documentation"]
+                "suggestions": ["Review the code", "Add tests", "Add documentation"],
+                **self._partial_info(result)
             }
         
+        except JSONRPCError:
+            raise
         except Exception as e:
             logger.exception("Error in generate_code")
             raise AgentError(str(e))
     
+    def _run_agent(self, agent_input: dict, config: dict = None, on_token=None, conversation_id: str = None,
+                   params: dict = None) -> dict:
+        """
+        运行统一 Agent
+        
+        在 RPC 请求中调用时绑定该请求的取消令牌，收到 $/cancelRequest 后
+        会在下一个图步骤、工具调用或模型 token 处停止。
+        on_token 在模型每生成一段文本时调用（见 run_agent）。
+        
+        运行期间的工具调用和待办事项更新以 chat.progress 通知发给发起请求的客户端，
+        附带 requestId（以及 conversationId，如果有）以便关联。
+        
+        运行受截止时间和步数上限约束（见 _budget）。预算耗尽时返回目前最好的部分回答
+        （结果中带 partial_response 和 stop_reason）；还没有任何回答时抛出 TimeoutError。
+        
+        使用的模型在运行开始时确定（见 switch_model）。没有 thread_id 的一次性运行
+        （如 explain_code）使用临时会话，结束后从 checkpointer 中删除。
+        """
+        from agents import run_agent, AgentBudgetExceededError
+        
+        request = get_current_request()
+        timeout, deadline, max_steps = self._budget(params or {}, request)
+        
+        # 模型在运行开始时确定：运行期间切换模型不影响这次运行；请求参数 model 只对这次调用生效
+        config = dict(config or {})
+        configurable = dict(config.get("configurable") or {})
+        configurable.setdefault("model", self._request_model(params) or self._model_for(configurable.get("thread_id")))
+        one_shot = "thread_id" not in configurable
+        if one_shot:
+            configurable["thread_id"] = f"oneshot-{uuid.uuid4().hex}"
+        config["configurable"] = configurable
+        try:
+            # 运行期间会话不被淘汰，也不被后台压缩
+            with self.checkpointer.running(configurable["thread_id"]):
+                return run_agent(
+                    self._agent(),
+                    agent_input,
+                    config,
+                    cancel_token=request.token if request else None,
+                    on_token=on_token,
+                    on_progress=self._progress_emitter(request, conversation_id),
+                    deadline=deadline,
+                    max_steps=max_steps
+                )
+        except AgentBudgetExceededError as e:
+            limit = f"{timeout:g}s deadline" if e.reason == "deadline" else f"{max_steps} step limit"
+            logger.warning(f"Agent stopped at its {limit} ({len(e.partial)} chars of partial answer)")
+            if not e.partial:
+                raise AgentTimeoutError(
+                    f"Agent did not produce an answer within its {limit}",
+                    {"reason": e.reason, "timeout": timeout, "max_steps": max_steps}
+                )
+            return {**e.state, "partial_response": e.partial, "stop_reason": e.reason}
+        except CircuitOpenError as e:
+            # 提供商持续故障：立即失败，告诉客户端多久后再试
+            raise LLMError(str(e), {"retry_after": round(e.retry_after, 1)})
+        finally:
+            if one_shot:
+                self.checkpointer.delete_thread(configurable["thread_id"])
+    
+    def _request_model(self, params: dict = None):
+        """请求参数 model 指定的模型（只对这次调用生效，不改变默认模型）"""
+        model = (params or {}).get("model")
+        if model is not None and (not isinstance(model, str) or not model.strip()):
+            raise InvalidParams("model must be a non-empty string")
+        return model.strip() if model else None
+    
+    def _budget(self, params: dict, request=None) -> tuple:
+        """
+        计算请求的截止时间和步数上限
+        
+        默认使用 AGENT_TIMEOUT / AGENT_MAX_STEPS，请求参数 timeout / max_steps 可以覆盖。
+        截止时间从收到请求时开始计算（包括排队时间），与扩展端的请求超时对齐。
+        
+        Returns:
+            (超时秒数, 截止时间（time.monotonic）, 步数上限)
+        """
+        try:
+            timeout = float(params.get("timeout") or self.settings.agent_timeout)
+            max_steps = int(params.get("max_steps") or params.get("maxSteps") or self.settings.agent_max_steps)
+        except (TypeError, ValueError):
+            raise InvalidParams("timeout and max_steps must be numbers")
+        if timeout <= 0 or max_steps < 1:
+            raise InvalidParams("timeout and max_steps must be positive")
+        
+        start = request.received_at if request is not None else time.monotonic()
+        return timeout, start + timeout, max_steps
+    
+    def _partial_info(self, result: dict) -> dict:
+        """预算耗尽提前停止时，在响应中标明这是部分回答"""
+        if "stop_reason" not in result:
+            return {}
+        return {"partial": True, "stop_reason": result["stop_reason"]}
+    
+    def _progress_emitter(self, request, conversation_id: str = None):
+        """创建发送 chat.progress 通知并记录工具耗时的回调"""
+        # 工具可能在 LangGraph 的线程池中执行，显式记下目标连接
+        connection = get_current_connection()
+        base = {"requestId": request.id if request else None}
+        if conversation_id is not None:
+            base["conversationId"] = conversation_id
+        
+        def emit(event: dict):
+            if event["type"] in ("tool_end", "tool_error") and event.get("durationMs") is not None:
+                with self._chat_stats_lock:
+                    histogram = self._tool_latency.get(event["tool"])
+                    if histogram is None:
+                        histogram = self._tool_latency[event["tool"]] = LatencyHistogram()
+                    histogram.record(event["durationMs"])
+            self.rpc_server.send_notification("chat.progress", {**base, **event}, connection)
+        
+        return emit
+    
+    def _extract_response(self, result: dict) -> str:
+        """从 Agent 最终状态中提取最后一条消息的文本（提前停止时为部分回答）"""
+        if "partial_response" in result:
+            return result["partial_response"]
+        messages = result.get("messages", [])
+        if messages:
+            last_message = messages[-1]
+            return last_message.content if hasattr(last_message, 'content') else str(last_message)
+        return str(result)
+    
     def _extract_code_blocks(self, text: str) -> list:
         """从文本中提取代码块"""
         import re
@@ -417,6 +1132,7 @@ def placeholder():
         language = params.get("language", "python")
         
         logger.info(f"Explain code request (language: {language})")
+        self._wait_ready(params)
         
         try:
             if self.unified_agent is None:
@@ -429,29 +1145,27 @@ def placeholder():
                 }
             
             # 调用统一 Agent（会自动委派给 code-explainer subagent）
-            result = self.unified_agent.invoke({
+            result = self._run_agent({
                 "messages": [{
                     "role": "user",
                     "content": f"Please explain this {language} code:\n\n```{language}\n{code}\n```"
                 }]
-            })
+            }, params=params)
             
             # 提取响应
-            messages = result.get("messages", [])
-            if messages:
-                last_message = messages[-1]
-                response = last_message.content if hasattr(last_message, 'content') else str(last_message)
-            else:
-                response = str(result)
+            response = self._extract_response(result)
             
             return {
                 "summary": response[:200] + "..." if len(response) > 200 else response,
                 "detailed_explanation": response,
                 "key_concepts": [],
                 "complexity": "Analyzed by AI",
-                "potential_issues": []
+                "potential_issues": [],
+                **self._partial_info(result)
             }
         
+        except JSONRPCError:
+            raise
         except Exception as e:
             logger.exception("Error in explain_code")
             raise AgentError(str(e))
@@ -472,6 +1186,7 @@ def placeholder():
         language = params.get("language", "python")
         
         logger.info(f"Refactor code request: {instructions}")
+        self._wait_ready(params)
         
         try:
             if self.unified_agent is None:
@@ -482,7 +1197,7 @@ def placeholder():
                 }
             
             # 调用统一 Agent（会自动委派给 refactoring subagent）
-            result = self.unified_agent.invoke({
+            result = self._run_agent({
                 "messages": [{
                     "role": "user",
                     "content": f"""Please refactor this {language} code according to: {instructions}
@@ -494,15 +1209,10 @@ Original code:
 
 Provide the refactored code and explain the changes."""
                 }]
-            })
+            }, params=params)
             
             # 提取响应
-            messages = result.get("messages", [])
-            if messages:
-                last_message = messages[-1]
-                response = last_message.content if hasattr(last_message, 'content') else str(last_message)
-            else:
-                response = str(result)
+            response = self._extract_response(result)
             
             # 提取重构后的代码
             code_blocks = self._extract_code_blocks(response)
@@ -516,9 +1226,12 @@ Provide the refactored code and explain the changes."""
                         "description": "Refactored by AI"
                     }
                 ],
-                "diff": response
+                "diff": response,
+                **self._partial_info(result)
             }
         
+        except JSONRPCError:
+            raise
         except Exception as e:
             logger.exception("Error in refactor_code")
             raise AgentError(str(e))
@@ -565,7 +1278,13 @@ Provide the refactored code and explain the changes."""
         }
     
     def shutdown(self, params: dict) -> dict:
-        """优雅关闭"""
+        """优雅关闭（守护进程模式下只断开调用方客户端，守护进程继续服务其他窗口）"""
+        connection = get_current_connection()
+        if self.socket_path and connection is not None:
+            logger.info(f"Client {connection.id} requested shutdown, disconnecting it")
+            connection.disconnect()
+            return {"status": "disconnecting"}
+        
         logger.info("Shutdown requested")
         self.rpc_server.stop()
         return {"status": "shutting down"}
@@ -573,11 +1292,50 @@ Provide the refactored code and explain the changes."""
     def run(self):
         """启动服务器"""
         logger.info(f"Starting Agent Server (workspace: {self.workspace_root})")
-        self.rpc_server.run()
+        if self.socket_path:
+            self.rpc_server.serve_unix(self.socket_path)
+        else:
+            self.rpc_server.run()
+
+
+def _report_startup(server: AgentServer, timeout: float = 300.0):
+    """--profile-startup 的子进程：报告服务器可以发送 server.ready 的时间，等待后台初始化完成后报告各阶段耗时"""
+    import startup_profile
+    startup_profile.emit_child_event("constructed")
+    wait_futures([server._ready], timeout=timeout)
+    error = server._ready.exception() if server._ready.done() else TimeoutError("initialization timed out")
+    startup_profile.emit_child_event(
+        "ready",
+        phases=dict(server._init_timings),
+        error=str(error) if error is not None else None
+    )
 
 
 def main():
     """主函数"""
+    parser = argparse.ArgumentParser(description="Vibe Coding Agent Server")
+    parser.add_argument(
+        "--socket",
+        default=os.environ.get("RPC_SOCKET_PATH") or None,
+        help="run as a shared daemon listening on this Unix socket instead of stdio"
+    )
+    parser.add_argument(
+        "--profile-startup",
+        metavar="REPORT",
+        help="profile a cold start (imports and init phases), write a JSON report and exit; "
+             "compare reports with: python src/startup_profile.py compare BASE NEW"
+    )
+    # --profile-startup 在子进程中以此参数启动服务器
+    parser.add_argument("--profile-startup-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.profile_startup:
+        import startup_profile
+        report = startup_profile.run_profile(os.path.abspath(__file__), args.profile_startup)
+        print(startup_profile.format_report(report))
+        print(f"Report written to {args.profile_startup}")
+        return
+    
     # 从环境变量读取配置
     workspace_root = os.environ.get("WORKSPACE_ROOT", os.getcwd())
     log_level = os.environ.get("LOG_LEVEL", "INFO")
@@ -591,10 +1349,15 @@ def main():
     logger.info(f"Workspace: {workspace_root}")
     logger.info(f"Log Level: {log_level}")
     logger.info(f"Python: {sys.version}")
+    logger.info(f"Mode: {'daemon (' + args.socket + ')' if args.socket else 'stdio'}")
     logger.info("=" * 60)
     
     # 创建并启动服务器
-    server = AgentServer(workspace_root)
+    server = AgentServer(workspace_root, socket_path=args.socket)
+    
+    if args.profile_startup_child:
+        _report_startup(server)
+        return
     
     try:
         server.run()
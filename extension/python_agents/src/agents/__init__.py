@@ -5,8 +5,19 @@ Agent 模块
 """
 from .code_agents import create_custom_tools
 from .unified_agent import create_unified_chat_agent
+from .runner import run_agent, AgentBudgetExceededError, ToolProgressCallbackHandler
+from .middleware import ResilientModelMiddleware, ModelSwitchMiddleware, HistoryCompactionMiddleware
+from .checkpointer import BoundedMemorySaver, SqliteCheckpointer
 
 __all__ = [
     'create_custom_tools',
     'create_unified_chat_agent',
+    'run_agent',
+    'AgentBudgetExceededError',
+    'ToolProgressCallbackHandler',
+    'ResilientModelMiddleware',
+    'ModelSwitchMiddleware',
+    'HistoryCompactionMiddleware',
+    'BoundedMemorySaver',
+    'SqliteCheckpointer',
 ]
@@ -0,0 +1,767 @@
+"""
+对话历史存储
+- BoundedMemorySaver: 限制 checkpointer 在进程内存中保存的对话数量和总大小
+- SqliteCheckpointer: 持久化到 SQLite，重启后对话历史仍在，按需加载到内存
+"""
+import os
+import time
+import zlib
+import pickle
+import shutil
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from langgraph.checkpoint.memory import InMemorySaver
+
+logger = logging.getLogger(__name__)
+
+# 超过该时间的溢出目录视为已退出进程的遗留，启动时删除
+_STALE_SPILL_SECONDS = 24 * 3600
+
+
+class BoundedMemorySaver(InMemorySaver):
+    """
+    有界的内存 checkpointer
+
+    每个对话（thread_id）的检查点、待写入记录和通道值都按序列化后的字节数计入该对话的大小。
+    对话数超过 max_threads 或总大小超过 max_bytes 时，按最近最少使用的顺序淘汰对话：
+    指定了 spill_dir 时写入磁盘，再次访问时自动加载回内存；否则直接丢弃（客户端会开始新的对话）。
+    正在写入的对话、正在运行的对话（见 running）和固定的对话（见 pin，如快照）不会被淘汰，
+    即使它本身超过了 max_bytes；固定的对话仍计入大小，只能通过 delete_thread 删除。
+
+    不带 thread_id 的 list() 只遍历内存中的对话。
+
+    Args:
+        max_threads: 内存中最多保留的对话数，0 表示不限制
+        max_bytes: 内存中对话的总大小上限，0 表示不限制
+        spill_dir: 溢出目录（每个进程使用其中的一个临时子目录，进程退出时删除）
+    """
+
+    def __init__(self, max_threads: int = 100, max_bytes: int = 0, spill_dir: Optional[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+
+        self._lock = threading.RLock()
+        # thread_id -> 字节数，按最近使用排序
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        # 已溢出到磁盘的对话：thread_id -> (文件, 字节数)
+        self._spilled: Dict[str, tuple] = {}
+        self._stats = {"evicted": 0, "spilled": 0, "restored": 0, "dropped": 0}
+        self._delete_listeners: List[Callable[[str], None]] = []
+        # 正在运行的对话：thread_id -> 运行数
+        self._running: Dict[str, int] = {}
+        # 固定的对话（不被淘汰）
+        self._pinned: set = set()
+
+        self._spill_dir = None
+        if spill_dir:
+            root = Path(spill_dir)
+            root.mkdir(parents=True, exist_ok=True)
+            self._remove_stale_spill_dirs(root)
+            self._spill_dir = Path(tempfile.mkdtemp(prefix="threads-", dir=root))
+            weakref.finalize(self, shutil.rmtree, str(self._spill_dir), True)
+
+    # ---- BaseCheckpointSaver ----
+
+    def get_tuple(self, config):
+        with self._lock:
+            thread_id = config["configurable"]["thread_id"]
+            self._touch(thread_id)
+            return super().get_tuple(config)
+
+    def get_delta_channel_history(self, *, config, channels):
+        # 沿祖先链读取 DeltaChannel 的待写入记录：与 get_tuple 一样先加载已卸载的对话（溢出文件或数据库），
+        # 并在遍历期间持有锁，避免与淘汰同时进行时读到不完整的历史
+        with self._lock:
+            self._touch(config["configurable"]["thread_id"])
+            return super().get_delta_channel_history(config=config, channels=channels)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        with self._lock:
+            if config:
+                self._touch(config["configurable"]["thread_id"])
+            # 在锁内取出全部结果，避免遍历过程中对话被淘汰
+            return iter(list(super().list(config, filter=filter, before=before, limit=limit)))
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        blob_keys = [(thread_id, checkpoint_ns, k, v) for k, v in new_versions.items()]
+        with self._lock:
+            self._touch(thread_id)
+            before = self._put_size(thread_id, checkpoint_ns, checkpoint["id"], blob_keys)
+            result = super().put(config, checkpoint, metadata, new_versions)
+            after = self._put_size(thread_id, checkpoint_ns, checkpoint["id"], blob_keys)
+            self._grow(thread_id, after - before)
+            return result
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        outer_key = (thread_id, config["configurable"].get("checkpoint_ns", ""), config["configurable"]["checkpoint_id"])
+        with self._lock:
+            self._touch(thread_id)
+            before = self._writes_size(outer_key)
+            super().put_writes(config, writes, task_id, task_path)
+            self._grow(thread_id, self._writes_size(outer_key) - before)
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock:
+            super().delete_thread(thread_id)
+            self._bytes -= self._sizes.pop(thread_id, 0)
+            self._pinned.discard(thread_id)
+            spilled = self._spilled.pop(thread_id, None)
+            if spilled is not None:
+                _unlink(spilled[0])
+        self._notify_deleted(thread_id)
+
+    @contextmanager
+    def running(self, thread_id: str):
+        """标记对话在这段时间内有运行中的 agent：不被淘汰，也不被压缩（见 SqliteCheckpointer.compact）"""
+        with self._lock:
+            self._running[thread_id] = self._running.get(thread_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                count = self._running.pop(thread_id) - 1
+                if count:
+                    self._running[thread_id] = count
+
+    def pin(self, thread_id: str):
+        """固定对话（如快照），之后不被淘汰，直到被删除"""
+        with self._lock:
+            self._pinned.add(thread_id)
+
+    def is_pinned(self, thread_id: str) -> bool:
+        """对话是否已固定"""
+        return thread_id in self._pinned
+
+    def add_delete_listener(self, listener: Callable[[str], None]):
+        """对话被删除（或淘汰时被丢弃）后调用 listener(thread_id)，用于清理与对话关联的状态"""
+        self._delete_listeners.append(listener)
+
+    def _notify_deleted(self, thread_id: str):
+        for listener in self._delete_listeners:
+            try:
+                listener(thread_id)
+            except Exception:
+                logger.exception(f"Delete listener failed for conversation {thread_id}")
+
+    # ---- 分叉 ----
+
+    def list_checkpoints(self, thread_id: str, checkpoint_ns: str = "") -> List[dict]:
+        """对话的检查点（从新到旧），只解码元数据：checkpoint_id、parent_id、step、source"""
+        with self._lock:
+            self._touch(thread_id)
+            saved = self.storage.get(thread_id, {}).get(checkpoint_ns, {})
+            history = []
+            for checkpoint_id in sorted(saved, reverse=True):
+                _, metadata, parent_id = saved[checkpoint_id]
+                metadata = self.serde.loads_typed(metadata)
+                history.append({
+                    "checkpoint_id": checkpoint_id,
+                    "parent_id": parent_id,
+                    "step": metadata.get("step"),
+                    "source": metadata.get("source"),
+                })
+            return history
+
+    def fork_thread(self, source: str, target: str, checkpoint_id: Optional[str] = None, pin: bool = False) -> List[str]:
+        """
+        从 source 的某个检查点分出新对话 target
+
+        复制分叉点及其祖先链（parent 链）上各检查点的条目、它们引用的通道值和待写入记录，
+        条目中的序列化数据（bytes，不可变）在内存中与源对话共用，不复制消息内容；
+        复制祖先链使新对话保留分叉点之前的检查点历史（可以再从更早的检查点分叉）。
+        之后两个对话各自写入新的检查点，互不影响；源对话中分叉点之后的检查点不会出现在新对话中。
+        大小统计按完整大小计算（源对话被淘汰后数据归新对话独有）。
+
+        Args:
+            source: 源对话的 thread_id
+            target: 新对话的 thread_id（必须不存在）
+            checkpoint_id: 分叉点，默认为最新的检查点
+            pin: 是否固定新对话（见 pin），用于快照
+
+        Returns:
+            复制的检查点 id（从分叉点到最早的祖先）
+
+        Raises:
+            KeyError: 源对话或检查点不存在
+            ValueError: 新对话已存在
+        """
+        with self._lock:
+            self._touch(target)
+            if self.storage.get(target):
+                raise ValueError(f"Conversation {target} already exists")
+            self._touch(source)
+            saved = self.storage.get(source, {}).get("", {})
+            if not saved:
+                raise KeyError(f"Conversation {source} has no checkpoints")
+            checkpoint_id = checkpoint_id or max(saved)
+            if checkpoint_id not in saved:
+                raise KeyError(f"Checkpoint {checkpoint_id} not found in conversation {source}")
+
+            chain = []
+            current = checkpoint_id
+            while current is not None and current in saved:
+                chain.append(current)
+                current = saved[current][2]
+
+            size = 0
+            for current in chain:
+                checkpoint_data, metadata, parent_id = saved[current]
+                self.storage[target][""][current] = (checkpoint_data, metadata, parent_id if parent_id in saved else None)
+                size += len(checkpoint_data[1]) + len(metadata[1])
+
+                checkpoint = self.serde.loads_typed(checkpoint_data)
+                for channel, version in checkpoint["channel_versions"].items():
+                    key = (target, "", channel, version)
+                    blob = self.blobs.get((source, "", channel, version))
+                    if blob is not None and key not in self.blobs:
+                        self.blobs[key] = blob
+                        size += len(blob[1])
+
+                writes = self.writes.get((source, "", current))
+                if writes:
+                    self.writes[(target, "", current)] = dict(writes)
+                    size += sum(len(write[2][1]) for write in writes.values())
+
+            if pin:
+                self._pinned.add(target)
+            self._grow(target, size)
+            return chain
+
+    # ---- 大小统计 ----
+
+    def _put_size(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str, blob_keys) -> int:
+        size = 0
+        saved = self.storage.get(thread_id, {}).get(checkpoint_ns, {}).get(checkpoint_id)
+        if saved is not None:
+            size += len(saved[0][1]) + len(saved[1][1])
+        for key in blob_keys:
+            blob = self.blobs.get(key)
+            if blob is not None:
+                size += len(blob[1])
+        return size
+
+    def _writes_size(self, outer_key) -> int:
+        return sum(len(write[2][1]) for write in self.writes.get(outer_key, {}).values())
+
+    def _grow(self, thread_id: str, delta: int):
+        """记录对话大小的变化，然后按限制淘汰其他对话"""
+        self._sizes[thread_id] = self._sizes.get(thread_id, 0) + delta
+        self._bytes += delta
+        self._enforce_limits(keep=thread_id)
+
+    def _touch(self, thread_id: str):
+        """标记对话为最近使用；对话已溢出到磁盘时先加载回内存"""
+        if thread_id in self._spilled:
+            self._restore(thread_id)
+            self._enforce_limits(keep=thread_id)
+        elif thread_id in self._sizes:
+            self._sizes.move_to_end(thread_id)
+
+    def _enforce_limits(self, keep: str):
+        while (self.max_threads and len(self._sizes) > self.max_threads) or \
+                (self.max_bytes and self._bytes > self.max_bytes):
+            victim = next((t for t in self._sizes if t != keep and self._evictable(t)), None)
+            if victim is None:
+                break
+            self._evict(victim)
+
+    # ---- 淘汰和溢出 ----
+
+    def _evictable(self, thread_id: str) -> bool:
+        return thread_id not in self._running and thread_id not in self._pinned
+
+    def _evict(self, thread_id: str):
+        size = self._sizes.pop(thread_id)
+        self._bytes -= size
+        self._stats["evicted"] += 1
+        self._offload(thread_id, size)
+        InMemorySaver.delete_thread(self, thread_id)
+
+    def _offload(self, thread_id: str, size: int):
+        """对话被淘汰前保存它的数据（写入溢出目录，未配置时丢弃）"""
+        if self._spill_dir is not None:
+            data = {
+                "storage": dict(self.storage.get(thread_id, {})),
+                "writes": {k: v for k, v in self.writes.items() if k[0] == thread_id},
+                "blobs": {k: v for k, v in self.blobs.items() if k[0] == thread_id},
+            }
+            path = self._spill_dir / (hashlib.sha256(thread_id.encode("utf-8")).hexdigest()[:32] + ".pkl")
+            try:
+                path.write_bytes(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+                self._spilled[thread_id] = (path, size)
+                self._stats["spilled"] += 1
+            except OSError as e:
+                logger.warning(f"Failed to spill conversation {thread_id}, dropping it: {e}")
+                self._stats["dropped"] += 1
+                self._notify_deleted(thread_id)
+        else:
+            self._stats["dropped"] += 1
+            logger.info(f"Dropped conversation {thread_id} ({size} bytes) from memory")
+            self._notify_deleted(thread_id)
+
+    def _restore(self, thread_id: str):
+        path, size = self._spilled.pop(thread_id)
+        try:
+            data = pickle.loads(path.read_bytes())
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logger.warning(f"Failed to restore conversation {thread_id}: {e}")
+            return
+        finally:
+            _unlink(path)
+
+        for checkpoint_ns, checkpoints in data["storage"].items():
+            self.storage[thread_id][checkpoint_ns].update(checkpoints)
+        for key, writes in data["writes"].items():
+            self.writes[key].update(writes)
+        self.blobs.update(data["blobs"])
+
+        self._sizes[thread_id] = size
+        self._bytes += size
+        self._stats["restored"] += 1
+
+    @staticmethod
+    def _remove_stale_spill_dirs(root: Path):
+        cutoff = time.time() - _STALE_SPILL_SECONDS
+        for path in root.glob("threads-*"):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def get_stats(self, top: int = 10) -> dict:
+        """内存中的对话数和大小、淘汰统计、占用最多的对话"""
+        with self._lock:
+            largest = sorted(self._sizes.items(), key=lambda item: item[1], reverse=True)[:top]
+            return {
+                "threads": len(self._sizes),
+                "bytes": self._bytes,
+                "max_threads": self.max_threads,
+                "max_bytes": self.max_bytes,
+                "spilled_threads": len(self._spilled),
+                "spilled_bytes": sum(size for _, size in self._spilled.values()),
+                **self._stats,
+                "largest": {thread_id: size for thread_id, size in largest},
+            }
+
+
+# 超过该大小的值压缩后写入数据库；第一个字节标记是否压缩
+_COMPRESS_MIN_BYTES = 512
+_RAW = b"\x00"
+_ZLIB = b"\x01"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL,
+    checkpoint_id TEXT NOT NULL,
+    parent_id TEXT,
+    type TEXT,
+    checkpoint BLOB,
+    metadata_type TEXT,
+    metadata BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    version TEXT NOT NULL,
+    type TEXT,
+    value BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL,
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT,
+    type TEXT,
+    value BLOB,
+    task_path TEXT,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+CREATE TABLE IF NOT EXISTS pinned (
+    thread_id TEXT PRIMARY KEY
+);
+"""
+
+
+def _pack(data: bytes) -> bytes:
+    if len(data) >= _COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(data, 1)
+        if len(compressed) < len(data):
+            return _ZLIB + compressed
+    return _RAW + data
+
+
+def _unpack(data: bytes) -> bytes:
+    return zlib.decompress(data[1:]) if data[:1] == _ZLIB else bytes(data[1:])
+
+
+class SqliteCheckpointer(BoundedMemorySaver):
+    """
+    持久化到 SQLite 的 checkpointer
+
+    所有写入同时写入 SQLite（WAL 模式，值按需 zlib 压缩），内存中只缓存最近使用的对话：
+    对话在下一次被访问时才从数据库加载，超出内存限制时直接从内存中卸载。
+    启动时不读取历史，重启开销与历史大小无关。
+
+    后台压缩定期为每个对话只保留最新的 keep_checkpoints 个检查点（以及重建它们的 DeltaChannel 通道值所需的祖先），
+    删除更早的检查点、它们的待写入记录和不再被引用的通道值。
+    固定的对话（见 pin）记录在数据库中，重启后仍然固定、不被压缩；它们可以从内存中卸载（数据在数据库中）。
+
+    Args:
+        path: 数据库文件路径
+        max_threads: 内存中最多缓存的对话数，0 表示不限制
+        max_bytes: 内存缓存的总大小上限，0 表示不限制
+        keep_checkpoints: 压缩后每个对话保留的检查点数
+        compact_interval: 后台压缩的间隔（秒），0 表示不压缩
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_threads: int = 100,
+        max_bytes: int = 0,
+        keep_checkpoints: int = 10,
+        compact_interval: float = 600,
+        **kwargs
+    ):
+        super().__init__(max_threads=max_threads, max_bytes=max_bytes, **kwargs)
+        self.path = Path(path)
+        self.keep_checkpoints = max(1, keep_checkpoints)
+        self._stats.update({"loaded": 0, "compactions": 0, "pruned_checkpoints": 0, "deferred_compactions": 0})
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = self._connect()
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._conn.executescript(_SCHEMA)
+        self._pinned.update(thread_id for thread_id, in self._conn.execute("SELECT thread_id FROM pinned"))
+
+        self._closed = threading.Event()
+        if compact_interval > 0:
+            threading.Thread(
+                target=self._compact_loop,
+                args=(compact_interval,),
+                name="checkpoint-compaction",
+                daemon=True
+            ).start()
+        weakref.finalize(self, self._closed.set)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL 模式下 NORMAL 不会损坏数据库，只可能丢失断电前最后的几个事务
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def close(self):
+        """停止后台压缩并关闭数据库连接"""
+        self._closed.set()
+        with self._lock:
+            self._conn.close()
+
+    # ---- 写入（同时写入内存和数据库） ----
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        with self._lock:
+            result = super().put(config, checkpoint, metadata, new_versions)
+            (ck_type, ck_data), (md_type, md_data), parent_id = self.storage[thread_id][checkpoint_ns][checkpoint["id"]]
+            blobs = []
+            for channel, version in new_versions.items():
+                blob_type, blob_data = self.blobs[(thread_id, checkpoint_ns, channel, version)]
+                blobs.append((thread_id, checkpoint_ns, channel, str(version), blob_type, _pack(blob_data)))
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, checkpoint["id"], parent_id, ck_type, _pack(ck_data), md_type, _pack(md_data))
+                )
+                self._conn.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?)", blobs)
+            return result
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        with self._lock:
+            super().put_writes(config, writes, task_id, task_path)
+            rows = [
+                (thread_id, checkpoint_ns, checkpoint_id, write_task_id, idx, channel, value_type, _pack(value), path)
+                for (write_task_id, idx), (_, channel, (value_type, value), path)
+                in self.writes.get((thread_id, checkpoint_ns, checkpoint_id), {}).items()
+                if write_task_id == task_id
+            ]
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany("INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def fork_thread(self, source: str, target: str, checkpoint_id: Optional[str] = None, pin: bool = False) -> List[str]:
+        with self._lock:
+            chain = super().fork_thread(source, target, checkpoint_id, pin)
+            blob_keys = set()
+            for current in chain:
+                checkpoint = self.serde.loads_typed(self.storage[target][""][current][0])
+                blob_keys.update((channel, str(version)) for channel, version in checkpoint["channel_versions"].items())
+            # 在数据库中用 INSERT ... SELECT 复制行（完整复制，不与源对话共用），不经过解压和重新压缩；
+            # 这样删除或压缩源对话不影响新对话。祖先链最早的检查点没有父检查点
+            with self._conn:
+                self._conn.execute("BEGIN")
+                if pin:
+                    self._conn.execute("INSERT OR IGNORE INTO pinned VALUES (?)", (target,))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO checkpoints SELECT ?, checkpoint_ns, checkpoint_id, ?, type, checkpoint, "
+                    "metadata_type, metadata FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = '' AND checkpoint_id = ?",
+                    [(target, self.storage[target][""][current][2], source, current) for current in chain]
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO blobs SELECT ?, checkpoint_ns, channel, version, type, value FROM blobs "
+                    "WHERE thread_id = ? AND checkpoint_ns = '' AND channel = ? AND version = ?",
+                    [(target, source, channel, version) for channel, version in sorted(blob_keys)]
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO writes SELECT ?, checkpoint_ns, checkpoint_id, task_id, idx, channel, type, value, "
+                    "task_path FROM writes WHERE thread_id = ? AND checkpoint_ns = '' AND checkpoint_id = ?",
+                    [(target, source, current) for current in chain]
+                )
+            return chain
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock:
+            super().delete_thread(thread_id)
+            with self._conn:
+                self._conn.execute("BEGIN")
+                for table in ("checkpoints", "blobs", "writes", "pinned"):
+                    self._conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+    def pin(self, thread_id: str):
+        with self._lock:
+            super().pin(thread_id)
+            self._conn.execute("INSERT OR IGNORE INTO pinned VALUES (?)", (thread_id,))
+
+    # ---- 按需加载 ----
+
+    def _touch(self, thread_id: str):
+        if thread_id in self._sizes:
+            self._sizes.move_to_end(thread_id)
+            return
+        if self._load(thread_id):
+            self._enforce_limits(keep=thread_id)
+
+    def _load(self, thread_id: str) -> bool:
+        """从数据库加载对话到内存，对话不存在时返回 False"""
+        size = 0
+        rows = self._conn.execute(
+            "SELECT checkpoint_ns, checkpoint_id, parent_id, type, checkpoint, metadata_type, metadata "
+            "FROM checkpoints WHERE thread_id = ?", (thread_id,)
+        ).fetchall()
+        if not rows:
+            return False
+        for checkpoint_ns, checkpoint_id, parent_id, ck_type, ck_data, md_type, md_data in rows:
+            checkpoint, metadata = _unpack(ck_data), _unpack(md_data)
+            self.storage[thread_id][checkpoint_ns][checkpoint_id] = ((ck_type, checkpoint), (md_type, metadata), parent_id)
+            size += len(checkpoint) + len(metadata)
+
+        for checkpoint_ns, channel, version, blob_type, value in self._conn.execute(
+            "SELECT checkpoint_ns, channel, version, type, value FROM blobs WHERE thread_id = ?", (thread_id,)
+        ):
+            value = _unpack(value)
+            self.blobs[(thread_id, checkpoint_ns, channel, version)] = (blob_type, value)
+            size += len(value)
+
+        for checkpoint_ns, checkpoint_id, task_id, idx, channel, value_type, value, task_path in self._conn.execute(
+            "SELECT checkpoint_ns, checkpoint_id, task_id, idx, channel, type, value, task_path "
+            "FROM writes WHERE thread_id = ?", (thread_id,)
+        ):
+            value = _unpack(value)
+            self.writes[(thread_id, checkpoint_ns, checkpoint_id)][(task_id, idx)] = (task_id, channel, (value_type, value), task_path)
+            size += len(value)
+
+        self._sizes[thread_id] = size
+        self._bytes += size
+        self._stats["loaded"] += 1
+        return True
+
+    def _evictable(self, thread_id: str) -> bool:
+        # 数据已经写入数据库，固定的对话也可以从内存中卸载
+        return thread_id not in self._running
+
+    def _offload(self, thread_id: str, size: int):
+        # 数据已经写入数据库，直接从内存中移除
+        pass
+
+    # ---- 后台压缩 ----
+
+    def _compact_loop(self, interval: float):
+        conn = None
+        while not self._closed.wait(interval):
+            try:
+                conn = conn or self._connect()
+                self.compact(conn)
+            except Exception as e:
+                logger.warning(f"Checkpoint compaction failed: {e}")
+        if conn is not None:
+            conn.close()
+
+    def compact(self, conn: Optional[sqlite3.Connection] = None) -> int:
+        """
+        每个对话只保留最新的 keep_checkpoints 个检查点
+
+        DeltaChannel 类型的通道（如 deep agent 的 messages）只在快照中保存完整值，其余检查点的值
+        由祖先的待写入记录重放得到，所以同时保留从这些检查点到最近的完整值之间的祖先。
+        在单独的连接上执行（未指定 conn 时临时创建一个），每个对话一个事务，不持有内存缓存的锁，
+        不阻塞其他对话的读写；有运行中的 agent 的对话（见 running）跳过，留到下一次压缩；固定的对话不压缩。
+        被压缩的对话如果在内存中则卸载，下次访问时重新加载。
+
+        Returns:
+            删除的检查点数
+        """
+        if conn is None:
+            conn = self._connect()
+            try:
+                return self.compact(conn)
+            finally:
+                conn.close()
+
+        pruned = compacted = deferred = 0
+        candidates = conn.execute(
+            "SELECT thread_id, checkpoint_ns FROM checkpoints WHERE thread_id NOT IN (SELECT thread_id FROM pinned) "
+            "GROUP BY thread_id, checkpoint_ns HAVING COUNT(*) > ?", (self.keep_checkpoints,)
+        ).fetchall()
+        for thread_id, checkpoint_ns in candidates:
+            if thread_id in self._running:
+                deferred += 1
+                continue
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                pruned += self._compact_thread(conn, thread_id, checkpoint_ns)
+            compacted += 1
+            with self._lock:
+                # 压缩期间开始运行的对话保留内存中的副本（只多出已删除的旧检查点），下次压缩后再卸载
+                if thread_id in self._sizes and thread_id not in self._running:
+                    self._bytes -= self._sizes.pop(thread_id)
+                    InMemorySaver.delete_thread(self, thread_id)
+
+        if compacted:
+            conn.execute("PRAGMA incremental_vacuum")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        with self._lock:
+            self._stats["compactions"] += 1
+            self._stats["pruned_checkpoints"] += pruned
+            self._stats["deferred_compactions"] += deferred
+        if pruned or deferred:
+            logger.info(
+                f"Compacted {compacted} conversation(s), removed {pruned} checkpoint(s), "
+                f"deferred {deferred} running conversation(s)"
+            )
+        return pruned
+
+    def _compact_thread(self, conn: sqlite3.Connection, thread_id: str, checkpoint_ns: str) -> int:
+        rows = conn.execute(
+            "SELECT checkpoint_id, parent_id, type, checkpoint FROM checkpoints "
+            "WHERE thread_id = ? AND checkpoint_ns = ? ORDER BY checkpoint_id DESC",
+            (thread_id, checkpoint_ns)
+        ).fetchall()
+        parents = {checkpoint_id: parent_id for checkpoint_id, parent_id, _, _ in rows}
+        versions = {
+            checkpoint_id: self.serde.loads_typed((ck_type, _unpack(ck_data)))["channel_versions"]
+            for checkpoint_id, _, ck_type, ck_data in rows
+        }
+        # 保存了完整值的通道值；DeltaChannel 的通道值大多为 "empty"，需要从祖先重放
+        stored = {
+            (channel, version)
+            for channel, version, blob_type in conn.execute(
+                "SELECT channel, version, type FROM blobs WHERE thread_id = ? AND checkpoint_ns = ?",
+                (thread_id, checkpoint_ns)
+            )
+            if blob_type != "empty"
+        }
+
+        def unresolved(checkpoint_id, channels):
+            return {channel for channel in channels
+                    if (channel, str(versions[checkpoint_id].get(channel))) not in stored}
+
+        # 最新的 keep_checkpoints 个检查点，以及重建它们的通道值所需的祖先
+        kept = set()
+        walked: Dict[str, set] = {}
+        for checkpoint_id, _, _, _ in rows[:self.keep_checkpoints]:
+            kept.add(checkpoint_id)
+            remaining = unresolved(checkpoint_id, versions[checkpoint_id])
+            current = parents[checkpoint_id]
+            while remaining and current in parents and not remaining <= walked.get(current, set()):
+                kept.add(current)
+                walked.setdefault(current, set()).update(remaining)
+                remaining = unresolved(current, remaining)
+                current = parents[current]
+        removed = [checkpoint_id for checkpoint_id, _, _, _ in rows if checkpoint_id not in kept]
+
+        referenced = {
+            (channel, str(version))
+            for checkpoint_id in kept
+            for channel, version in versions[checkpoint_id].items()
+        }
+        conn.executemany(
+            "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+            [(thread_id, checkpoint_ns, checkpoint_id) for checkpoint_id in removed]
+        )
+        conn.executemany(
+            "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+            [(thread_id, checkpoint_ns, checkpoint_id) for checkpoint_id in removed]
+        )
+        unreferenced = [
+            (thread_id, checkpoint_ns, channel, version)
+            for channel, version in conn.execute(
+                "SELECT channel, version FROM blobs WHERE thread_id = ? AND checkpoint_ns = ?",
+                (thread_id, checkpoint_ns)
+            ).fetchall()
+            if (channel, version) not in referenced
+        ]
+        conn.executemany(
+            "DELETE FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+            unreferenced
+        )
+        # 检查点的父检查点被删除后，它成为保留的历史的起点
+        conn.execute(
+            "UPDATE checkpoints SET parent_id = NULL WHERE thread_id = ? AND checkpoint_ns = ? AND parent_id IS NOT NULL "
+            "AND parent_id NOT IN (SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?)",
+            (thread_id, checkpoint_ns, thread_id, checkpoint_ns)
+        )
+        return len(removed)
+
+    def get_stats(self, top: int = 10) -> dict:
+        stats = super().get_stats(top)
+        try:
+            stats["db_bytes"] = sum(
+                os.path.getsize(f"{self.path}{suffix}")
+                for suffix in ("", "-wal")
+                if os.path.exists(f"{self.path}{suffix}")
+            )
+        except OSError:
+            pass
+        return stats
+
+
+def _unlink(path: Path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
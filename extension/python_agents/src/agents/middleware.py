@@ -0,0 +1,313 @@
+"""
+Agent 中间件
+在 deep agent 的模型调用外层加入横切逻辑
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+from langchain.agents.middleware import AgentMiddleware
+from langchain_core.messages import HumanMessage, RemoveMessage, SystemMessage
+from langgraph.config import get_config
+from langgraph.constants import TAG_NOSTREAM
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+
+from utils.resilience import CircuitBreaker, RetryPolicy, call_timeout, call_with_retry, remaining_budget
+from utils.tokens import content_text, count_tokens, estimate_tokens
+
+from .runner import DeadlineExceededError
+
+logger = logging.getLogger(__name__)
+
+
+def _run_config() -> dict:
+    """当前运行的配置（不在图中运行时为空）"""
+    try:
+        return get_config()
+    except RuntimeError:
+        return {}
+
+
+class ResilientModelMiddleware(AgentMiddleware):
+    """
+    模型调用的重试和熔断
+
+    agent 每一步的模型调用在暂时性故障（429、5xx、连接错误）时按 RetryPolicy 重试，
+    遵守 Retry-After；提供商的熔断器打开时直接失败。
+    重试等待不会越过 run_agent 设置的截止时间，请求被取消时立即停止。
+
+    只重试单次模型调用，不重跑整个 agent：工具调用可能已经产生副作用（如写文件）。
+
+    每次调用（包括重试）的 HTTP 超时取剩余预算和 timeout 中较小的一个，
+    单次模型调用不会阻塞到截止时间之后；截止时间已过时抛出 DeadlineExceededError，
+    由 run_agent 转换为带部分回答的 AgentBudgetExceededError。
+
+    Args:
+        policy: 重试策略
+        breaker: 提供商的熔断器
+        timeout: 单次调用的 HTTP 超时上限（秒），与 LLMConfig.timeout 一致
+    """
+
+    def __init__(self, policy: RetryPolicy, breaker: Optional[CircuitBreaker] = None, timeout: Optional[float] = None):
+        super().__init__()
+        self.policy = policy
+        self.breaker = breaker
+        self.timeout = timeout
+
+    def wrap_model_call(self, request, handler):
+        def call():
+            if remaining_budget() == 0:
+                raise DeadlineExceededError()
+            timeout = call_timeout(self.timeout)
+            if timeout is None:
+                return handler(request)
+            return handler(request.override(model_settings={**request.model_settings, "timeout": timeout}))
+
+        try:
+            return call_with_retry(call, self.policy, self.breaker, description="Agent model call")
+        except DeadlineExceededError:
+            raise
+        except Exception as e:
+            if remaining_budget() == 0:
+                # 因为超时被截断的调用按截止时间处理
+                raise DeadlineExceededError() from e
+            raise
+
+
+class ModelSwitchMiddleware(AgentMiddleware):
+    """
+    按运行配置选择模型
+
+    运行配置的 configurable.model 指定本次运行使用的模型名称，resolve 把名称解析为
+    聊天模型实例。切换模型不需要重建 agent，也不影响 checkpointer 中的对话历史；
+    模型在运行开始时确定，切换时正在执行的请求继续使用原来的模型。
+    未指定模型时使用创建 agent 时的模型。
+
+    注意：deepagents 自动添加的 general-purpose 子 agent（task 工具）不经过用户中间件，
+    仍使用创建 agent 时的模型。
+    """
+
+    def __init__(self, resolve: Callable[[str], Any]):
+        super().__init__()
+        self.resolve = resolve
+
+    def wrap_model_call(self, request, handler):
+        name = _run_config().get("configurable", {}).get("model")
+        if name:
+            model = self.resolve(name)
+            if model is not None and model is not request.model:
+                request = request.override(model=model)
+        return handler(request)
+
+
+SUMMARY_PROMPT = """You compact the history of a conversation between a user and a coding assistant.
+Write a concise summary of the conversation below that lets the assistant continue the work without the original messages.
+Keep: the user's goals and requirements, decisions made, files created or modified (with paths), important code identifiers,
+errors encountered and how they were resolved, and any open tasks. Drop pleasantries and content that can be re-read from files.
+Reply with the summary only."""
+
+# 摘要消息的标记（再次压缩时摘要本身也会被合并进新的摘要）
+SUMMARY_MARKER = "history_summary"
+
+_TRUNCATED_SUFFIX = " characters of older tool output omitted]"
+
+
+class HistoryCompactionMiddleware(AgentMiddleware):
+    """
+    对话历史压缩
+
+    每次调用模型前估算对话历史的 token 数，超过 max_tokens 时：
+    1. 截断较早轮次中过长的工具输出（如 read_file 读入的整个文件），够用则到此为止；
+    2. 否则用当前模型把较早的轮次总结成一条摘要消息，只保留最近约 keep_tokens 的完整轮次。
+
+    压缩结果写回状态（和 checkpointer），之后的请求不再发送被压缩的历史。
+    一轮从一条用户消息开始，切分点总在轮次边界上，工具调用和工具结果不会被拆开；
+    当前轮次总是完整保留。摘要失败时只做截断，不影响本次请求。
+
+    Args:
+        resolve: 模型名称 -> 聊天模型实例（与 ModelSwitchMiddleware 相同）
+        default_model: 运行配置未指定模型时用于生成摘要的模型
+        max_tokens: 对话历史的 token 预算，0 表示不压缩
+        keep_tokens: 压缩后完整保留的最近历史的 token 数
+        tool_output_chars: 较早轮次中工具输出保留的字符数
+    """
+
+    def __init__(
+        self,
+        resolve: Callable[[str], Any],
+        default_model: Any,
+        max_tokens: int = 32000,
+        keep_tokens: int = 8000,
+        tool_output_chars: int = 2000,
+        max_tracked_threads: int = 200,
+    ):
+        super().__init__()
+        self.resolve = resolve
+        self.default_model = default_model
+        self.max_tokens = max_tokens
+        self.keep_tokens = keep_tokens
+        self.tool_output_chars = tool_output_chars
+        self.max_tracked_threads = max_tracked_threads
+
+        self._lock = threading.Lock()
+        # thread_id -> 该会话的 token 使用情况（按最近使用排序）
+        self._threads: "OrderedDict[str, dict]" = OrderedDict()
+        self._stats = {"truncations": 0, "summaries": 0, "failures": 0, "tokens_saved": 0}
+
+    def before_model(self, state, runtime):
+        messages = state["messages"]
+        thread_id = _run_config().get("configurable", {}).get("thread_id")
+        before = count_tokens(messages)
+        self._track(thread_id, messages, before)
+        if not self.max_tokens or before <= self.max_tokens:
+            return None
+
+        split = self._split(messages)
+        if split == 0:
+            # 只有当前一轮，无法压缩
+            return None
+        older, recent = messages[:split], messages[split:]
+
+        truncated = [self._truncate(message) for message in older]
+        changed = [new for new, old in zip(truncated, older) if new is not old]
+        after = count_tokens(truncated) + count_tokens(recent)
+        if after <= self.max_tokens:
+            self._record(thread_id, "truncate", before, after)
+            return {"messages": changed}
+
+        summary = self._summarize(truncated)
+        if summary is None:
+            if not changed:
+                return None
+            self._record(thread_id, "truncate", before, after)
+            return {"messages": changed}
+
+        memory = HumanMessage(
+            content=f"[Summary of the earlier conversation]\n\n{summary}",
+            additional_kwargs={SUMMARY_MARKER: True}
+        )
+        after = count_tokens([memory]) + count_tokens(recent)
+        self._record(thread_id, "summary", before, after)
+        return {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES), memory, *recent]}
+
+    def _split(self, messages: List[Any]) -> int:
+        """最近历史的起点：最后一轮之前、从后往前累计不超过 keep_tokens 的最早的轮次起点"""
+        starts = [i for i, message in enumerate(messages) if getattr(message, "type", None) == "human"]
+        if not starts:
+            return 0
+        split = starts[-1]
+        recent_tokens = count_tokens(messages[split:])
+        for start in reversed(starts[:-1]):
+            recent_tokens += count_tokens(messages[start:split])
+            if recent_tokens > self.keep_tokens:
+                break
+            split = start
+        return split
+
+    def _truncate(self, message: Any) -> Any:
+        """截断过长的工具输出（返回同 id 的新消息，写回状态时替换原消息）"""
+        if getattr(message, "type", None) != "tool":
+            return message
+        text = content_text(message.content)
+        if len(text) <= self.tool_output_chars or text.endswith(_TRUNCATED_SUFFIX):
+            return message
+        omitted = len(text) - self.tool_output_chars
+        return message.model_copy(update={
+            "content": f"{text[:self.tool_output_chars]}\n... [{omitted}{_TRUNCATED_SUFFIX}"
+        })
+
+    def _summarize(self, messages: List[Any]) -> Optional[str]:
+        """用当前运行的模型总结较早的历史；失败时返回 None"""
+        name = _run_config().get("configurable", {}).get("model")
+        model = (self.resolve(name) if name else None) or self.default_model
+        transcript = self._transcript(messages)
+        # 摘要调用同样不越过请求的截止时间
+        timeout = call_timeout()
+        try:
+            # nostream：摘要不作为回答的 token 流式输出给客户端
+            response = model.invoke(
+                [SystemMessage(content=SUMMARY_PROMPT), HumanMessage(content=transcript)],
+                config={"tags": [TAG_NOSTREAM]},
+                **({"timeout": timeout} if timeout is not None else {})
+            )
+        except Exception as e:
+            logger.warning(f"History summarization failed, keeping truncated history: {e}")
+            with self._lock:
+                self._stats["failures"] += 1
+            return None
+        summary = content_text(response.content).strip()
+        return summary or None
+
+    def _transcript(self, messages: List[Any]) -> str:
+        """摘要的输入；超过预算时只保留最近的部分（之前的摘要总在开头，始终保留）"""
+        lines = []
+        for message in messages:
+            kind = getattr(message, "type", None)
+            text = content_text(message.content)
+            if kind == "human":
+                label = "Earlier summary" if message.additional_kwargs.get(SUMMARY_MARKER) else "User"
+            elif kind == "ai":
+                label = "Assistant"
+                calls = ", ".join(call.get("name", "") for call in getattr(message, "tool_calls", None) or ())
+                if calls:
+                    text = f"{text}\n(called tools: {calls})".strip()
+            elif kind == "tool":
+                label = f"Tool result ({getattr(message, 'name', None) or 'tool'})"
+            else:
+                continue
+            if text:
+                lines.append(f"{label}: {text}")
+
+        budget = self.max_tokens
+        kept = []
+        for line in reversed(lines):
+            budget -= estimate_tokens(line)
+            if budget < 0 and kept:
+                break
+            kept.append(line)
+        if lines and lines[0].startswith("Earlier summary") and lines[0] not in kept:
+            kept.append(lines[0])
+        return "\n\n".join(reversed(kept))
+
+    # ---- 统计 ----
+
+    def _track(self, thread_id: Optional[str], messages: List[Any], estimated: int):
+        if not thread_id:
+            return
+        # 模型返回的实际用量（最近一次调用的输入 + 输出 token）
+        usage = None
+        for message in reversed(messages):
+            usage = getattr(message, "usage_metadata", None)
+            if getattr(message, "type", None) == "ai":
+                break
+        with self._lock:
+            entry = self._threads.pop(thread_id, None) or {"compactions": 0}
+            entry["history_tokens"] = estimated
+            if usage:
+                entry["last_input_tokens"] = usage.get("input_tokens")
+                entry["last_output_tokens"] = usage.get("output_tokens")
+            self._threads[thread_id] = entry
+            while len(self._threads) > self.max_tracked_threads:
+                self._threads.popitem(last=False)
+
+    def _record(self, thread_id: Optional[str], mode: str, before: int, after: int):
+        logger.info(f"Compacted history of {thread_id} ({mode}): ~{before} -> ~{after} tokens")
+        with self._lock:
+            self._stats["truncations" if mode == "truncate" else "summaries"] += 1
+            self._stats["tokens_saved"] += max(0, before - after)
+            entry = self._threads.get(thread_id)
+            if entry is not None:
+                entry["compactions"] += 1
+                entry["history_tokens"] = after
+                entry["last_compaction"] = {"mode": mode, "before_tokens": before, "after_tokens": after}
+
+    def get_stats(self, top: int = 10) -> dict:
+        """压缩次数、节省的 token 数和历史最长的会话"""
+        with self._lock:
+            largest = sorted(self._threads.items(), key=lambda item: item[1]["history_tokens"], reverse=True)[:top]
+            return {
+                "max_tokens": self.max_tokens,
+                **self._stats,
+                "threads": {thread_id: dict(entry) for thread_id, entry in largest},
+            }
@@ -0,0 +1,277 @@
+"""
+Agent 运行器
+统一驱动 deep agent 的执行，在图的每一步和每次工具/模型调用前检查取消，
+并可以转发模型 token 和工具调用/待办事项的进度事件
+"""
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langgraph.errors import GraphRecursionError
+
+from utils.resilience import call_budget
+from utils.tokens import content_text
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceededError(Exception):
+    """运行超过截止时间（在回调和图的步骤之间抛出）"""
+
+
+class AgentBudgetExceededError(Exception):
+    """
+    运行在完成前耗尽预算（截止时间或最大步数）
+
+    Attributes:
+        reason: "deadline" | "max_steps"
+        state: 停止时的最新状态
+        partial: 目前为止最好的部分回答（没有时为空字符串）
+    """
+
+    def __init__(self, reason: str, state: Dict[str, Any], partial: str):
+        super().__init__(f"Agent stopped early: {reason}")
+        self.reason = reason
+        self.state = state
+        self.partial = partial
+
+
+class CancellationCallbackHandler(BaseCallbackHandler):
+    """
+    在 LangChain 回调中检查取消令牌和截止时间
+
+    令牌的 check() 在已取消时抛出异常；raise_error=True 让异常中断当前运行。
+    模型以流式方式调用时，在 token 回调中抛出会关闭底层 HTTP 响应，
+    从而放弃尚未生成的部分，不再继续消耗 token。
+    """
+
+    raise_error = True
+
+    def __init__(self, cancel_token: Any = None, deadline: Optional[float] = None):
+        self.cancel_token = cancel_token
+        self.deadline = deadline
+
+    def _check(self):
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise DeadlineExceededError()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._check()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._check()
+
+    def on_llm_new_token(self, token, **kwargs):
+        self._check()
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self._check()
+
+
+def _summarize(value: Any, limit: int = 120) -> str:
+    """截断过长的参数值，进度事件中只需要能辨认出调用了什么"""
+    text = value if isinstance(value, str) else repr(value)
+    return text if len(text) <= limit else text[:limit] + f"...({len(text)} chars)"
+
+
+def _output_size(output: Any) -> int:
+    """工具输出的字符数（ToolMessage 取其 content）"""
+    content = getattr(output, "content", output)
+    return len(content) if isinstance(content, str) else len(str(content))
+
+
+class ToolProgressCallbackHandler(BaseCallbackHandler):
+    """
+    把工具调用的开始和结束转换为进度事件
+
+    事件通过 emit(event) 交给调用方，字段:
+        type: "tool_start" | "tool_end" | "tool_error"
+        tool: 工具名
+        runId: 本次调用的 id（关联开始和结束）
+        args: 参数摘要（tool_start）
+        durationMs, outputSize: 耗时和输出字符数（tool_end）
+        error: 错误信息（tool_error）
+
+    子 agent 中的工具调用同样会上报。工具可能在线程池中并发执行，
+    emit 需要是线程安全的。
+    """
+
+    def __init__(self, emit: Callable[[Dict[str, Any]], None]):
+        self.emit = emit
+        self._lock = threading.Lock()
+        self._started: Dict[Any, tuple] = {}
+
+    def on_tool_start(self, serialized, input_str, run_id=None, inputs=None, **kwargs):
+        name = (serialized or {}).get("name") or kwargs.get("name") or "tool"
+        with self._lock:
+            self._started[run_id] = (name, time.monotonic())
+
+        if isinstance(inputs, dict):
+            args = {key: _summarize(value) for key, value in inputs.items()}
+        else:
+            args = _summarize(input_str)
+        self._safe_emit({"type": "tool_start", "tool": name, "runId": str(run_id), "args": args})
+
+    def on_tool_end(self, output, run_id=None, **kwargs):
+        name, duration_ms = self._finish(run_id)
+        self._safe_emit({
+            "type": "tool_end",
+            "tool": name,
+            "runId": str(run_id),
+            "durationMs": duration_ms,
+            "outputSize": _output_size(output),
+        })
+
+    def on_tool_error(self, error, run_id=None, **kwargs):
+        name, duration_ms = self._finish(run_id)
+        self._safe_emit({
+            "type": "tool_error",
+            "tool": name,
+            "runId": str(run_id),
+            "durationMs": duration_ms,
+            "error": _summarize(str(error), 300),
+        })
+
+    def _finish(self, run_id) -> tuple:
+        with self._lock:
+            name, started = self._started.pop(run_id, ("tool", None))
+        duration_ms = round((time.monotonic() - started) * 1000, 1) if started is not None else None
+        return name, duration_ms
+
+    def _safe_emit(self, event: Dict[str, Any]):
+        # 进度只是辅助信息，发送失败不能中断 agent 运行
+        try:
+            self.emit(event)
+        except Exception:
+            logger.exception("Failed to emit progress event")
+
+
+def _token_text(chunk: Any) -> str:
+    """取出模型输出片段中的文本（工具调用参数等非文本片段返回空字符串）"""
+    if getattr(chunk, "type", None) != "AIMessageChunk":
+        # 工具结果等完整消息不是模型生成的 token
+        return ""
+    return content_text(getattr(chunk, "content", ""))
+
+
+def run_agent(
+    agent,
+    agent_input: Optional[Dict[str, Any]],
+    config: Optional[Dict[str, Any]] = None,
+    cancel_token: Any = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    deadline: Optional[float] = None,
+    max_steps: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    运行 agent 并返回最终状态
+
+    Args:
+        agent: 编译好的 deep agent
+        agent_input: 输入状态，如 {"messages": [...]}
+        config: LangGraph 运行配置（thread_id 等）
+        cancel_token: 可选的取消令牌，需提供 check() 方法
+        on_token: 可选的回调，模型每生成一段文本调用一次。
+            只转发主 agent 的输出（子 agent 的 token 不在 messages 流中），
+            同一次运行中不同的模型消息之间插入空行分隔
+        on_progress: 可选的回调，接收工具调用事件（见 ToolProgressCallbackHandler）
+            和待办事项更新 {"type": "todos", "todos": [...]}
+        deadline: 可选的截止时间（time.monotonic() 的值），在模型 token、工具调用和图的步骤之间检查
+        max_steps: 可选的图步数上限（LangGraph 的 recursion_limit）
+
+    Returns:
+        最终的状态字典
+
+    Raises:
+        AgentBudgetExceededError: 超过截止时间或步数上限，携带部分回答
+    """
+    config = dict(config or {})
+    if max_steps is not None:
+        config["recursion_limit"] = max_steps
+    if cancel_token is not None or deadline is not None:
+        config["callbacks"] = [
+            *config.get("callbacks", []),
+            CancellationCallbackHandler(cancel_token, deadline),
+        ]
+    if on_progress is not None:
+        config["callbacks"] = [
+            *config.get("callbacks", []),
+            ToolProgressCallbackHandler(on_progress),
+        ]
+
+    # 使用 stream 而不是 invoke：每完成一步都能检查取消。
+    # 同时订阅 messages 模式，使模型以流式方式调用，取消能在 token 之间生效。
+    state: Dict[str, Any] = {}
+    # 本次运行之前已有的消息（对话历史 + 输入）的 id，用于找出本次生成的回答。
+    # 不用消息数：历史压缩（HistoryCompactionMiddleware）可能在运行中缩短消息列表
+    baseline = None
+    todos = None
+    message_id = None
+    emitted = False
+    # 正在生成的模型消息的文本（超时时作为部分回答）
+    current: list = []
+    try:
+        # 模型调用的重试等待不越过截止时间，取消时立即停止（见 ResilientModelMiddleware）
+        with call_budget(deadline, cancel_token):
+            for mode, payload in agent.stream(agent_input, config, stream_mode=["values", "messages"]):
+                if cancel_token is not None:
+                    cancel_token.check()
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise DeadlineExceededError()
+
+                if mode == "values":
+                    state = payload
+                    if baseline is None:
+                        baseline = {getattr(m, "id", None) for m in state.get("messages", [])} - {None}
+                    if on_progress is not None and state.get("todos") is not None and state["todos"] != todos:
+                        # write_todos 更新了待办列表
+                        todos = state["todos"]
+                        on_progress({"type": "todos", "todos": todos})
+                elif mode == "messages":
+                    chunk, _metadata = payload
+                    text = _token_text(chunk)
+                    if not text:
+                        continue
+
+                    chunk_id = getattr(chunk, "id", None)
+                    if chunk_id != message_id:
+                        current = []
+                    current.append(text)
+                    if emitted and chunk_id != message_id:
+                        # 工具调用之后的新一轮模型输出
+                        text = "\n\n" + text
+                    message_id = chunk_id
+                    emitted = True
+                    if on_token is not None:
+                        on_token(text)
+
+    except DeadlineExceededError:
+        raise AgentBudgetExceededError("deadline", state, _partial_answer(state, baseline, current))
+    except GraphRecursionError:
+        raise AgentBudgetExceededError("max_steps", state, _partial_answer(state, baseline, current))
+
+    return state
+
+
+def _partial_answer(state: Dict[str, Any], baseline: Optional[set], current: list) -> str:
+    """
+    运行中途停止时最好的部分回答
+
+    优先使用正在流式生成的那条消息；没有时使用本次运行中最后一条带文本的模型消息
+    """
+    text = "".join(current).strip()
+    if text:
+        return text
+
+    for message in reversed(state.get("messages", [])):
+        if getattr(message, "type", None) != "ai" or getattr(message, "id", None) in (baseline or ()):
+            continue
+        text = content_text(getattr(message, "content", ""))
+        if text.strip():
+            return text.strip()
+    return ""
@@ -2,6 +2,7 @@
 统一的 Chat Agent
 基于 deepagents，一个聊天框完成所有代码操作（生成、解释、重构）
 """
+import hashlib
 import logging
 from typing import List
 from deepagents import create_deep_agent
@@ -13,6 +14,8 @@ def create_unified_chat_agent(
     llm,
     custom_tools: List = None,
     backend = None,
+    middleware: List = None,
+    checkpointer = None,
 ):
     """
     创建统一的聊天 Agent（单一 DeepAgent，无 subagents）
@@ -30,7 +33,9 @@ def create_unified_chat_agent(
                 - None: 使用默认的 StateBackend（推荐）
                 - StateBackend: 文件存储在 LangGraph 状态中
                 - FilesystemBackend: 文件存储在实际磁盘上
-                注意：这不是 checkpointer！Checkpointer 在 invoke 时传递。
+                注意：这不是 checkpointer！
+        middleware: 额外的 Agent 中间件（如模型调用的重试和熔断）
+        checkpointer: 对话历史的 checkpointer（按运行配置的 thread_id 保存）
         
     Returns:
         配置好的 DeepAgent
@@ -38,8 +43,24 @@ def create_unified_chat_agent(
     
     logger.info("Creating unified chat agent...")
     
-    # 统一的系统提示：涵盖所有功能
-    system_prompt = """You are Vibe Coding AI - an expert AI coding assistant with comprehensive capabilities.
+    # 创建单一强大的 DeepAgent
+    agent = create_deep_agent(
+        model=llm,
+        system_prompt=SYSTEM_PROMPT,
+        tools=custom_tools or [],  # 包含所有代码分析工具
+        backend=backend,  # 文件系统后端（None = 使用默认 StateBackend）
+        middleware=middleware or (),
+        checkpointer=checkpointer,
+    )
+    
+    logger.info("✓ Unified chat agent created successfully")
+    logger.info("  Single DeepAgent with all capabilities (generation, explanation, refactoring)")
+    
+    return agent
+
+
+# 统一的系统提示：涵盖所有功能
+SYSTEM_PROMPT = """You are Vibe Coding AI - an expert AI coding assistant with comprehensive capabilities.
 
 ## Your Core Abilities
 
@@ -146,17 +167,7 @@ You have access to:
 - **Planning:** write_todos for task breakdown
 
 Be helpful, accurate, and efficient. Always understand the context before acting."""
-    
-    # 创建单一强大的 DeepAgent
-    agent = create_deep_agent(
-        model=llm,
-        system_prompt=system_prompt,
-        tools=custom_tools or [],  # 包含所有代码分析工具
-        backend=backend,  # 文件系统后端（None = 使用默认 StateBackend）
-    )
-    
-    logger.info("✓ Unified chat agent created successfully")
-    logger.info("  Single DeepAgent with all capabilities (generation, explanation, refactoring)")
-    
-    return agent
+
+# 系统提示的版本（内容哈希），作为响应缓存键的一部分：修改提示后旧的缓存结果自动失效
+SYSTEM_PROMPT_VERSION = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:12]
 
@@ -3,8 +3,9 @@
 从环境变量和文件加载配置
 """
 import os
+import hashlib
 import logging
-from typing import Optional
+from typing import List, Optional
 from dataclasses import dataclass, field
 from pathlib import Path
 
@@ -31,6 +32,7 @@ class Settings:
     # 工作区配置
     workspace_root: str = field(default_factory=os.getcwd)
     workspace_dir: Optional[str] = None  # Agent 生成文件的目标目录，默认为 workspace_root/workspace
+    cache_dir: Optional[str] = None  # 缓存目录，默认为用户缓存目录下按 workspace_root 区分的子目录
     
     # LLM 配置
     llm_provider: str = "dashscope"
@@ -39,14 +41,42 @@ class Settings:
     llm_api_base: Optional[str] = None
     llm_temperature: float = 0.7
     llm_max_tokens: int = 4000
+    llm_circuit_failure_threshold: int = 5  # 连续故障达到该次数后熔断，快速失败
+    llm_circuit_reset_seconds: int = 30  # 熔断后多久放行探测请求
+    prewarm_models: List[str] = field(default_factory=list)  # 启动后在后台预先创建客户端并建立连接的模型
     
     # 开发模式（仅用于调试）
     dev_mode: bool = False
     
     # Agent 配置
-    agent_timeout: int = 30  # 秒
-    agent_max_retries: int = 3
-    agent_enable_cache: bool = True
+    agent_timeout: int = 30  # 秒，单个请求的截止时间（请求参数 timeout 可覆盖），也用作 LLM HTTP 超时
+    agent_max_steps: int = 50  # 单次运行的图步数上限（LangGraph recursion_limit）
+    agent_max_retries: int = 3  # 模型调用遇到 429/5xx/连接错误时的重试次数
+    agent_enable_cache: bool = True  # 缓存 explain_code / generate_code / refactor_code 的结果
+    agent_cache_max_entries: int = 256  # 内存缓存的条目上限
+    agent_cache_max_mb: int = 32  # 内存缓存的大小上限
+    agent_cache_ttl: int = 3600  # 缓存条目有效期（秒），0 表示不过期
+    agent_cache_disk_mb: int = 0  # 磁盘缓存（cache_dir/responses）容量，0 表示只用内存缓存
+    agent_history_max_tokens: int = 32000  # 对话历史超过该 token 数（估算）时压缩，0 表示不压缩
+    agent_history_keep_tokens: int = 8000  # 压缩时完整保留的最近历史的 token 数，更早的轮次总结为摘要
+    agent_history_tool_chars: int = 2000  # 压缩时较早轮次的工具输出保留的字符数
+    agent_context_max_tokens: int = 4000  # chat 请求附带的编辑器上下文的 token 预算（估算），0 表示不附带
+    conversation_max_threads: int = 100  # 内存中保留的对话数上限，0 表示不限制
+    conversation_max_mb: int = 128  # 内存中对话历史的总大小上限，0 表示不限制
+    conversation_spill: bool = True  # 超出上限的对话写入 cache_dir/conversations，再次使用时加载；否则丢弃
+    conversation_store: str = "memory"  # 对话历史存储：memory（进程内）或 sqlite（cache_dir/conversations.sqlite3，重启后保留）
+    conversation_keep_checkpoints: int = 10  # sqlite 存储压缩后每个对话保留的检查点数
+    conversation_compact_interval: int = 600  # sqlite 存储后台压缩的间隔（秒），0 表示不压缩
+    
+    # RPC 配置
+    rpc_max_workers: int = 4  # 并发处理请求的线程数，0 表示串行处理
+    rpc_framing: str = "line"  # 初始分帧模式：line 或 content-length
+    rpc_asyncio: bool = False  # 主循环运行在 asyncio 事件循环上（支持 async 处理器）
+    rpc_output_buffer_mb: int = 8  # 输出队列积压上限，超过后发送方阻塞
+    rpc_coalesce_ms: int = 20  # 合并连续 chat.stream 片段的时间窗口，0 表示只合并已积压的片段
+    rpc_spill_threshold_kb: int = 256  # 结果中超过该大小的字符串写入临时文件（客户端开启时），0 表示禁用
+    rpc_spill_max_age: int = 600  # 未释放的溢出文件保留时间（秒）
+    rpc_stats_log_interval: int = 0  # 每隔该秒数把 RPC 指标摘要写入日志，0 表示不写
     
     # 安全配置
     max_file_size_mb: int = 10
@@ -75,6 +105,7 @@ class Settings:
         return cls(
             workspace_root=os.environ.get("WORKSPACE_ROOT", os.getcwd()),
             workspace_dir=os.environ.get("WORKSPACE_DIR"),  # 如果未设置，将使用默认路径
+            cache_dir=os.environ.get("CACHE_DIR"),
             
             # LLM
             llm_provider=os.environ.get("LLM_PROVIDER", "dashscope"),
@@ -83,14 +114,42 @@ class Settings:
             llm_api_base=os.environ.get("LLM_API_BASE"),
             llm_temperature=float(os.environ.get("LLM_TEMPERATURE", "0.7")),
             llm_max_tokens=int(os.environ.get("LLM_MAX_TOKENS", "4000")),
+            llm_circuit_failure_threshold=int(os.environ.get("LLM_CIRCUIT_FAILURE_THRESHOLD", "5")),
+            llm_circuit_reset_seconds=int(os.environ.get("LLM_CIRCUIT_RESET_SECONDS", "30")),
+            prewarm_models=[m.strip() for m in os.environ.get("PREWARM_MODELS", "").split(",") if m.strip()],
             
             # 开发模式标志
             dev_mode=dev_mode,
             
             # Agent
             agent_timeout=int(os.environ.get("AGENT_TIMEOUT", "30")),
+            agent_max_steps=int(os.environ.get("AGENT_MAX_STEPS", "50")),
             agent_max_retries=int(os.environ.get("AGENT_MAX_RETRIES", "3")),
             agent_enable_cache=os.environ.get("AGENT_ENABLE_CACHE", "true").lower() == "true",
+            agent_cache_max_entries=int(os.environ.get("AGENT_CACHE_MAX_ENTRIES", "256")),
+            agent_cache_max_mb=int(os.environ.get("AGENT_CACHE_MAX_MB", "32")),
+            agent_cache_ttl=int(os.environ.get("AGENT_CACHE_TTL", "3600")),
+            agent_cache_disk_mb=int(os.environ.get("AGENT_CACHE_DISK_MB", "0")),
+            agent_history_max_tokens=int(os.environ.get("AGENT_HISTORY_MAX_TOKENS", "32000")),
+            agent_history_keep_tokens=int(os.environ.get("AGENT_HISTORY_KEEP_TOKENS", "8000")),
+            agent_history_tool_chars=int(os.environ.get("AGENT_HISTORY_TOOL_CHARS", "2000")),
+            agent_context_max_tokens=int(os.environ.get("AGENT_CONTEXT_MAX_TOKENS", "4000")),
+            conversation_max_threads=int(os.environ.get("CONVERSATION_MAX_THREADS", "100")),
+            conversation_max_mb=int(os.environ.get("CONVERSATION_MAX_MB", "128")),
+            conversation_spill=os.environ.get("CONVERSATION_SPILL", "true").lower() == "true",
+            conversation_store=os.environ.get("CONVERSATION_STORE", "memory").lower(),
+            conversation_keep_checkpoints=int(os.environ.get("CONVERSATION_KEEP_CHECKPOINTS", "10")),
+            conversation_compact_interval=int(os.environ.get("CONVERSATION_COMPACT_INTERVAL", "600")),
+            
+            # RPC
+            rpc_max_workers=int(os.environ.get("RPC_MAX_WORKERS", "4")),
+            rpc_framing=os.environ.get("RPC_FRAMING", "line").lower(),
+            rpc_asyncio=os.environ.get("RPC_ASYNCIO", "false").lower() == "true",
+            rpc_output_buffer_mb=int(os.environ.get("RPC_OUTPUT_BUFFER_MB", "8")),
+            rpc_coalesce_ms=int(os.environ.get("RPC_COALESCE_MS", "20")),
+            rpc_spill_threshold_kb=int(os.environ.get("RPC_SPILL_THRESHOLD_KB", "256")),
+            rpc_spill_max_age=int(os.environ.get("RPC_SPILL_MAX_AGE", "600")),
+            rpc_stats_log_interval=int(os.environ.get("RPC_STATS_LOG_INTERVAL", "0")),
             
             # 安全
             max_file_size_mb=int(os.environ.get("MAX_FILE_SIZE_MB", "10")),
@@ -129,6 +188,28 @@ class Settings:
             # 默认：workspace_root/workspace
             return (Path(self.workspace_root) / "workspace").resolve()
     
+    def get_cache_dir(self) -> Path:
+        """
+        获取缓存目录路径
+        
+        如果 cache_dir 已设置，直接使用（相对路径相对于 workspace_root）；
+        否则使用用户级缓存目录 $XDG_CACHE_HOME/vibe_coding/<工作区哈希>（默认 ~/.cache），
+        不在用户的项目里创建目录，不同工作区的缓存互不干扰
+        
+        Returns:
+            Path: 缓存目录的绝对路径
+        """
+        if not self.cache_dir:
+            workspace = str(Path(self.workspace_root).resolve())
+            digest = hashlib.sha256(workspace.encode("utf-8")).hexdigest()[:16]
+            user_cache = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+            return (Path(user_cache) / "vibe_coding" / digest).resolve()
+        
+        cache_path = Path(self.cache_dir)
+        if not cache_path.is_absolute():
+            cache_path = Path(self.workspace_root) / cache_path
+        return cache_path.resolve()
+    
     def validate(self) -> bool:
         """验证配置是否有效"""
         issues = []
@@ -151,6 +232,66 @@ class Settings:
         if self.llm_max_tokens < 1:
             issues.append(f"Invalid max_tokens: {self.llm_max_tokens}")
         
+        if self.llm_circuit_failure_threshold < 1:
+            issues.append(f"Invalid llm_circuit_failure_threshold: {self.llm_circuit_failure_threshold}")
+        
+        if self.agent_max_retries < 0:
+            issues.append(f"Invalid agent_max_retries: {self.agent_max_retries}")
+        
+        if self.agent_timeout < 1:
+            issues.append(f"Invalid agent_timeout: {self.agent_timeout}")
+        
+        if self.agent_max_steps < 1:
+            issues.append(f"Invalid agent_max_steps: {self.agent_max_steps}")
+        
+        if self.agent_cache_max_entries < 1 or self.agent_cache_max_mb < 1:
+            issues.append(f"Invalid agent cache size: {self.agent_cache_max_entries} entries / {self.agent_cache_max_mb}MB")
+        
+        if self.agent_cache_ttl < 0 or self.agent_cache_disk_mb < 0:
+            issues.append(f"Invalid agent cache ttl/disk size: {self.agent_cache_ttl}s / {self.agent_cache_disk_mb}MB")
+        
+        if self.agent_history_max_tokens < 0 or self.agent_history_tool_chars < 0:
+            issues.append(f"Invalid agent history limits: {self.agent_history_max_tokens} tokens / "
+                          f"{self.agent_history_tool_chars} tool output chars")
+        
+        if self.agent_history_max_tokens and not 0 <= self.agent_history_keep_tokens < self.agent_history_max_tokens:
+            issues.append(f"Invalid agent_history_keep_tokens: {self.agent_history_keep_tokens} "
+                          f"(must be below agent_history_max_tokens {self.agent_history_max_tokens})")
+        
+        if self.agent_context_max_tokens < 0:
+            issues.append(f"Invalid agent_context_max_tokens: {self.agent_context_max_tokens}")
+        
+        if self.conversation_max_threads < 0 or self.conversation_max_mb < 0:
+            issues.append(f"Invalid conversation limits: {self.conversation_max_threads} threads / {self.conversation_max_mb}MB")
+        
+        if self.conversation_store not in ("memory", "sqlite"):
+            issues.append(f"Invalid conversation_store: {self.conversation_store} (must be memory or sqlite)")
+        
+        if self.conversation_keep_checkpoints < 1 or self.conversation_compact_interval < 0:
+            issues.append(f"Invalid conversation compaction: keep {self.conversation_keep_checkpoints} "
+                          f"every {self.conversation_compact_interval}s")
+        
+        if self.rpc_max_workers < 0:
+            issues.append(f"Invalid rpc_max_workers: {self.rpc_max_workers}")
+        
+        if self.rpc_framing not in ("line", "content-length"):
+            issues.append(f"Invalid rpc_framing: {self.rpc_framing} (must be line or content-length)")
+        
+        if self.rpc_output_buffer_mb < 1:
+            issues.append(f"Invalid rpc_output_buffer_mb: {self.rpc_output_buffer_mb}")
+        
+        if self.rpc_coalesce_ms < 0:
+            issues.append(f"Invalid rpc_coalesce_ms: {self.rpc_coalesce_ms}")
+        
+        if self.rpc_spill_threshold_kb < 0:
+            issues.append(f"Invalid rpc_spill_threshold_kb: {self.rpc_spill_threshold_kb}")
+        
+        if self.rpc_spill_max_age < 1:
+            issues.append(f"Invalid rpc_spill_max_age: {self.rpc_spill_max_age}")
+        
+        if self.rpc_stats_log_interval < 0:
+            issues.append(f"Invalid rpc_stats_log_interval: {self.rpc_stats_log_interval}")
+        
         if self.dev_mode:
             logger.info("🔧 Development mode enabled - using test configuration")
         
@@ -166,13 +307,40 @@ class Settings:
         return {
             "workspace_root": self.workspace_root,
             "workspace_dir": str(self.get_workspace_dir()),  # 显示实际使用的路径
+            "cache_dir": str(self.get_cache_dir()),
             "llm_provider": self.llm_provider,
             "llm_model": self.llm_model,
             "llm_temperature": self.llm_temperature,
             "llm_max_tokens": self.llm_max_tokens,
+            "llm_circuit_failure_threshold": self.llm_circuit_failure_threshold,
+            "llm_circuit_reset_seconds": self.llm_circuit_reset_seconds,
+            "prewarm_models": self.prewarm_models,
             "agent_timeout": self.agent_timeout,
+            "agent_max_steps": self.agent_max_steps,
             "agent_max_retries": self.agent_max_retries,
             "agent_enable_cache": self.agent_enable_cache,
+            "agent_cache_max_entries": self.agent_cache_max_entries,
+            "agent_cache_max_mb": self.agent_cache_max_mb,
+            "agent_cache_ttl": self.agent_cache_ttl,
+            "agent_cache_disk_mb": self.agent_cache_disk_mb,
+            "agent_history_max_tokens": self.agent_history_max_tokens,
+            "agent_history_keep_tokens": self.agent_history_keep_tokens,
+            "agent_history_tool_chars": self.agent_history_tool_chars,
+            "agent_context_max_tokens": self.agent_context_max_tokens,
+            "conversation_max_threads": self.conversation_max_threads,
+            "conversation_max_mb": self.conversation_max_mb,
+            "conversation_spill": self.conversation_spill,
+            "conversation_store": self.conversation_store,
+            "conversation_keep_checkpoints": self.conversation_keep_checkpoints,
+            "conversation_compact_interval": self.conversation_compact_interval,
+            "rpc_max_workers": self.rpc_max_workers,
+            "rpc_framing": self.rpc_framing,
+            "rpc_asyncio": self.rpc_asyncio,
+            "rpc_output_buffer_mb": self.rpc_output_buffer_mb,
+            "rpc_coalesce_ms": self.rpc_coalesce_ms,
+            "rpc_spill_threshold_kb": self.rpc_spill_threshold_kb,
+            "rpc_spill_max_age": self.rpc_spill_max_age,
+            "rpc_stats_log_interval": self.rpc_stats_log_interval,
             "max_file_size_mb": self.max_file_size_mb,
             "max_memory_mb": self.max_memory_mb,
             "enable_security_checks": self.enable_security_checks,
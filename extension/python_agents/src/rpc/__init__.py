@@ -2,6 +2,9 @@
 RPC 模块
 """
 from .server import JSONRPCServer
+from .connection import Connection
+from .spill import SpillStore
+from .metrics import RPCMetrics, LatencyHistogram
 from .errors import (
     JSONRPCError,
     ParseError,
@@ -9,12 +12,14 @@ from .errors import (
     MethodNotFound,
     InvalidParams,
     InternalError,
+    RequestCancelled,
     AgentError,
     LLMError,
     FileSystemError,
     TimeoutError,
     SecurityError
 )
+from .context import CancellationToken, RequestContext, get_current_request, get_current_connection
 from .protocol import (
     JSONRPCRequest,
     JSONRPCResponse,
@@ -24,12 +29,17 @@ from .protocol import (
 
 __all__ = [
     'JSONRPCServer',
+    'Connection',
+    'SpillStore',
+    'RPCMetrics',
+    'LatencyHistogram',
     'JSONRPCError',
     'ParseError',
     'InvalidRequest',
     'MethodNotFound',
     'InvalidParams',
     'InternalError',
+    'RequestCancelled',
     'AgentError',
     'LLMError',
     'FileSystemError',
@@ -39,5 +49,9 @@ __all__ = [
     'JSONRPCResponse',
     'JSONRPCErrorResponse',
     'JSONRPCNotification',
+    'CancellationToken',
+    'RequestContext',
+    'get_current_request',
+    'get_current_connection',
 ]
 
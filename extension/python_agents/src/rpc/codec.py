@@ -0,0 +1,64 @@
+"""
+JSON 编解码
+单次遍历完成序列化并直接输出 UTF-8 字节；安装了 orjson 时自动使用
+"""
+import json
+import logging
+from typing import Any, Union
+
+logger = logging.getLogger(__name__)
+
+# 可选的快速 JSON 后端
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def encode_json_stdlib(obj: Any) -> bytes:
+    """
+    使用标准库序列化为 UTF-8 字节
+
+    ensure_ascii=False 时孤立的代理字符（surrogate）会原样留在生成的字符串中，
+    编码为 UTF-8 时用 errors='ignore' 丢弃它们。效果与先递归清理再序列化相同，
+    但只遍历一次对象树，也不会复制中间的 dict/list。
+    """
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8', errors='ignore')
+
+
+def encode_json(obj: Any) -> bytes:
+    """
+    序列化为 UTF-8 字节
+
+    优先使用 orjson；orjson 拒绝的输入（孤立代理字符、超出 64 位的整数等）
+    回退到标准库，不可序列化的对象仍然抛出 TypeError。
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # orjson.JSONEncodeError 是 TypeError 的子类
+            pass
+    return encode_json_stdlib(obj)
+
+
+def decode_json(data: Union[str, bytes, bytearray, memoryview]) -> Any:
+    """
+    解析 JSON 文本或 UTF-8 字节
+
+    Raises:
+        UnicodeDecodeError: 字节不是合法的 UTF-8
+        json.JSONDecodeError: JSON 格式错误
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson 比标准库严格（如 NaN），交给标准库给出最终结果
+            pass
+
+    if not isinstance(data, str):
+        data = str(data, 'utf-8')
+    return json.loads(data)
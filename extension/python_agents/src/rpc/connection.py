@@ -0,0 +1,195 @@
+"""
+客户端连接
+每个连接拥有独立的分帧、输出写线程和应用层状态；
+stdio 模式只有一个连接，守护进程模式下每个 Unix socket 客户端一个连接
+"""
+import socket
+import logging
+import itertools
+import threading
+from typing import Any, Dict, Optional, BinaryIO
+
+from .codec import encode_json
+from .writer import OutputWriter
+from .transport import TRANSPORTS, create_transport
+
+logger = logging.getLogger(__name__)
+
+
+def merge_stream_notifications(older: dict, newer: dict) -> dict:
+    """合并同一会话的两条 chat.stream 通知：拼接 chunk，其余字段取较新的一条"""
+    params = dict(newer["params"])
+    params["chunk"] = older["params"]["chunk"] + params["chunk"]
+    return {**newer, "params": params}
+
+
+def merge_notifications(older: dict, newer: dict) -> dict:
+    """合并同一 key 的两条通知：chat.stream 拼接片段，待办列表快照（chat.progress todos）只保留较新的一条"""
+    if newer.get("method") == "chat.stream":
+        return merge_stream_notifications(older, newer)
+    return newer
+
+
+def _coalesce_key(data: Any) -> Optional[tuple]:
+    """
+    可合并消息的 key，其他消息不合并（返回 None）
+
+    - chat.stream 通知按会话合并
+    - chat.progress 的待办列表更新按请求合并：每条都是完整快照，只需写出最新的；
+      工具调用的开始和结束事件需要成对出现，不合并
+    """
+    if not isinstance(data, dict):
+        return None
+    params = data.get("params")
+    if not isinstance(params, dict):
+        return None
+    if data.get("method") == "chat.stream" and isinstance(params.get("chunk"), str):
+        return ("chat.stream", params.get("conversationId"))
+    if data.get("method") == "chat.progress" and params.get("type") == "todos":
+        return ("chat.progress", params.get("requestId"), params.get("conversationId"))
+    return None
+
+
+class Connection:
+    """
+    一个客户端连接
+    
+    Args:
+        reader: 二进制输入流
+        writer: 二进制输出流
+        framing: 初始分帧模式
+        sock: 守护进程模式下的客户端 socket（用于主动断开）
+        max_pending_bytes: 输出队列积压上限
+        coalesce_window: 合并 chat.stream 片段和待办列表更新的时间窗口（秒）
+    """
+    
+    _ids = itertools.count(1)
+    
+    def __init__(
+        self,
+        reader: Optional[BinaryIO],
+        writer: BinaryIO,
+        framing: str = "line",
+        sock: Optional[socket.socket] = None,
+        max_pending_bytes: int = 8 * 1024 * 1024,
+        coalesce_window: float = 0.02
+    ):
+        self.id = next(Connection._ids)
+        self.framing = framing
+        self.transport = create_transport(framing, reader, writer)
+        self.socket = sock
+        self.max_pending_bytes = max_pending_bytes
+        self.coalesce_window = coalesce_window
+        self.closed = False
+        # 通过 $/configure 开启后，大结果写入临时文件（见 SpillStore）
+        self.spillover = False
+        # 客户端通过 $/configure 提供的稳定标识（如工作区或会话 id），跨连接、跨重启不变
+        self.client_id: Optional[str] = None
+        
+        # 应用层的会话状态（如客户端自己的工作区）
+        self.state: Dict[str, Any] = {}
+        
+        self._writer: Optional[OutputWriter] = None
+        # 写线程未启动时（如直接调用 process_message）保证消息不会交错
+        self._write_lock = threading.Lock()
+    
+    def start_writer(self):
+        """启动输出写线程"""
+        if self._writer is None:
+            self._writer = OutputWriter(
+                self.transport,
+                merge=merge_notifications,
+                max_pending_bytes=self.max_pending_bytes,
+                coalesce_window=self.coalesce_window
+            )
+            self._writer.start()
+    
+    def write(self, data: Any) -> bytes:
+        """序列化并写出一条消息（线程安全）"""
+        # 序列化时顺带丢弃无效的 Unicode 字符（孤立代理字符）；
+        # 在调用方线程完成，不可序列化的结果在这里就抛出 TypeError
+        payload = encode_json(data)
+        
+        if self.closed:
+            logger.debug(f"Connection {self.id} closed, dropped message ({len(payload)} bytes)")
+            return payload
+        
+        writer = self._writer
+        if writer is not None:
+            key = _coalesce_key(data)
+            writer.put(payload, key, data if key is not None else None)
+            return payload
+        
+        with self._write_lock:
+            self.transport.write_message(payload)
+        return payload
+    
+    def send_result(self, response: Optional[dict]) -> Optional[bytes]:
+        """写出单个请求的响应，返回编码后的消息"""
+        if response is None:
+            return None
+        payload = self.write(response)
+        logger.debug(f"Sent response: {payload[:100]!r}...")
+        return payload
+    
+    def switch_framing(self, framing: str, response: Optional[dict]):
+        """
+        写出 $/configure 的响应并切换分帧
+        
+        响应（以及此前排队的消息）使用旧分帧；读取端立即切换，
+        客户端收到响应后发送的消息使用新分帧。
+        """
+        if framing not in TRANSPORTS:
+            raise ValueError(f"Unsupported framing: {framing}")
+        
+        payload = encode_json(response) if response is not None else None
+        
+        with self._write_lock:
+            transport = self.transport
+            if framing == self.framing:
+                switched = transport
+            else:
+                switched = create_transport(framing, transport.reader, transport.writer)
+            
+            writer = self._writer
+            if writer is not None:
+                if payload is not None:
+                    writer.put(payload)
+                writer.switch_transport(switched)
+            elif payload is not None:
+                transport.write_message(payload)
+            
+            self.transport = switched
+            if framing != self.framing:
+                self.framing = framing
+                logger.info(f"Connection {self.id} switched framing: {transport.name} -> {framing}")
+    
+    def disconnect(self):
+        """停止读取该连接的后续请求（已排队的输出仍会写出）"""
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+    
+    def close(self):
+        """写出剩余消息并关闭连接（之后的消息被丢弃）"""
+        self.closed = True
+        writer = self._writer
+        if writer is not None:
+            writer.close()
+            self._writer = None
+            logger.info(f"Connection {self.id} output writer stopped: {writer.get_stats()}")
+        
+        if self.socket is not None:
+            # makefile() 创建的文件对象也持有 socket，需要一并关闭
+            for stream in (self.transport.reader, self.transport.writer, self.socket):
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+    
+    def get_output_stats(self) -> dict:
+        """获取写线程的统计（未启动时为空）"""
+        writer = self._writer
+        return writer.get_stats() if writer is not None else {}
@@ -0,0 +1,83 @@
+"""
+请求上下文
+记录正在处理的请求信息，并为处理器提供取消令牌
+"""
+import time
+import threading
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional
+
+from .errors import RequestCancelled
+
+
+class CancellationToken:
+    """取消令牌（线程安全）"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self.cancelled_at: Optional[float] = None
+
+    def cancel(self):
+        """标记为已取消，并调用已注册的回调"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.cancelled_at = time.monotonic()
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]):
+        """注册取消回调（已取消时立即调用）"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    @property
+    def cancelled(self) -> bool:
+        """是否已取消"""
+        return self._event.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待取消，返回是否已取消（用于可被取消打断的等待，如重试退避）"""
+        return self._event.wait(timeout)
+
+    def check(self):
+        """已取消时抛出 RequestCancelled"""
+        if self._event.is_set():
+            raise RequestCancelled()
+
+
+@dataclass
+class RequestContext:
+    """单个请求的上下文"""
+    id: Any
+    method: str
+    token: CancellationToken = field(default_factory=CancellationToken)
+    received_at: float = field(default_factory=time.monotonic)
+    started_at: Optional[float] = None
+    # 请求来自的客户端连接（rpc.connection.Connection）
+    connection: Any = None
+
+
+_current_request: ContextVar[Optional[RequestContext]] = ContextVar(
+    "rpc_current_request", default=None
+)
+
+
+def get_current_request() -> Optional[RequestContext]:
+    """获取当前线程正在处理的请求上下文（不在请求中时返回 None）"""
+    return _current_request.get()
+
+
+def get_current_connection() -> Optional[Any]:
+    """获取当前请求所属的客户端连接（不在请求中时返回 None）"""
+    context = _current_request.get()
+    return context.connection if context is not None else None
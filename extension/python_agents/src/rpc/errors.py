@@ -52,6 +52,12 @@ class InternalError(JSONRPCError):
         super().__init__(-32603, message, data)
 
 
+class RequestCancelled(JSONRPCError):
+    """请求已被客户端取消（与 LSP 的 RequestCancelled 错误码一致）"""
+    def __init__(self, message: str = "Request cancelled", data: dict = None):
+        super().__init__(-32800, message, data)
+
+
 # 自定义错误
 class AgentError(JSONRPCError):
     """Agent 执行错误"""
@@ -0,0 +1,181 @@
+"""
+RPC 指标
+按方法统计调用次数、错误数、执行中的请求数、延迟分布和收发字节数，
+通过 server.stats 方法查询，也可以定期写入日志（stderr）
+"""
+import math
+import time
+import threading
+from typing import Dict, List, Optional
+
+# 延迟直方图的桶：0.1ms 起每个桶增长 25%，约 100 个桶覆盖到 30 分钟
+_BUCKET_BASE_MS = 0.1
+_BUCKET_GROWTH = 1.25
+_BUCKET_COUNT = 100
+
+
+def _bucket_index(value_ms: float) -> int:
+    if value_ms <= _BUCKET_BASE_MS:
+        return 0
+    index = int(math.log(value_ms / _BUCKET_BASE_MS, _BUCKET_GROWTH)) + 1
+    return min(index, _BUCKET_COUNT - 1)
+
+
+def _bucket_upper(index: int) -> float:
+    return _BUCKET_BASE_MS * _BUCKET_GROWTH ** index
+
+
+class LatencyHistogram:
+    """
+    固定对数分桶的延迟直方图
+
+    记录是 O(1) 的，内存固定；百分位数的相对误差不超过一个桶的宽度（25%），
+    对于区分毫秒级的传输开销和秒级的 LLM 调用已经足够。
+    调用方负责加锁。
+    """
+
+    def __init__(self):
+        self.counts: List[int] = [0] * _BUCKET_COUNT
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, value_ms: float):
+        self.counts[_bucket_index(value_ms)] += 1
+        self.count += 1
+        self.total_ms += value_ms
+        self.max_ms = max(self.max_ms, value_ms)
+
+    def percentile(self, p: float) -> float:
+        """第 p 百分位（0-100），取所在桶的上界（不超过实际最大值）"""
+        if self.count == 0:
+            return 0.0
+        rank = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(_bucket_upper(index), self.max_ms)
+        return self.max_ms
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 2),
+            "p95_ms": round(self.percentile(95), 2),
+            "p99_ms": round(self.percentile(99), 2),
+            "max_ms": round(self.max_ms, 2),
+        }
+
+
+class _MethodStats:
+    """单个方法的统计"""
+
+    __slots__ = ("calls", "errors", "cancelled", "in_flight", "latency", "queue_wait",
+                 "bytes_in", "bytes_out", "messages_out")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.in_flight = 0
+        self.latency = LatencyHistogram()
+        self.queue_wait = LatencyHistogram()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_out = 0
+
+
+class RPCMetrics:
+    """
+    服务器指标
+
+    - latency: 处理器执行时间（从开始执行到返回）
+    - queue_wait: 从收到请求到开始执行的等待（线程池排队、会话串行化）
+    - bytes_in / bytes_out: 请求、响应和通知编码后的大小
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods: Dict[str, _MethodStats] = {}
+        self.started_at = time.monotonic()
+
+    def _get(self, method: str) -> _MethodStats:
+        stats = self._methods.get(method)
+        if stats is None:
+            stats = self._methods[method] = _MethodStats()
+        return stats
+
+    def request_started(self, method: str, queue_wait: float):
+        """请求开始执行（queue_wait 单位为秒）"""
+        with self._lock:
+            stats = self._get(method)
+            stats.in_flight += 1
+            stats.queue_wait.record(queue_wait * 1000)
+
+    def request_finished(self, method: str, duration: Optional[float], error: bool = False, cancelled: bool = False):
+        """
+        请求结束
+
+        Args:
+            duration: 执行时间（秒）；未开始执行就结束（如排队时被取消）时为 None
+        """
+        with self._lock:
+            stats = self._get(method)
+            stats.calls += 1
+            if cancelled:
+                stats.cancelled += 1
+            elif error:
+                stats.errors += 1
+            if duration is not None:
+                stats.in_flight -= 1
+                stats.latency.record(duration * 1000)
+
+    def record_bytes_in(self, method: str, size: int):
+        with self._lock:
+            self._get(method).bytes_in += size
+
+    def record_bytes_out(self, method: str, size: int):
+        with self._lock:
+            stats = self._get(method)
+            stats.bytes_out += size
+            stats.messages_out += 1
+
+    def snapshot(self) -> dict:
+        """按方法汇总的统计"""
+        with self._lock:
+            methods = {
+                name: {
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "cancelled": stats.cancelled,
+                    "in_flight": stats.in_flight,
+                    "latency": stats.latency.summary(),
+                    "queue_wait": stats.queue_wait.summary(),
+                    "bytes_in": stats.bytes_in,
+                    "bytes_out": stats.bytes_out,
+                    "messages_out": stats.messages_out,
+                }
+                for name, stats in self._methods.items()
+            }
+        return {
+            "uptime_s": round(time.monotonic() - self.started_at, 1),
+            "methods": methods,
+        }
+
+    def format_summary(self) -> str:
+        """一行一个方法的摘要（用于定期日志）"""
+        lines = []
+        for name, stats in sorted(self.snapshot()["methods"].items()):
+            if not stats["calls"] and not stats["in_flight"]:
+                # 只有输出的通知（如 chat.stream）
+                lines.append(f"{name}: out={stats['messages_out']} msgs/{stats['bytes_out']}B")
+                continue
+            latency = stats["latency"]
+            lines.append(
+                f"{name}: calls={stats['calls']} errors={stats['errors']} cancelled={stats['cancelled']} "
+                f"in_flight={stats['in_flight']} p50={latency['p50_ms']}ms p95={latency['p95_ms']}ms "
+                f"p99={latency['p99_ms']}ms in={stats['bytes_in']}B out={stats['bytes_out']}B"
+            )
+        return "\n".join(lines)
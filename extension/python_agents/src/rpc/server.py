@@ -1,11 +1,19 @@
 """
 JSON-RPC 服务器核心
-通过 stdin/stdout 与 VS Code 扩展通信
+通过 stdin/stdout 与 VS Code 扩展通信，也可以作为守护进程在 Unix socket 上服务多个客户端
 """
+import os
 import sys
 import json
+import stat
+import time
+import socket
+import asyncio
 import logging
-from typing import Callable, Dict, Any
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, Optional, Deque, Tuple, List
 from .protocol import (
     JSONRPCRequest,
     JSONRPCResponse,
@@ -17,8 +25,16 @@ from .errors import (
     ParseError,
     InvalidRequest,
     MethodNotFound,
-    InternalError
+    InvalidParams,
+    InternalError,
+    RequestCancelled
 )
+from .context import RequestContext, _current_request
+from .transport import TRANSPORTS
+from .codec import decode_json
+from .connection import Connection
+from .spill import SpillStore
+from .metrics import RPCMetrics
 
 
 logger = logging.getLogger(__name__)
@@ -29,6 +45,8 @@ def sanitize_for_json(obj):
     清理对象中的无效 Unicode 字符，确保可以安全地进行 JSON 序列化
     
     处理孤立的代理字符（surrogate），这些字符在 UTF-8 编码中是无效的
+    
+    注意：发送路径已改用 codec.encode_json（单次遍历），此函数保留用于兼容
     """
     if isinstance(obj, str):
         # 使用 'ignore' 错误处理器清理无效字符
@@ -43,58 +61,281 @@ def sanitize_for_json(obj):
         return obj
 
 
+class _BatchCollector:
+    """收集批量请求的响应，全部完成后一次性写出"""
+    
+    def __init__(self, connection: Connection, size: int, metrics: RPCMetrics):
+        self._connection = connection
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._remaining = size
+        self._responses: list = []
+    
+    def add(self, response: Optional[dict]):
+        """记录一个条目的响应（通知为 None）"""
+        with self._lock:
+            if response is not None:
+                self._responses.append(response)
+            self._remaining -= 1
+            complete = self._remaining == 0
+        
+        if complete and self._responses:
+            payload = self._connection.write(self._responses)
+            self._metrics.record_bytes_out("$batch", len(payload))
+            logger.debug(f"Sent batch response ({len(self._responses)} entries): {payload[:100]!r}...")
+
+
 class JSONRPCServer:
-    """JSON-RPC 服务器"""
+    """
+    JSON-RPC 服务器
+    
+    max_workers > 0 时，请求在有界线程池中并发执行，响应按完成顺序写出（通过 id 关联）；
+    同一 conversation_id 的请求仍按到达顺序串行执行。
+    max_workers = 0 时退化为逐条串行处理。
+    
+    framing 指定初始分帧模式（"line" 或 "content-length"），
+    客户端也可以在收到 server.ready 后通过 $/configure 请求切换。
+    
+    use_asyncio=True 时主循环运行在 asyncio 事件循环上：stdin 通过 StreamReader 读取，
+    async def 处理器直接在事件循环上并发执行，同步处理器交给线程池执行。
+    
+    服务器运行期间，所有输出由单独的写线程按顺序写出（见 OutputWriter）：
+    同一会话连续的 chat.stream 片段在 coalesce_window 秒内合并，
+    积压超过 max_pending_bytes 时发送方阻塞等待。
+    
+    run() 通过 stdin/stdout 服务单个客户端；serve_unix() 作为守护进程在 Unix socket 上
+    服务多个客户端。每个客户端是一个独立的 Connection（分帧、输出、请求 id 和会话互不影响），
+    所有客户端共享同一个线程池和已注册的方法。
+    
+    提供 spill_store 时，server.ready 中声明 spillover 能力；客户端通过
+    $/configure {"spillover": true} 开启后，结果中超过阈值的字符串写入临时文件，
+    响应只携带引用（见 SpillStore）。
+    
+    每个方法的调用次数、错误数、延迟分布和收发字节数记录在 metrics 中，
+    通过内置的 server.stats 方法查询；stats_log_interval > 0 时每隔该秒数写入一次日志。
+    """
     
-    def __init__(self):
+    def __init__(
+        self,
+        max_workers: int = 0,
+        framing: str = "line",
+        use_asyncio: bool = False,
+        max_pending_bytes: int = 8 * 1024 * 1024,
+        coalesce_window: float = 0.02,
+        spill_store: Optional[SpillStore] = None,
+        stats_log_interval: float = 0
+    ):
+        if framing not in TRANSPORTS:
+            raise ValueError(f"Unsupported framing: {framing}")
+        
         self.methods: Dict[str, Callable] = {}
+        self.inline_methods: set = set()
         self.running = False
+        self.max_workers = max_workers
+        self.framing = framing
+        self.use_asyncio = use_asyncio
+        self.max_pending_bytes = max_pending_bytes
+        self.coalesce_window = coalesce_window
+        self.spill_store = spill_store
+        self.stats_log_interval = stats_log_interval
+        self._executor: Optional[ThreadPoolExecutor] = None
+        
+        # stdio 连接（首次使用时创建）和所有活动连接
+        self.connection: Optional[Connection] = None
+        self._connections_lock = threading.Lock()
+        self._connections: Dict[int, Connection] = {}
+        self._connect_hooks: List[Callable[[Connection], None]] = []
+        self._disconnect_hooks: List[Callable[[Connection], None]] = []
+        
+        # asyncio 模式下尚未完成的请求任务
+        self._tasks: set = set()
+        
+        # 会话串行化：(连接 id, conversation_id) -> 等待执行的请求队列
+        self._conversation_lock = threading.Lock()
+        self._conversation_queues: Dict[Tuple[int, str], Deque[Tuple[dict, Callable]]] = {}
+        
+        # 已接收但尚未完成的请求：(连接 id, 请求 id) -> 上下文（用于取消）
+        self._requests_lock = threading.Lock()
+        self._requests: Dict[Tuple[int, Any], RequestContext] = {}
+        self._cancel_stats = {
+            "cancelled": 0,
+            "cancelled_before_start": 0,
+            "stop_latency_ms": 0.0,
+            "run_time_before_cancel_ms": 0.0,
+        }
+        
+        # 指标，以及 server.stats 中附带的其他统计来源
+        self.metrics = RPCMetrics()
+        self._stats_sources: Dict[str, Callable[[], Any]] = {}
+        self._stats_stop = threading.Event()
+        
+        # 内置协议方法
+        self.register_method("$/cancelRequest", self._cancel_request, inline=True)
+        self.register_method("$/releaseSpill", self._release_spill, inline=True)
+        self.register_method("server.stats", self._server_stats, inline=True)
     
-    def register_method(self, name: str, handler: Callable):
-        """注册 RPC 方法"""
+    def register_method(self, name: str, handler: Callable, inline: bool = False):
+        """
+        注册 RPC 方法
+        
+        Args:
+            name: 方法名
+            handler: 处理函数，接收 params 字典；可以是 async def 函数
+            inline: 是否在读取线程上直接执行（用于 shutdown 等轻量控制方法）
+        """
+        if inline and asyncio.iscoroutinefunction(handler):
+            raise ValueError(f"Inline method cannot be a coroutine function: {name}")
+        
         self.methods[name] = handler
+        if inline:
+            self.inline_methods.add(name)
         logger.info(f"Registered method: {name}")
     
-    def send_response(self, response: JSONRPCResponse):
+    def on_connect(self, hook: Callable[[Connection], None]):
+        """注册客户端连接建立时的回调（在发送 server.ready 之前调用）"""
+        self._connect_hooks.append(hook)
+    
+    def on_disconnect(self, hook: Callable[[Connection], None]):
+        """注册客户端断开时的回调"""
+        self._disconnect_hooks.append(hook)
+    
+    # ------------------------------------------------------------------
+    # 连接与输出
+    # ------------------------------------------------------------------
+    
+    def _get_connection(self) -> Connection:
+        """获取 stdio 连接，首次使用时基于 stdin/stdout 的二进制流创建"""
+        if self.connection is None:
+            self.connection = Connection(
+                getattr(sys.stdin, 'buffer', None),
+                sys.stdout.buffer,
+                framing=self.framing,
+                max_pending_bytes=self.max_pending_bytes,
+                coalesce_window=self.coalesce_window
+            )
+        return self.connection
+    
+    def _target(self, connection: Optional[Connection] = None) -> Connection:
+        """确定消息的目标连接：显式指定 > 当前请求的连接 > stdio 连接"""
+        if connection is not None:
+            return connection
+        context = _current_request.get()
+        if context is not None and context.connection is not None:
+            return context.connection
+        return self._get_connection()
+    
+    def _write(self, data: Any, connection: Optional[Connection] = None) -> bytes:
+        """序列化并写出一条消息（线程安全）"""
+        return self._target(connection).write(data)
+    
+    def get_output_stats(self) -> dict:
+        """获取 stdio 连接写线程的统计（未启动时为空）"""
+        connection = self.connection
+        return connection.get_output_stats() if connection is not None else {}
+    
+    def get_connections(self) -> List[Connection]:
+        """获取所有活动连接"""
+        with self._connections_lock:
+            return list(self._connections.values())
+    
+    def send_response(self, response: JSONRPCResponse, connection: Optional[Connection] = None):
         """发送响应到 stdout"""
-        data = response.to_dict()
-        # 清理无效的 Unicode 字符
-        data = sanitize_for_json(data)
-        json_str = json.dumps(data, ensure_ascii=False)
-        sys.stdout.write(json_str + '\n')
-        sys.stdout.flush()
-        logger.debug(f"Sent response: {json_str[:100]}...")
-    
-    def send_error(self, error: JSONRPCError, request_id: int = None):
+        payload = self._write(response.to_dict(), connection)
+        logger.debug(f"Sent response: {payload[:100]!r}...")
+    
+    def send_error(self, error: JSONRPCError, request_id: int = None, connection: Optional[Connection] = None):
         """发送错误响应"""
         response = JSONRPCErrorResponse(
             jsonrpc="2.0",
             error=error.to_dict(),
             id=request_id
         )
-        data = response.to_dict()
-        # 清理无效的 Unicode 字符
-        data = sanitize_for_json(data)
-        json_str = json.dumps(data, ensure_ascii=False)
-        sys.stdout.write(json_str + '\n')
-        sys.stdout.flush()
+        self._write(response.to_dict(), connection)
         logger.error(f"Sent error: {error.message}")
     
-    def send_notification(self, method: str, params: Dict[str, Any]):
-        """发送通知（无需响应）"""
+    def send_notification(self, method: str, params: Dict[str, Any], connection: Optional[Connection] = None):
+        """
+        发送通知（无需响应）
+        
+        未指定 connection 时发往当前请求所属的客户端（在请求外调用时发往 stdio）
+        """
         notification = JSONRPCNotification(
             jsonrpc="2.0",
             method=method,
             params=params
         )
-        data = notification.to_dict()
-        # 清理无效的 Unicode 字符
-        data = sanitize_for_json(data)
-        json_str = json.dumps(data, ensure_ascii=False)
-        sys.stdout.write(json_str + '\n')
-        sys.stdout.flush()
+        payload = self._write(notification.to_dict(), connection)
+        self.metrics.record_bytes_out(method, len(payload))
         logger.debug(f"Sent notification: {method}")
     
+    # ------------------------------------------------------------------
+    # 统计
+    # ------------------------------------------------------------------
+    
+    def add_stats_source(self, name: str, source: Callable[[], Any]):
+        """注册 server.stats 中附带的统计（如 LLM 调用、缓存），source 返回可序列化的值"""
+        self._stats_sources[name] = source
+    
+    def get_stats(self, connection: Optional[Connection] = None) -> dict:
+        """汇总指标、输出、取消和溢出统计"""
+        stats = self.metrics.snapshot()
+        stats["connections"] = len(self.get_connections())
+        stats["output"] = self._target(connection).get_output_stats()
+        stats["cancellation"] = self.get_cancellation_stats()
+        if self.spill_store is not None:
+            stats["spill"] = self.spill_store.get_stats()
+        
+        for name, source in self._stats_sources.items():
+            try:
+                stats[name] = source()
+            except Exception as e:
+                logger.warning(f"Stats source {name} failed: {e}")
+                stats[name] = {"error": str(e)}
+        return stats
+    
+    def _server_stats(self, params: dict) -> dict:
+        """处理 server.stats 请求"""
+        return self.get_stats()
+    
+    def _metric_name(self, method: str) -> str:
+        """指标中使用的方法名（未注册的方法合并统计，避免任意方法名撑大指标表）"""
+        return method if method in self.methods else "$unknown"
+    
+    def _record(self, context: RequestContext, response: Optional[dict]):
+        """记录请求结束"""
+        duration = None if context.started_at is None else time.monotonic() - context.started_at
+        self.metrics.request_finished(
+            self._metric_name(context.method),
+            duration,
+            error=response is not None and "error" in response,
+            cancelled=context.token.cancelled
+        )
+    
+    def _responder(self, connection: Connection, method: str) -> Callable[[Optional[dict]], None]:
+        """写出响应并记录其大小"""
+        def done(response: Optional[dict]):
+            payload = connection.send_result(response)
+            if payload is not None:
+                self.metrics.record_bytes_out(method, len(payload))
+        return done
+    
+    def _log_stats_periodically(self):
+        """定期把指标摘要写入日志，直到服务器停止"""
+        while not self._stats_stop.wait(self.stats_log_interval):
+            summary = self.metrics.format_summary()
+            if summary:
+                logger.info(f"RPC stats:\n{summary}")
+    
+    def _start_stats_logger(self):
+        """stats_log_interval > 0 时启动定期日志线程"""
+        self._stats_stop.clear()
+        if self.stats_log_interval > 0:
+            threading.Thread(target=self._log_stats_periodically, name="rpc-stats", daemon=True).start()
+    
+    # ------------------------------------------------------------------
+    # 请求处理
+    # ------------------------------------------------------------------
+    
     def handle_request(self, request: JSONRPCRequest) -> Any:
         """处理请求"""
         method_name = request.method
@@ -108,6 +349,9 @@ class JSONRPCServer:
         # 调用处理器
         try:
             result = handler(request.params)
+            if asyncio.iscoroutine(result):
+                # 线程模式下的 async 处理器：在当前 worker 线程上运行独立的事件循环
+                result = asyncio.run(result)
             return result
         except JSONRPCError:
             raise
@@ -115,64 +359,608 @@ class JSONRPCServer:
             logger.exception(f"Error in handler {method_name}")
             raise InternalError(str(e), {"traceback": str(e)})
     
-    def process_message(self, line: str):
-        """处理单条消息"""
-        request_id = None
+    async def handle_request_async(self, request: JSONRPCRequest) -> Any:
+        """处理请求（async 处理器，在事件循环上执行）"""
+        method_name = request.method
+        
+        if method_name not in self.methods:
+            raise MethodNotFound(method_name)
+        
+        handler = self.methods[method_name]
         
         try:
-            # 解析 JSON
-            try:
-                data = json.loads(line)
-            except json.JSONDecodeError as e:
-                raise ParseError(f"Invalid JSON: {str(e)}")
-            
-            # 验证请求格式
-            if not isinstance(data, dict):
-                raise InvalidRequest("Request must be an object")
+            return await handler(request.params)
+        except JSONRPCError:
+            raise
+        except Exception as e:
+            logger.exception(f"Error in handler {method_name}")
+            raise InternalError(str(e), {"traceback": str(e)})
+    
+    def _decode(self, message) -> Any:
+        """解析 JSON 消息（文本或 UTF-8 字节）"""
+        try:
+            # 直接从字节解码，不经过文本层的逐行读取
+            return decode_json(message)
+        except UnicodeDecodeError as e:
+            raise ParseError(f"Invalid UTF-8: {str(e)}")
+        except json.JSONDecodeError as e:
+            raise ParseError(f"Invalid JSON: {str(e)}")
+    
+    def _validate(self, data: Any) -> dict:
+        """校验单个请求对象"""
+        if not isinstance(data, dict):
+            raise InvalidRequest("Request must be an object")
+        
+        if "jsonrpc" not in data or data["jsonrpc"] != "2.0":
+            raise InvalidRequest("Invalid jsonrpc version")
+        
+        if "method" not in data:
+            raise InvalidRequest("Missing method field")
+        
+        return data
+    
+    def _error_dict(self, error: JSONRPCError, request_id: Any = None) -> dict:
+        """构造错误响应字典"""
+        logger.error(f"Sent error: {error.message}")
+        return JSONRPCErrorResponse(
+            jsonrpc="2.0",
+            error=error.to_dict(),
+            id=request_id
+        ).to_dict()
+    
+    def _track(self, connection: Connection, data: dict) -> Optional[RequestContext]:
+        """登记带 id 的请求，使其在排队和执行期间都可以被取消"""
+        request_id = data.get("id")
+        if request_id is None:
+            return None
+        context = RequestContext(id=request_id, method=data["method"], connection=connection)
+        with self._requests_lock:
+            self._requests[(connection.id, request_id)] = context
+        return context
+    
+    def _untrack(self, context: RequestContext):
+        """请求完成后注销，并记录取消统计"""
+        key = (context.connection.id, context.id)
+        with self._requests_lock:
+            if self._requests.get(key) is context:
+                del self._requests[key]
             
-            if "jsonrpc" not in data or data["jsonrpc"] != "2.0":
-                raise InvalidRequest("Invalid jsonrpc version")
+            if not context.token.cancelled:
+                return
             
-            if "method" not in data:
-                raise InvalidRequest("Missing method field")
+            stats = self._cancel_stats
+            stats["cancelled"] += 1
+            if context.started_at is None:
+                # 尚未开始执行就被取消，整个处理时间都被节省下来
+                stats["cancelled_before_start"] += 1
+            else:
+                cancelled_at = max(context.token.cancelled_at, context.started_at)
+                stats["stop_latency_ms"] += (time.monotonic() - cancelled_at) * 1000
+                stats["run_time_before_cancel_ms"] += (cancelled_at - context.started_at) * 1000
+    
+    def _cancel_request(self, params: dict):
+        """处理 $/cancelRequest 通知（只能取消同一连接发出的请求）"""
+        request_id = params.get("id")
+        connection = self._target()
+        with self._requests_lock:
+            context = self._requests.get((connection.id, request_id))
+        
+        if context is None:
+            # 请求已完成或不存在，忽略
+            logger.debug(f"Cancel ignored, request not in flight: {request_id}")
+            return None
+        
+        context.token.cancel()
+        logger.info(f"Cancelling request {request_id} ({context.method})")
+        return None
+    
+    def _cancel_connection_requests(self, connection: Connection):
+        """取消某个连接所有未完成的请求（客户端断开时）"""
+        with self._requests_lock:
+            contexts = [c for (cid, _), c in self._requests.items() if cid == connection.id]
+        for context in contexts:
+            context.token.cancel()
+        if contexts:
+            logger.info(f"Cancelled {len(contexts)} request(s) of disconnected client {connection.id}")
+    
+    def get_cancellation_stats(self) -> dict:
+        """获取取消统计"""
+        with self._requests_lock:
+            stats = dict(self._cancel_stats)
+        
+        stopped = stats["cancelled"] - stats["cancelled_before_start"]
+        stats["avg_stop_latency_ms"] = round(stats["stop_latency_ms"] / stopped, 2) if stopped else 0.0
+        return stats
+    
+    def _begin(self, connection: Connection, data: dict) -> Tuple[JSONRPCRequest, RequestContext]:
+        """创建请求对象并获取上下文"""
+        request = JSONRPCRequest.from_dict(data)
+        
+        # 获取（或登记）请求上下文；通知也有上下文，但不可取消
+        context = None
+        if request.id is not None:
+            with self._requests_lock:
+                context = self._requests.get((connection.id, request.id))
+            if context is None:
+                context = self._track(connection, data)
+        else:
+            context = RequestContext(id=None, method=request.method, connection=connection)
+        return request, context
+    
+    def _spill(self, connection: Connection, result: Any) -> Any:
+        """连接开启了 spillover 时，把结果中的大字符串写入临时文件（在 worker 线程上执行）"""
+        if self.spill_store is None or not connection.spillover:
+            return result
+        return self.spill_store.spill(result, owner=connection.id)
+    
+    def _release_spill(self, params: dict):
+        """处理 $/releaseSpill 通知：客户端读取完毕后删除溢出文件"""
+        if self.spill_store is not None and params.get("path"):
+            self.spill_store.release(params["path"])
+        return None
+    
+    def _result_dict(self, request: JSONRPCRequest, result: Any) -> Optional[dict]:
+        """构造成功响应字典（通知不需要响应，返回 None）"""
+        if request.is_notification():
+            return None
+        return JSONRPCResponse(
+            jsonrpc="2.0",
+            result=result,
+            id=request.id
+        ).to_dict()
+    
+    def _failure_dict(self, error: Exception, context: Optional[RequestContext], request_id: Any) -> dict:
+        """构造失败响应字典"""
+        # 被取消的请求统一返回 RequestCancelled，无论处理器以何种方式退出
+        if context is not None and context.token.cancelled:
+            return self._error_dict(RequestCancelled(), request_id)
+        if isinstance(error, JSONRPCError):
+            return self._error_dict(error, request_id)
+        logger.error("Unexpected error", exc_info=error)
+        return self._error_dict(InternalError(str(error)), request_id)
+    
+    def _execute(self, connection: Connection, data: dict) -> Optional[dict]:
+        """执行已校验的请求，返回响应字典（通知成功时返回 None）"""
+        context = None
+        response = None
+        
+        try:
+            request, context = self._begin(connection, data)
             
-            # 创建请求对象
-            request = JSONRPCRequest.from_dict(data)
-            request_id = request.id
+            # 排队期间已被取消
+            context.token.check()
+            self._start(context)
             
             # 处理请求
-            result = self.handle_request(request)
+            token = _current_request.set(context)
+            try:
+                result = self.handle_request(request)
+            finally:
+                _current_request.reset(token)
             
-            # 发送响应（如果不是通知）
-            if not request.is_notification():
-                response = JSONRPCResponse(
-                    jsonrpc="2.0",
-                    result=result,
-                    id=request.id
-                )
-                self.send_response(response)
+            response = self._result_dict(request, self._spill(connection, result))
+            return response
         
+        except Exception as e:
+            response = self._failure_dict(e, context, data.get("id"))
+            return response
+        finally:
+            if context is not None:
+                self._record(context, response)
+                if context.id is not None:
+                    self._untrack(context)
+    
+    def _start(self, context: RequestContext):
+        """标记请求开始执行"""
+        context.started_at = time.monotonic()
+        self.metrics.request_started(self._metric_name(context.method), context.started_at - context.received_at)
+    
+    def _send_result(self, response: Optional[dict]):
+        """写出单个请求的响应（发往 stdio 连接）"""
+        self._get_connection().send_result(response)
+    
+    def process_message(self, line, connection: Optional[Connection] = None):
+        """处理一条消息（单个请求或批量请求），全部在当前线程同步执行"""
+        self._handle_line(connection or self._get_connection(), line, self._run_inline)
+    
+    def dispatch_message(self, line, connection: Optional[Connection] = None):
+        """
+        分派一条消息
+        
+        解析在读取线程上完成；请求本身提交到线程池执行，
+        未启用线程池或方法标记为 inline 时直接执行。
+        """
+        self._handle_line(connection or self._get_connection(), line, self._run_request)
+    
+    def _handle_line(self, connection: Connection, line, run: Callable):
+        """
+        解析一条输入消息，按单个请求或批量请求处理
+        
+        Args:
+            connection: 消息来自的连接，响应写回该连接
+            line: 消息文本或字节
+            run: 执行策略，run(connection, data, done) 执行请求并把响应交给 done
+        """
+        try:
+            data = self._decode(line)
         except JSONRPCError as e:
-            self.send_error(e, request_id)
+            connection.send_result(self._error_dict(e))
+            return
+        
+        if isinstance(data, list):
+            self.metrics.record_bytes_in("$batch", len(line))
+            self._handle_batch(connection, data, run)
+            return
+        
+        try:
+            data = self._validate(data)
+        except JSONRPCError as e:
+            connection.send_result(self._error_dict(e))
+            return
+        
+        if data["method"] == "$/configure":
+            self._configure(connection, data)
+            return
+        
+        method = self._metric_name(data["method"])
+        self.metrics.record_bytes_in(method, len(line))
+        run(connection, data, self._responder(connection, method))
+    
+    def _configure(self, connection: Connection, data: dict):
+        """
+        处理 $/configure 请求（协商传输选项）
+        
+        支持的参数:
+            framing: "line" | "content-length"
+            spillover: bool - 大结果写入临时文件，响应中只携带引用（服务器需启用 spill_store）
+            clientId: str - 客户端的稳定标识（如工作区或会话 id），保存在 connection.client_id
+        
+        响应以当前分帧写出，随后立即切换，
+        保证客户端收到响应后的所有消息都使用新的分帧。
+        """
+        request_id = data.get("id")
+        params = data.get("params") or {}
+        framing = params.get("framing", connection.framing)
+        
+        if framing not in TRANSPORTS:
+            error = InvalidParams(f"Unsupported framing: {framing}", {"supported": list(TRANSPORTS)})
+            connection.send_result(self._error_dict(error, request_id))
+            return
+        
+        client_id = params.get("clientId", connection.client_id)
+        if client_id is not None and (not isinstance(client_id, str) or not client_id):
+            error = InvalidParams("clientId must be a non-empty string")
+            connection.send_result(self._error_dict(error, request_id))
+            return
+        
+        result = {"framing": framing}
+        if "clientId" in params:
+            connection.client_id = client_id
+            result["clientId"] = client_id
+        if "spillover" in params:
+            # 服务器未启用溢出时返回 false，客户端继续按内联结果处理
+            connection.spillover = bool(params["spillover"]) and self.spill_store is not None
+            result["spillover"] = connection.spillover
+        
+        response = None
+        if request_id is not None:
+            response = JSONRPCResponse(
+                jsonrpc="2.0",
+                result=result,
+                id=request_id
+            ).to_dict()
+        connection.switch_framing(framing, response)
+    
+    def _handle_batch(self, connection: Connection, batch: list, run: Callable):
+        """
+        处理批量请求
+        
+        各条目独立执行（启用线程池时并发），所有响应收集完毕后合并为一行写出。
+        按 JSON-RPC 2.0 规范，通知不产生响应；全部是通知时不写出任何内容。
+        $/configure 会切换分帧，不能和其他请求一起批量发送，返回 InvalidRequest。
+        """
+        if not batch:
+            connection.send_result(self._error_dict(InvalidRequest("Empty batch")))
+            return
+        
+        collector = _BatchCollector(connection, len(batch), self.metrics)
+        for item in batch:
+            try:
+                item = self._validate(item)
+            except JSONRPCError as e:
+                collector.add(self._error_dict(e))
+                continue
+            
+            if item["method"] == "$/configure":
+                error = InvalidRequest("$/configure must be sent as a single message, not in a batch")
+                collector.add(self._error_dict(error, item.get("id")) if item.get("id") is not None else None)
+                continue
+            
+            if item.get("id") is None:
+                # 通知：执行但丢弃响应
+                run(connection, item, lambda response: collector.add(None))
+            else:
+                run(connection, item, collector.add)
+    
+    def _run_inline(self, connection: Connection, data: dict, done: Callable[[Optional[dict]], None]):
+        """在当前线程执行请求"""
+        done(self._execute(connection, data))
+    
+    def _run_request(self, connection: Connection, data: dict, done: Callable[[Optional[dict]], None]):
+        """在线程池中执行请求（未启用线程池或 inline 方法直接执行）"""
+        if self._executor is None or data["method"] in self.inline_methods:
+            done(self._execute(connection, data))
+            return
+        
+        # 先登记再排队，排队中的请求也能被取消
+        self._track(connection, data)
+        self._submit(connection, data, done)
+    
+    def _conversation_key(self, connection: Connection, data: dict) -> Optional[Tuple[int, str]]:
+        """提取用于串行化的会话 ID（支持 camelCase 和 snake_case），不同连接的会话互不影响"""
+        params = data.get("params")
+        if not isinstance(params, dict):
+            return None
+        key = params.get("conversationId") or params.get("conversation_id")
+        return (connection.id, str(key)) if key else None
+    
+    def _enqueue(self, key: Tuple[int, str], data: dict, done: Callable[[Optional[dict]], None]) -> bool:
+        """
+        把请求放入会话队列
+        
+        Returns:
+            该会话当前没有请求在执行时返回 True，调用方需要立即开始执行
+        """
+        with self._conversation_lock:
+            queue = self._conversation_queues.get(key)
+            if queue is not None:
+                # 该会话已有请求在执行，排队等待
+                queue.append((data, done))
+                return False
+            self._conversation_queues[key] = deque()
+            return True
+    
+    def _dequeue(self, key: Tuple[int, str]) -> Optional[Tuple[dict, Callable]]:
+        """取出会话队列中的下一个请求，队列为空时移除该会话并返回 None"""
+        with self._conversation_lock:
+            queue = self._conversation_queues[key]
+            if not queue:
+                del self._conversation_queues[key]
+                return None
+            return queue.popleft()
+    
+    def _submit(self, connection: Connection, data: dict, done: Callable[[Optional[dict]], None]):
+        """提交请求到线程池，同一会话的请求排队串行执行"""
+        key = self._conversation_key(connection, data)
+        if key is None:
+            self._executor.submit(self._execute_and_report, connection, data, done)
+            return
+        
+        if self._enqueue(key, data, done):
+            self._executor.submit(self._execute_serialized, connection, key, data, done)
+    
+    def _execute_and_report(self, connection: Connection, data: dict, done: Callable[[Optional[dict]], None]):
+        """在 worker 线程中执行请求并回调"""
+        try:
+            done(self._execute(connection, data))
+        except Exception:
+            logger.exception("Failed to deliver response")
+    
+    def _execute_serialized(self, connection: Connection, key: Tuple[int, str], data: dict,
+                            done: Callable[[Optional[dict]], None]):
+        """依次执行同一会话的请求，直到队列为空"""
+        while True:
+            self._execute_and_report(connection, data, done)
+            item = self._dequeue(key)
+            if item is None:
+                return
+            data, done = item
+    
+    # ------------------------------------------------------------------
+    # asyncio 模式
+    # ------------------------------------------------------------------
+    
+    def _run_request_async(self, connection: Connection, data: dict, done: Callable[[Optional[dict]], None]):
+        """在事件循环上为请求创建任务（inline 方法直接执行）"""
+        if data["method"] in self.inline_methods:
+            done(self._execute(connection, data))
+            return
+        
+        # 先登记再排队，排队中的请求也能被取消
+        self._track(connection, data)
+        
+        key = self._conversation_key(connection, data)
+        if key is None:
+            self._spawn(self._aexecute_and_report(connection, data, done))
+        elif self._enqueue(key, data, done):
+            self._spawn(self._aexecute_serialized(connection, key, data, done))
+    
+    def _spawn(self, coro):
+        """创建请求任务并保留引用，直到任务完成"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _aexecute_and_report(self, connection: Connection, data: dict,
+                                   done: Callable[[Optional[dict]], None]):
+        """执行请求并回调"""
+        try:
+            done(await self._aexecute(connection, data))
+        except Exception:
+            logger.exception("Failed to deliver response")
+    
+    async def _aexecute_serialized(self, connection: Connection, key: Tuple[int, str], data: dict,
+                                   done: Callable[[Optional[dict]], None]):
+        """依次执行同一会话的请求，直到队列为空"""
+        while True:
+            await self._aexecute_and_report(connection, data, done)
+            item = self._dequeue(key)
+            if item is None:
+                return
+            data, done = item
+    
+    async def _aexecute(self, connection: Connection, data: dict) -> Optional[dict]:
+        """
+        在事件循环上执行已校验的请求
+        
+        同步处理器交给线程池（与线程模式行为一致）；
+        async 处理器在独立的任务中运行，$/cancelRequest 会直接取消该任务。
+        """
+        handler = self.methods.get(data["method"])
+        if not asyncio.iscoroutinefunction(handler):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._execute, connection, data)
+        
+        context = None
+        response = None
+        try:
+            request, context = self._begin(connection, data)
+            
+            # 排队期间已被取消
+            context.token.check()
+            self._start(context)
+            
+            # 任务创建时复制当前 contextvars，处理器中可以通过 get_current_request 取得上下文
+            token = _current_request.set(context)
+            try:
+                task = asyncio.ensure_future(self.handle_request_async(request))
+            finally:
+                _current_request.reset(token)
+            
+            loop = asyncio.get_running_loop()
+            context.token.add_callback(lambda: loop.call_soon_threadsafe(task.cancel))
+            result = await task
+            
+            response = self._result_dict(request, self._spill(connection, result))
+            return response
+        
+        except asyncio.CancelledError:
+            if context is not None and context.token.cancelled:
+                response = self._error_dict(RequestCancelled(), data.get("id"))
+                return response
+            raise
         except Exception as e:
-            logger.exception("Unexpected error")
-            self.send_error(InternalError(str(e)), request_id)
+            response = self._failure_dict(e, context, data.get("id"))
+            return response
+        finally:
+            if context is not None:
+                self._record(context, response)
+                if context.id is not None:
+                    self._untrack(context)
     
-    def run(self):
-        """启动服务器主循环"""
+    async def _open_reader(self, connection: Connection) -> Tuple[Callable, Optional[asyncio.BaseTransport]]:
+        """
+        创建异步读取函数
+        
+        优先把 stdin 接入事件循环（StreamReader）；stdin 不是管道/终端
+        （如重定向自普通文件、内存流、Windows 控制台）时，回退为在线程中阻塞读取。
+        
+        Returns:
+            (读取函数, 需要在退出时关闭的管道传输或 None)
+        """
+        loop = asyncio.get_running_loop()
+        stdin = getattr(sys.stdin, 'buffer', None)
+        
+        try:
+            mode = os.fstat(stdin.fileno()).st_mode
+            if not (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or stat.S_ISCHR(mode)):
+                raise ValueError("not a pipe, socket or character device")
+            # 单条消息可能很大（附带整个文件内容），放宽 readline 的长度限制
+            stream = asyncio.StreamReader(limit=64 * 1024 * 1024)
+            pipe, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stream), stdin)
+        except (NotImplementedError, ValueError, OSError, AttributeError) as e:
+            logger.info(f"stdin is not pollable ({e}), reading in a background thread")
+            return lambda: loop.run_in_executor(None, connection.transport.read_message), None
+        
+        # 每次读取都使用当前传输（$/configure 可能切换分帧）
+        return lambda: connection.transport.aread_message(stream), pipe
+    
+    async def serve_async(self):
+        """在当前事件循环上运行服务器主循环"""
         self.running = True
-        logger.info("JSON-RPC server starting...")
         
-        # 发送就绪通知
+        # 同步处理器仍需要线程池
+        self._start_executor(max(1, self.max_workers))
+        
+        connection = self._get_connection()
+        self._open_connection(connection)
+        read_message, pipe = await self._open_reader(connection)
+        logger.info("Server ready (asyncio), waiting for requests on stdin...")
+        
+        try:
+            while self.running:
+                try:
+                    message = await read_message()
+                    
+                    # 返回 None 说明 stdin 关闭
+                    if message is None:
+                        logger.info("stdin closed, shutting down...")
+                        break
+                    
+                    logger.debug(f"Received message ({len(message)} bytes)")
+                    self._handle_line(connection, message, self._run_request_async)
+                
+                except JSONRPCError as e:
+                    # 分帧错误（如缺少 Content-Length）
+                    connection.send_result(self._error_dict(e))
+        finally:
+            # 等待已接收的请求全部完成（客户端可通过 $/cancelRequest 提前结束）
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            if pipe is not None:
+                pipe.close()
+            self._shutdown_executor()
+            self._close_connection(connection)
+    
+    # ------------------------------------------------------------------
+    # 主循环
+    # ------------------------------------------------------------------
+    
+    def _open_connection(self, connection: Connection, **ready_params):
+        """登记连接、启动写线程、调用连接回调并发送就绪通知"""
+        connection.start_writer()
+        with self._connections_lock:
+            self._connections[connection.id] = connection
+        
+        for hook in self._connect_hooks:
+            try:
+                hook(connection)
+            except Exception:
+                logger.exception("Connect hook failed")
+        
         self.send_notification("server.ready", {
             "version": "1.0.0",
-            "capabilities": list(self.methods.keys())
-        })
+            "capabilities": list(self.methods.keys()),
+            "framing": {
+                "current": connection.framing,
+                "supported": list(TRANSPORTS)
+            },
+            # 可选能力：客户端通过 $/configure 开启
+            "spillover": {"threshold": self.spill_store.threshold} if self.spill_store is not None else None,
+            **ready_params
+        }, connection)
+    
+    def _close_connection(self, connection: Connection):
+        """注销连接、调用断开回调，并写出剩余消息"""
+        with self._connections_lock:
+            self._connections.pop(connection.id, None)
         
-        logger.info("Server ready, waiting for requests on stdin...")
+        for hook in self._disconnect_hooks:
+            try:
+                hook(connection)
+            except Exception:
+                logger.exception("Disconnect hook failed")
         
-        # 确保 stdin 是阻塞模式
-        import os
+        connection.close()
+        if self.spill_store is not None:
+            # 客户端已断开，未释放的溢出文件不会再被读取
+            self.spill_store.release_owner(connection.id)
+        if connection is self.connection:
+            # 下次使用 stdio 时重新创建
+            self.connection = None
+    
+    def _ensure_blocking_stdin(self):
+        """确保 stdin 是阻塞模式"""
         if hasattr(sys.stdin, 'fileno'):
             try:
                 # 设置为阻塞模式
@@ -183,32 +971,75 @@ class JSONRPCServer:
                     logger.info("Set stdin to blocking mode")
             except Exception as e:
                 logger.warning(f"Could not set stdin blocking mode: {e}")
-        
-        try:
-            # 从 stdin 逐行读取
-            while self.running:
-                try:
-                    # 使用阻塞读取
-                    line = sys.stdin.readline()
-                    
-                    # 如果读到空字符串且不是空行，说明 stdin 关闭
-                    if line == '':
-                        logger.info("stdin closed (empty string), shutting down...")
-                        break
-                    
-                    line = line.strip()
-                    if not line:
-                        # 空行，继续读取
-                        continue
-                    
-                    logger.debug(f"Received: {line[:100]}...")
-                    self.process_message(line)
+    
+    def _start_executor(self, max_workers: int):
+        """启动请求线程池"""
+        if self._executor is None and max_workers > 0:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix="rpc-worker"
+            )
+            logger.info(f"Concurrent dispatch enabled ({max_workers} workers)")
+    
+    def _shutdown_executor(self):
+        """等待线程池中已接收的请求完成并关闭线程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+    
+    def _read_loop(self, connection: Connection):
+        """从连接逐条读取并分派消息，直到输入关闭（$/configure 可能在循环中切换传输）"""
+        while self.running:
+            try:
+                # 使用阻塞读取
+                message = connection.transport.read_message()
                 
-                except EOFError:
-                    logger.info("EOF on stdin, shutting down...")
+                # 返回 None 说明输入关闭
+                if message is None:
+                    logger.info(f"Input of connection {connection.id} closed")
                     break
-                except KeyboardInterrupt:
-                    raise
+                
+                logger.debug(f"Received message ({len(message)} bytes)")
+                self.dispatch_message(message, connection)
+            
+            except JSONRPCError as e:
+                # 分帧错误（如缺少 Content-Length）
+                connection.send_result(self._error_dict(e))
+            except EOFError:
+                logger.info(f"EOF on connection {connection.id}")
+                break
+            except (ConnectionError, ValueError) as e:
+                # socket 被重置或已关闭（ValueError: 读取已关闭的文件）
+                logger.info(f"Connection {connection.id} lost: {e}")
+                break
+    
+    def _serve(self):
+        """线程模式的主循环：在当前线程阻塞读取 stdin，请求分派到线程池"""
+        self._start_executor(self.max_workers)
+        
+        connection = self._get_connection()
+        self._open_connection(connection)
+        logger.info("Server ready, waiting for requests on stdin...")
+        
+        self._ensure_blocking_stdin()
+        try:
+            self._read_loop(connection)
+        finally:
+            # 等待已接收的请求全部完成（客户端可通过 $/cancelRequest 提前结束）
+            self._shutdown_executor()
+            self._close_connection(connection)
+    
+    def run(self):
+        """启动服务器主循环"""
+        self.running = True
+        logger.info("JSON-RPC server starting...")
+        self._start_stats_logger()
+        
+        try:
+            if self.use_asyncio:
+                asyncio.run(self.serve_async())
+            else:
+                self._serve()
         
         except KeyboardInterrupt:
             logger.info("Server interrupted by user")
@@ -216,9 +1047,108 @@ class JSONRPCServer:
             logger.exception("Server error")
         finally:
             self.running = False
+            self._stats_stop.set()
+            self._shutdown_executor()
             logger.info("Server stopped")
     
+    # ------------------------------------------------------------------
+    # 守护进程模式
+    # ------------------------------------------------------------------
+    
+    def _bind_unix_socket(self, path: str) -> socket.socket:
+        """绑定 Unix socket；已有守护进程在监听时报错，清理残留的 socket 文件"""
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                # 上次异常退出残留的 socket 文件
+                os.unlink(path)
+            else:
+                raise RuntimeError(f"Another agent daemon is already listening on {path}")
+            finally:
+                probe.close()
+        
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        # 只允许当前用户连接
+        os.chmod(path, 0o600)
+        listener.listen()
+        return listener
+    
+    def _serve_client(self, sock: socket.socket):
+        """服务一个 socket 客户端，直到其断开"""
+        connection = Connection(
+            sock.makefile("rb"),
+            sock.makefile("wb"),
+            framing=self.framing,
+            sock=sock,
+            max_pending_bytes=self.max_pending_bytes,
+            coalesce_window=self.coalesce_window
+        )
+        logger.info(f"Client {connection.id} connected")
+        
+        try:
+            self._open_connection(connection, clientId=connection.id, mode="daemon")
+            self._read_loop(connection)
+        except Exception:
+            logger.exception(f"Error serving client {connection.id}")
+        finally:
+            # 客户端已断开，停止它未完成的请求
+            self._cancel_connection_requests(connection)
+            self._close_connection(connection)
+            logger.info(f"Client {connection.id} disconnected ({len(self._connections)} active)")
+    
+    def serve_unix(self, path: str, poll_interval: float = 0.5):
+        """
+        作为守护进程在 Unix socket 上服务多个客户端
+        
+        每个客户端一个读取线程，请求在共享的线程池中执行。
+        stop() 后不再接受新连接，并断开现有客户端。
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            raise RuntimeError("Unix domain sockets are not supported on this platform")
+        
+        self.running = True
+        self._start_executor(max(1, self.max_workers))
+        listener = self._bind_unix_socket(path)
+        # 定期醒来检查 running，使 stop() 能结束 accept 循环
+        listener.settimeout(poll_interval)
+        logger.info(f"Agent daemon listening on {path}")
+        self._start_stats_logger()
+        
+        clients: List[threading.Thread] = []
+        try:
+            while self.running:
+                try:
+                    sock, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                
+                sock.settimeout(None)
+                thread = threading.Thread(target=self._serve_client, args=(sock,), name="rpc-client", daemon=True)
+                thread.start()
+                clients = [t for t in clients if t.is_alive()] + [thread]
+        
+        except KeyboardInterrupt:
+            logger.info("Daemon interrupted by user")
+        finally:
+            self.running = False
+            self._stats_stop.set()
+            listener.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            
+            for connection in self.get_connections():
+                connection.disconnect()
+            for thread in clients:
+                thread.join(timeout=5)
+            self._shutdown_executor()
+            logger.info("Agent daemon stopped")
+    
     def stop(self):
         """停止服务器"""
         self.running = False
-
@@ -0,0 +1,205 @@
+"""
+大结果溢出到临时文件
+响应中超过阈值的字符串（如 chat 的 full_response、refactor_code 的 diff）写入缓存目录，
+JSON 中只保留引用、大小和哈希，扩展通过 mmap 直接读取文件，不必在单线程上解析数 MB 的一行 JSON。
+
+引用格式:
+    {"$spill": {"path": "...", "size": 1234567, "sha256": "...", "encoding": "utf-8"}}
+
+文件的生命周期:
+- 客户端读取后发送 $/releaseSpill 通知删除文件
+- 客户端断开时删除该连接尚未释放的文件
+- 超过 max_age 秒的文件在后续溢出时被清理（包括之前异常退出的进程遗留的文件）
+"""
+import os
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SPILL_SUFFIX = ".spill"
+
+
+class SpillStore:
+    """
+    溢出文件存储
+
+    Args:
+        directory: 溢出文件所在目录（不存在时自动创建）
+        threshold: 字符串编码后超过该字节数时溢出
+        max_age: 未释放文件的最长保留时间（秒）
+    """
+
+    def __init__(self, directory: str, threshold: int = 256 * 1024, max_age: float = 600.0):
+        self.directory = Path(directory).resolve()
+        self.threshold = threshold
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        # 连接 id -> 该连接尚未释放的文件
+        self._owners: Dict[Any, Set[Path]] = {}
+        self._last_cleanup = 0.0
+        self._stats = {
+            "spilled": 0,
+            "spilled_bytes": 0,
+            "released": 0,
+            "expired": 0,
+        }
+
+    def spill(self, value: Any, owner: Any = None) -> Any:
+        """
+        把 value 中超过阈值的字符串写入文件并替换为引用
+
+        只复制被替换的字符串所在的容器，其余部分原样返回。
+
+        Args:
+            value: 处理器返回的结果
+            owner: 文件所属的连接 id（连接关闭时一并清理）
+        """
+        self._maybe_cleanup()
+        return self._walk(value, owner)
+
+    def _walk(self, value: Any, owner: Any) -> Any:
+        if isinstance(value, str):
+            # 按字符数预判，避免为小字符串编码（UTF-8 每个字符最多 4 字节）
+            if len(value) * 4 <= self.threshold:
+                return value
+            data = value.encode("utf-8", errors="ignore")
+            if len(data) <= self.threshold:
+                return value
+            return self._write(data, owner)
+
+        if isinstance(value, dict):
+            result = None
+            for key, item in value.items():
+                spilled = self._walk(item, owner)
+                if spilled is not item:
+                    if result is None:
+                        result = dict(value)
+                    result[key] = spilled
+            return value if result is None else result
+
+        if isinstance(value, (list, tuple)):
+            items = [self._walk(item, owner) for item in value]
+            if all(new is old for new, old in zip(items, value)):
+                return value
+            return items
+
+        return value
+
+    def _write(self, data: bytes, owner: Any) -> dict:
+        """写入一个溢出文件，返回引用"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{os.getpid()}-{uuid.uuid4().hex}{SPILL_SUFFIX}"
+
+        # 先写临时文件再改名，客户端看到的文件总是完整的
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._owners.setdefault(owner, set()).add(path)
+            self._stats["spilled"] += 1
+            self._stats["spilled_bytes"] += len(data)
+
+        logger.debug(f"Spilled {len(data)} bytes to {path}")
+        return {
+            "$spill": {
+                "path": str(path),
+                "size": len(data),
+                "sha256": hashlib.sha256(data).hexdigest(),
+                "encoding": "utf-8",
+            }
+        }
+
+    def release(self, path: str) -> bool:
+        """删除客户端已读取的文件（只接受本存储目录下的溢出文件）"""
+        target = Path(path).resolve()
+        if target.parent != self.directory or target.suffix != SPILL_SUFFIX:
+            logger.warning(f"Refusing to release file outside spill directory: {path}")
+            return False
+
+        with self._lock:
+            for paths in self._owners.values():
+                paths.discard(target)
+
+        if self._remove(target):
+            with self._lock:
+                self._stats["released"] += 1
+            return True
+        return False
+
+    def release_owner(self, owner: Any):
+        """删除某个连接尚未释放的全部文件（连接关闭时）"""
+        with self._lock:
+            paths = self._owners.pop(owner, set())
+        for path in paths:
+            self._remove(path)
+        if paths:
+            logger.info(f"Removed {len(paths)} unreleased spill file(s) of client {owner}")
+
+    def _maybe_cleanup(self):
+        """每隔一段时间清理一次过期文件"""
+        now = time.time()
+        with self._lock:
+            if now - self._last_cleanup < min(self.max_age, 60.0):
+                return
+            self._last_cleanup = now
+        self.cleanup()
+
+    def cleanup(self, max_age: Optional[float] = None) -> int:
+        """删除目录中超过 max_age 秒未释放的溢出文件，返回删除的数量"""
+        max_age = self.max_age if max_age is None else max_age
+        if not self.directory.is_dir():
+            return 0
+
+        deadline = time.time() - max_age
+        removed = 0
+        for path in self.directory.glob(f"*{SPILL_SUFFIX}"):
+            try:
+                if path.stat().st_mtime > deadline:
+                    continue
+            except OSError:
+                continue
+            if self._remove(path):
+                removed += 1
+
+        if removed:
+            with self._lock:
+                for paths in self._owners.values():
+                    paths.difference_update(p for p in list(paths) if not p.exists())
+                self._stats["expired"] += removed
+            logger.info(f"Removed {removed} expired spill file(s)")
+        return removed
+
+    def close(self):
+        """删除本进程创建的所有文件"""
+        with self._lock:
+            owners = list(self._owners)
+        for owner in owners:
+            self.release_owner(owner)
+
+    @staticmethod
+    def _remove(path: Path) -> bool:
+        try:
+            path.unlink()
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logger.warning(f"Failed to remove spill file {path}: {e}")
+            return False
+
+    def get_stats(self) -> dict:
+        """获取溢出统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = sum(len(paths) for paths in self._owners.values())
+        stats["threshold"] = self.threshold
+        return stats
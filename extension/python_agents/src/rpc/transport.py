@@ -0,0 +1,185 @@
+"""
+JSON-RPC 传输层
+负责消息分帧：按行分隔（默认）或 LSP 风格的 Content-Length 头部
+
+read_message 从阻塞的二进制流读取；aread_message 从 asyncio.StreamReader 读取
+"""
+import asyncio
+import logging
+from typing import BinaryIO, Optional, Union
+
+from .errors import ParseError
+
+logger = logging.getLogger(__name__)
+
+
+class LineTransport:
+    """
+    按行分帧的传输（向后兼容的默认模式）
+
+    每条消息是一行 JSON，以换行符结尾
+    """
+
+    name = "line"
+
+    def __init__(self, reader: Optional[BinaryIO], writer: BinaryIO):
+        self.reader = reader
+        self.writer = writer
+
+    def read_message(self) -> Optional[bytes]:
+        """读取下一条消息，输入关闭时返回 None"""
+        while True:
+            line = self.reader.readline()
+            if not line:
+                return None
+
+            line = line.strip()
+            if line:
+                return line
+            # 空行，继续读取
+
+    async def aread_message(self, stream: asyncio.StreamReader) -> Optional[bytes]:
+        """从 asyncio 流读取下一条消息，输入关闭时返回 None"""
+        while True:
+            line = await stream.readline()
+            if not line:
+                return None
+
+            line = line.strip()
+            if line:
+                return line
+
+    def write_message(self, payload: Union[bytes, memoryview], flush: bool = True):
+        """写出一条消息（连续写出多条时可以只在最后 flush）"""
+        self.writer.write(payload)
+        self.writer.write(b"\n")
+        if flush:
+            self.writer.flush()
+
+    def flush(self):
+        """刷新输出流"""
+        self.writer.flush()
+
+
+class ContentLengthTransport:
+    """
+    Content-Length 分帧的传输（与 LSP 相同）
+
+    每条消息由 "Content-Length: N" 等头部、一个空行和 N 字节的 JSON 组成。
+    读取直接在原始字节上进行，消息体读入可复用的缓冲区，避免逐行解码和重复拷贝；
+    消息体中的换行符也不会破坏分帧。
+    """
+
+    name = "content-length"
+
+    def __init__(self, reader: Optional[BinaryIO], writer: BinaryIO, buffer_size: int = 64 * 1024):
+        self.reader = reader
+        self.writer = writer
+        self._buffer = bytearray(buffer_size)
+
+    def _read_headers(self) -> Optional[dict]:
+        """读取头部，输入关闭时返回 None"""
+        headers = {}
+        while True:
+            line = self.reader.readline()
+            if not line:
+                return None
+            if self._parse_header(line, headers):
+                return headers
+
+    @staticmethod
+    def _parse_header(line: bytes, headers: dict) -> bool:
+        """解析一行头部，遇到头部结束的空行时返回 True"""
+        line = line.strip()
+        if not line:
+            # 头部之前多余的空行忽略
+            return bool(headers)
+
+        name, sep, value = line.partition(b":")
+        if not sep:
+            raise ParseError(f"Invalid header line: {line[:100]!r}")
+        headers[name.strip().lower()] = value.strip()
+        return False
+
+    @staticmethod
+    def _content_length(headers: dict) -> int:
+        """从头部取出消息体长度"""
+        try:
+            return int(headers[b"content-length"])
+        except (KeyError, ValueError):
+            raise ParseError("Missing or invalid Content-Length header")
+
+    def read_message(self) -> Optional[memoryview]:
+        """
+        读取下一条消息，输入关闭时返回 None
+
+        返回的 memoryview 指向内部缓冲区，在下一次读取前有效
+        """
+        headers = self._read_headers()
+        if headers is None:
+            return None
+
+        length = self._content_length(headers)
+        if length > len(self._buffer):
+            # 按 2 的幂扩容，避免大消息反复分配
+            self._buffer = bytearray(1 << (length - 1).bit_length())
+
+        view = memoryview(self._buffer)[:length]
+        received = 0
+        while received < length:
+            n = self.reader.readinto(view[received:])
+            if not n:
+                logger.warning(f"Input closed in the middle of a message ({received}/{length} bytes)")
+                return None
+            received += n
+
+        return view
+
+    async def aread_message(self, stream: asyncio.StreamReader) -> Optional[bytes]:
+        """从 asyncio 流读取下一条消息，输入关闭时返回 None"""
+        headers = {}
+        while True:
+            line = await stream.readline()
+            if not line:
+                return None
+            if self._parse_header(line, headers):
+                break
+
+        try:
+            return await stream.readexactly(self._content_length(headers))
+        except asyncio.IncompleteReadError as e:
+            logger.warning(f"Input closed in the middle of a message ({len(e.partial)} bytes)")
+            return None
+
+    def write_message(self, payload: Union[bytes, memoryview], flush: bool = True):
+        """写出一条消息（连续写出多条时可以只在最后 flush）"""
+        self.writer.write(b"Content-Length: %d\r\n\r\n" % len(payload))
+        self.writer.write(payload)
+        if flush:
+            self.writer.flush()
+
+    def flush(self):
+        """刷新输出流"""
+        self.writer.flush()
+
+
+TRANSPORTS = {
+    LineTransport.name: LineTransport,
+    ContentLengthTransport.name: ContentLengthTransport,
+}
+
+
+def create_transport(framing: str, reader: Optional[BinaryIO], writer: BinaryIO):
+    """
+    根据分帧模式创建传输
+
+    Args:
+        framing: "line" 或 "content-length"
+        reader: 二进制输入流
+        writer: 二进制输出流
+    """
+    try:
+        transport_class = TRANSPORTS[framing]
+    except KeyError:
+        raise ValueError(f"Unsupported framing: {framing}")
+    return transport_class(reader, writer)
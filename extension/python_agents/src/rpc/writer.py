@@ -0,0 +1,209 @@
+"""
+输出写线程
+所有发往 stdout 的消息经由同一个有界队列，由单独的线程按顺序写出：
+- 消息之间不会交错
+- 同一会话连续的 chat.stream 片段在短时间窗口内合并为一条通知（同一请求连续的待办列表更新只保留最新的一条）
+- 扩展读取过慢、队列超过字节上限时，生产者阻塞等待（背压），内存不会无限增长
+"""
+import time
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Hashable, Optional
+
+from .codec import encode_json
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending:
+    """队列中的一项：已编码的消息、可合并的消息或控制操作"""
+
+    __slots__ = ("payload", "size", "key", "message", "action", "created")
+
+    def __init__(self, payload: Optional[bytes] = None, size: int = 0, key: Optional[Hashable] = None,
+                 message: Any = None, action: Optional[Callable[[], None]] = None):
+        self.payload = payload
+        self.size = size
+        self.key = key
+        self.message = message
+        self.action = action
+        self.created = time.monotonic()
+
+
+class OutputWriter:
+    """
+    单线程输出写入器
+
+    Args:
+        transport: 输出传输（需要 write_message 和 flush）
+        merge: 合并函数 merge(older, newer) -> message，用于合并同一 key 的连续消息
+        max_pending_bytes: 队列中允许积压的最大字节数，超过后 put 阻塞
+        coalesce_window: 可合并消息在队首等待后续片段的最长时间（秒）
+    """
+
+    def __init__(
+        self,
+        transport,
+        merge: Optional[Callable[[Any, Any], Any]] = None,
+        max_pending_bytes: int = 8 * 1024 * 1024,
+        coalesce_window: float = 0.02
+    ):
+        self.transport = transport
+        self.merge = merge
+        self.max_pending_bytes = max_pending_bytes
+        self.coalesce_window = coalesce_window
+
+        self._cond = threading.Condition()
+        self._queue: Deque[_Pending] = deque()
+        self._pending_bytes = 0
+        self._writing = False
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {
+            "messages": 0,
+            "writes": 0,
+            "bytes": 0,
+            "coalesced": 0,
+            "blocked": 0,
+            "blocked_ms": 0.0,
+            "max_pending_bytes": 0,
+        }
+
+    def start(self):
+        """启动写线程"""
+        self._thread = threading.Thread(target=self._run, name="rpc-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, payload: bytes, key: Optional[Hashable] = None, message: Any = None):
+        """
+        提交一条已编码的消息
+
+        Args:
+            payload: 编码后的消息
+            key: 合并键；与队尾消息的 key 相同时二者合并为一条
+            message: key 不为空时提供原始消息，合并后在写出时重新编码
+        """
+        size = len(payload)
+        with self._cond:
+            self._wait_for_space(size)
+            self._stats["messages"] += 1
+
+            tail = self._queue[-1] if self._queue else None
+            if key is not None and tail is not None and tail.key == key and self.merge is not None:
+                # 与队尾的同类消息合并，写出时重新编码
+                tail.message = self.merge(tail.message, message)
+                tail.payload = None
+                tail.size += size
+                self._stats["coalesced"] += 1
+            else:
+                self._queue.append(_Pending(payload, size, key, message))
+
+            self._pending_bytes += size
+            self._stats["max_pending_bytes"] = max(self._stats["max_pending_bytes"], self._pending_bytes)
+            self._cond.notify_all()
+
+    def call(self, action: Callable[[], None]):
+        """在写线程上按队列顺序执行操作（如切换输出分帧）"""
+        with self._cond:
+            self._queue.append(_Pending(action=action))
+            self._cond.notify_all()
+
+    def switch_transport(self, transport):
+        """队列中已有的消息写出后切换输出传输"""
+        def switch():
+            self.transport = transport
+        self.call(switch)
+
+    def _wait_for_space(self, size: int):
+        """队列超过字节上限时阻塞（调用方持有锁）；队列为空时总是允许，避免大消息死锁"""
+        if self._pending_bytes + size <= self.max_pending_bytes or not self._queue:
+            return
+
+        start = time.monotonic()
+        self._stats["blocked"] += 1
+        while self._queue and self._pending_bytes + size > self.max_pending_bytes and not self._closed:
+            self._cond.wait()
+        self._stats["blocked_ms"] += (time.monotonic() - start) * 1000
+
+    def _take(self) -> Optional[list]:
+        """取出可以写出的所有消息，队列为空且已关闭时返回 None（调用方持有锁）"""
+        while True:
+            if not self._queue:
+                if self._closed:
+                    return None
+                self._cond.wait()
+                continue
+
+            head = self._queue[0]
+            if head.key is not None and len(self._queue) == 1 and not self._closed:
+                # 唯一的一条可合并消息：在时间窗口内等待后续片段
+                remaining = head.created + self.coalesce_window - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+
+            items = list(self._queue)
+            self._queue.clear()
+            self._writing = True
+            return items
+
+    def _run(self):
+        """写线程主循环：一次取出队列中的全部消息，逐条写出后只 flush 一次"""
+        while True:
+            with self._cond:
+                items = self._take()
+                if items is None:
+                    return
+
+            written = 0
+            for item in items:
+                try:
+                    if item.action is not None:
+                        item.action()
+                        continue
+                    payload = item.payload if item.payload is not None else encode_json(item.message)
+                    self.transport.write_message(payload, flush=False)
+                    written += 1
+                except Exception:
+                    logger.exception("Failed to write message")
+
+            try:
+                self.transport.flush()
+            except Exception:
+                logger.exception("Failed to flush output")
+
+            with self._cond:
+                self._pending_bytes -= sum(item.size for item in items)
+                self._stats["writes"] += written
+                self._stats["bytes"] += sum(item.size for item in items)
+                self._writing = False
+                self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待已提交的消息全部写出"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queue or self._writing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout: Optional[float] = 5.0):
+        """写出剩余消息并停止写线程"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def get_stats(self) -> dict:
+        """获取写出统计"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["pending_bytes"] = self._pending_bytes
+            stats["queued"] = len(self._queue)
+        return stats
@@ -0,0 +1,253 @@
+"""
+启动性能分析
+记录 agent_server 冷启动的各模块导入耗时和各初始化阶段耗时，写成 JSON 报告，
+并可以比较两份报告，发现启动时间的退化
+
+生成报告（在新的子进程中以 -X importtime 启动服务器，初始化完成后退出）:
+    python src/agent_server.py --profile-startup startup.json
+
+比较报告（新报告比基线慢超过阈值时退出码为 1）:
+    python src/startup_profile.py compare baseline.json startup.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+REPORT_VERSION = 1
+
+# 子进程在构造完服务器（即将发送 server.ready）和初始化完成时各输出一行带此前缀的 JSON
+CHILD_MARKER = "@@startup-profile "
+
+# 父进程启动子进程时的时间戳（time.time()），子进程据此计算从启动解释器开始的耗时
+_T0_ENV = "STARTUP_PROFILE_T0"
+
+_IMPORTTIME_PREFIX = "import time:"
+
+
+def parse_importtime(lines) -> List[dict]:
+    """
+    解析 -X importtime 的输出
+
+    每个模块一条记录：module、self_ms、cumulative_ms、depth（嵌套层数，0 为顶层导入）
+    和 parent（导入它的模块）。importtime 先输出子模块再输出父模块，
+    所以遇到某一层的模块时，之前挂起的更深一层的模块都是它的子模块。
+    """
+    modules: List[dict] = []
+    pending: List[dict] = []
+    for line in lines:
+        if not line.startswith(_IMPORTTIME_PREFIX):
+            continue
+        parts = line[len(_IMPORTTIME_PREFIX):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            self_us = int(parts[0])
+            cumulative_us = int(parts[1])
+        except ValueError:
+            # 表头行
+            continue
+
+        name_field = parts[2].rstrip("\n")
+        name = name_field.strip()
+        depth = max(0, (len(name_field) - len(name_field.lstrip(" ")) - 1) // 2)
+        entry = {
+            "module": name,
+            "self_ms": round(self_us / 1000, 3),
+            "cumulative_ms": round(cumulative_us / 1000, 3),
+            "depth": depth,
+            "parent": None,
+        }
+        while pending and pending[-1]["depth"] > depth:
+            pending.pop()["parent"] = name
+        pending.append(entry)
+        modules.append(entry)
+    return modules
+
+
+def summarize_imports(modules: List[dict], top: int = 30) -> dict:
+    """汇总导入耗时：总耗时、按顶层包汇总的自身耗时、累计耗时最高的模块"""
+    by_package: Dict[str, float] = {}
+    for entry in modules:
+        package = entry["module"].split(".")[0]
+        by_package[package] = by_package.get(package, 0.0) + entry["self_ms"]
+
+    return {
+        "count": len(modules),
+        "total_ms": round(sum(m["cumulative_ms"] for m in modules if m["depth"] == 0), 1),
+        "by_package": {
+            name: round(ms, 1)
+            for name, ms in sorted(by_package.items(), key=lambda item: item[1], reverse=True)
+        },
+        "slowest": [
+            {"module": m["module"], "cumulative_ms": m["cumulative_ms"], "self_ms": m["self_ms"]}
+            for m in sorted(modules, key=lambda m: m["cumulative_ms"], reverse=True)[:top]
+        ],
+    }
+
+
+def emit_child_event(event: str, **data):
+    """子进程向父进程报告进度（写到 stdout），附带从父进程启动子进程开始的耗时"""
+    elapsed_ms = round((time.time() - float(os.environ.get(_T0_ENV, time.time()))) * 1000, 1)
+    sys.stdout.write(CHILD_MARKER + json.dumps({"event": event, "elapsed_ms": elapsed_ms, **data}) + "\n")
+    sys.stdout.flush()
+
+
+def run_profile(server_script: str, output: str, timeout: float = 300.0, extra_env: Optional[dict] = None) -> dict:
+    """
+    在子进程中以 -X importtime 启动服务器并生成报告
+
+    Args:
+        server_script: agent_server.py 的路径
+        output: 报告写入的路径
+        timeout: 等待子进程完成初始化的秒数
+
+    Returns:
+        报告内容
+    """
+    env = dict(os.environ, **(extra_env or {}))
+    env.setdefault("LOG_LEVEL", "WARNING")
+    command = [sys.executable, "-X", "importtime", server_script, "--profile-startup-child"]
+
+    started = time.monotonic()
+    env[_T0_ENV] = repr(time.time())
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+    )
+    try:
+        # stdout 只有少量事件行，stderr 是 importtime 的输出；communicate 同时读取两者，避免管道写满
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise RuntimeError(f"Server did not finish initializing within {timeout:.0f}s")
+    process_ms = round((time.monotonic() - started) * 1000, 1)
+
+    events = {}
+    for line in stdout.splitlines():
+        if line.startswith(CHILD_MARKER):
+            event = json.loads(line[len(CHILD_MARKER):])
+            events[event.pop("event")] = event
+    if "ready" not in events:
+        tail = "\n".join(line for line in stderr.splitlines() if not line.startswith(_IMPORTTIME_PREFIX))[-2000:]
+        raise RuntimeError(f"Server exited with code {process.returncode} before initializing:\n{tail}")
+
+    modules = parse_importtime(stderr.splitlines())
+    report = {
+        "version": REPORT_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        # 子进程从启动解释器开始计时
+        "server_ready_ms": events.get("constructed", {}).get("elapsed_ms"),
+        "agent_ready_ms": events["ready"].get("elapsed_ms"),
+        "process_ms": process_ms,
+        "init_error": events["ready"].get("error"),
+        "phases": events["ready"].get("phases", {}),
+        "imports": summarize_imports(modules),
+        "modules": modules,
+    }
+
+    Path(output).write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    return report
+
+
+def format_report(report: dict, top: int = 10) -> str:
+    """报告的简要文本形式"""
+    lines = [
+        f"server.ready after {report['server_ready_ms']}ms, agent ready after {report['agent_ready_ms']}ms "
+        f"(imports {report['imports']['total_ms']}ms in {report['imports']['count']} modules)",
+        "phases:",
+    ]
+    lines += [f"  {name:<14} {ms:>10.1f}ms" for name, ms in report["phases"].items()]
+    lines.append("slowest packages (self time):")
+    lines += [f"  {name:<28} {ms:>10.1f}ms" for name, ms in list(report["imports"]["by_package"].items())[:top]]
+    if report.get("init_error"):
+        lines.append(f"initialization failed: {report['init_error']}")
+    return "\n".join(lines)
+
+
+def _metrics(report: dict) -> Dict[str, float]:
+    """参与比较的指标：总体耗时、各阶段、导入总耗时和各顶层包"""
+    metrics = {
+        "server_ready_ms": report.get("server_ready_ms"),
+        "agent_ready_ms": report.get("agent_ready_ms"),
+        "imports.total_ms": report["imports"]["total_ms"],
+    }
+    metrics.update({f"phase.{name}": ms for name, ms in report.get("phases", {}).items()})
+    metrics.update({f"package.{name}": ms for name, ms in report["imports"]["by_package"].items()})
+    return {name: value for name, value in metrics.items() if isinstance(value, (int, float))}
+
+
+def compare_reports(baseline: dict, current: dict, threshold: float = 20.0, min_ms: float = 50.0) -> Tuple[List[str], List[str]]:
+    """
+    比较两份报告
+
+    某项指标比基线慢超过 threshold 百分比、且绝对差值超过 min_ms 时视为退化
+    （绝对差值的下限用于忽略小模块的测量噪声）。
+
+    Returns:
+        (输出行, 退化的指标名)
+    """
+    base = _metrics(baseline)
+    new = _metrics(current)
+    lines = [f"{'metric':<36} {'baseline':>10} {'current':>10} {'delta':>10}"]
+    regressions = []
+    for name in sorted(set(base) | set(new), key=lambda n: -max(base.get(n, 0), new.get(n, 0))):
+        before = base.get(name, 0.0)
+        after = new.get(name, 0.0)
+        delta = after - before
+        regressed = delta > min_ms and (before == 0 or delta / before * 100 > threshold)
+        if regressed:
+            regressions.append(name)
+        # 只列出有意义的变化和总体指标
+        if regressed or abs(delta) > min_ms or not name.startswith("package."):
+            flag = "  REGRESSION" if regressed else ""
+            lines.append(f"{name:<36} {before:>9.1f}ms {after:>9.1f}ms {delta:>+9.1f}ms{flag}")
+    return lines, regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Startup profile reports for agent_server")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    show = subcommands.add_parser("show", help="print a summary of a report")
+    show.add_argument("report")
+
+    compare = subcommands.add_parser("compare", help="compare a report against a baseline")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=20.0, help="regression threshold in percent (default 20)")
+    compare.add_argument("--min-ms", type=float, default=50.0, help="ignore differences below this many ms (default 50)")
+
+    args = parser.parse_args(argv)
+    if args.command == "show":
+        print(format_report(json.loads(Path(args.report).read_text(encoding="utf-8"))))
+        return 0
+
+    baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+    current = json.loads(Path(args.current).read_text(encoding="utf-8"))
+    lines, regressions = compare_reports(baseline, current, args.threshold, args.min_ms)
+    print("\n".join(lines))
+    if regressions:
+        print(f"\n{len(regressions)} startup regression(s): {', '.join(regressions)}")
+        return 1
+    print("\nNo startup regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
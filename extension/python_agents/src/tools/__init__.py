@@ -14,7 +14,8 @@ from .ast_tools import (
     FunctionInfo,
     ClassInfo,
     ImportInfo,
-    CodeMetrics
+    CodeMetrics,
+    CodeFingerprint
 )
 
 __all__ = [
@@ -23,5 +24,6 @@ __all__ = [
     'ClassInfo',
     'ImportInfo',
     'CodeMetrics',
+    'CodeFingerprint',
 ]
 
@@ -3,7 +3,9 @@ AST 分析工具
 提供代码结构分析功能
 """
 import ast
+import hashlib
 import logging
+import textwrap
 from typing import List, Dict, Any, Optional
 from dataclasses import dataclass, field
 
@@ -53,6 +55,31 @@ class CodeMetrics:
     complexity: int  # 圈复杂度估算
 
 
+@dataclass
+class CodeFingerprint:
+    """代码指纹（格式、注释变化时保持不变）"""
+    digest: str  # 整段代码的指纹，前缀 ast: 或 text: 表示计算方式
+    kind: str  # "ast"（按语法树）或 "text"（非 Python 或无法解析时按规范化文本）
+    functions: Dict[str, str] = field(default_factory=dict)  # 函数/方法限定名 -> 指纹
+
+
+class _DocstringStripper(ast.NodeTransformer):
+    """去掉模块、类和函数的文档字符串"""
+    
+    def _strip(self, node):
+        self.generic_visit(node)
+        body = node.body
+        if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) \
+                and isinstance(body[0].value.value, str):
+            node.body = body[1:] or [ast.Pass()]
+        return node
+    
+    visit_Module = _strip
+    visit_ClassDef = _strip
+    visit_FunctionDef = _strip
+    visit_AsyncFunctionDef = _strip
+
+
 class ASTTools:
     """AST 分析工具集"""
     
@@ -354,4 +381,55 @@ class ASTTools:
                         return None
         
         return None
-
+    
+    def fingerprint(self, code: str, language: str = "python", strip_docstrings: bool = False) -> CodeFingerprint:
+        """
+        计算代码的规范化指纹
+        
+        Python 代码解析后对 ast.dump 取哈希：缩进、空行、空白、注释和行号都不影响结果
+        （选中类中的方法时带有的公共缩进会先去掉）。同时为每个函数和方法
+        （限定名如 "Class.method"）计算子指纹，文件中其他部分改动时，未修改的函数指纹不变。
+        非 Python 代码或无法解析的片段退化为规范化文本（去掉公共缩进、行尾空白和空行）的哈希。
+        
+        Args:
+            code: 源代码
+            language: 编程语言
+            strip_docstrings: 是否忽略文档字符串
+            
+        Returns:
+            代码指纹
+        """
+        tree = None
+        if language.lower() in ("python", "py"):
+            try:
+                tree = ast.parse(textwrap.dedent(code))
+            except (SyntaxError, ValueError):
+                tree = None
+        
+        if tree is None:
+            lines = textwrap.dedent(code.replace("\r\n", "\n").replace("\r", "\n")).split("\n")
+            normalized = "\n".join(line.rstrip() for line in lines if line.strip())
+            return CodeFingerprint(digest="text:" + self._hash(normalized), kind="text")
+        
+        if strip_docstrings:
+            tree = _DocstringStripper().visit(tree)
+        
+        functions = {}
+        self._collect_function_fingerprints(tree, "", functions)
+        return CodeFingerprint(digest="ast:" + self._hash(ast.dump(tree)), kind="ast", functions=functions)
+    
+    def _collect_function_fingerprints(self, node: ast.AST, prefix: str, result: Dict[str, str]):
+        """递归收集函数和方法的指纹（限定名包含外层类名和函数名）"""
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                name = prefix + child.name
+                result[name] = "ast:" + self._hash(ast.dump(child))
+                self._collect_function_fingerprints(child, name + ".", result)
+            elif isinstance(child, ast.ClassDef):
+                self._collect_function_fingerprints(child, prefix + child.name + ".", result)
+            elif isinstance(child, (ast.If, ast.Try, ast.With, ast.AsyncWith)):
+                # 条件定义（如 if TYPE_CHECKING / try-except ImportError）中的函数
+                self._collect_function_fingerprints(child, prefix, result)
+    
+    def _hash(self, text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
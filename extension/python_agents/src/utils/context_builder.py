@@ -2,12 +2,37 @@
 上下文构建器
 为 Agent 构建丰富的上下文信息
 """
+import ast
 import logging
 from typing import Dict, List, Any, Optional
 from pathlib import Path
 
+from .tokens import estimate_tokens
+
 logger = logging.getLogger(__name__)
 
+# 上下文各部分的价值（assemble_context 按 价值 / token 数 从高到低放入预算）
+SECTION_VALUES = {
+    "current_file": 3.0,
+    "selected_code": 10.0,
+    "enclosing_symbol": 6.0,
+    "surrounding_code": 5.0,
+    "file_content": 4.0,
+    "related_files": 1.0,
+    "workspace": 1.5,
+}
+
+# 放入 prompt 的顺序（与选择顺序无关）
+SECTION_ORDER = list(SECTION_VALUES)
+
+# 包含了其他部分内容的部分：放入整个文件后，光标周围的代码和所在符号不再重复
+SECTION_COVERS = {
+    "file_content": ("enclosing_symbol", "surrounding_code"),
+}
+
+# 代码部分放不下时截断到剩余预算，剩余预算少于该 token 数时直接舍弃
+MIN_TRUNCATED_TOKENS = 64
+
 
 class ContextBuilder:
     """上下文构建器"""
@@ -81,6 +106,15 @@ class ContextBuilder:
                 )
                 if surrounding:
                     context["surrounding_code"] = surrounding
+                
+                # Python 文件：光标所在的函数或类
+                if context["current_file"]["language"] == "python":
+                    symbol = self._find_enclosing_symbol(
+                        context["current_file"].get("content", ""),
+                        cursor_position.get("line", 0)
+                    )
+                    if symbol:
+                        context["enclosing_symbol"] = symbol
         
         # 工作区信息
         if include_workspace_info:
@@ -176,6 +210,46 @@ class ContextBuilder:
             "cursor_line": line_number
         }
     
+    def _find_enclosing_symbol(self, file_content: str, line_number: int) -> Optional[Dict[str, Any]]:
+        """
+        查找包含指定行的最内层函数或类
+        
+        Args:
+            file_content: Python 源代码
+            line_number: 行号（1-based）
+        
+        Returns:
+            {"type", "name", "start_line", "end_line", "content"}，不在任何符号内或无法解析时返回 None
+        """
+        if not file_content:
+            return None
+        try:
+            tree = ast.parse(file_content)
+        except (SyntaxError, ValueError):
+            return None
+        
+        best = None
+        for node in ast.walk(tree):
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                continue
+            # 装饰器属于符号的一部分
+            start = min([node.lineno] + [d.lineno for d in node.decorator_list])
+            end = node.end_lineno or node.lineno
+            if start <= line_number <= end and (best is None or end - start < best[1] - best[0]):
+                best = (start, end, node)
+        
+        if best is None:
+            return None
+        start, end, node = best
+        lines = file_content.split('\n')
+        return {
+            "type": "class" if isinstance(node, ast.ClassDef) else "function",
+            "name": node.name,
+            "start_line": start,
+            "end_line": end,
+            "content": '\n'.join(lines[start - 1:end])
+        }
+    
     def _get_workspace_info(self) -> Dict[str, Any]:
         """
         获取工作区信息
@@ -262,16 +336,20 @@ class ContextBuilder:
         
         return related[:max_files]
     
-    def format_context_for_prompt(self, context: Dict[str, Any]) -> str:
+    def format_context_for_prompt(self, context: Dict[str, Any], max_tokens: Optional[int] = None) -> str:
         """
         将上下文格式化为 Prompt
         
         Args:
             context: 上下文字典
-            
+            max_tokens: token 预算（估算），指定时按 assemble_context 选择放入的部分
+        
         Returns:
             格式化的上下文文本
         """
+        if max_tokens is not None:
+            return self.assemble_context(context, max_tokens)["text"]
+        
         parts = []
         
         # 当前文件
@@ -307,4 +385,219 @@ class ContextBuilder:
                 parts.append(f"Project types: {', '.join(ws['project_types'])}")
         
         return '\n'.join(parts)
+    
+    def assemble_context(self, context: Dict[str, Any], max_tokens: int) -> Dict[str, Any]:
+        """
+        在 token 预算内组装上下文
+        
+        把 build_context 的结果拆成若干部分（文件信息、选中的代码、所在符号、光标周围的代码、
+        整个文件、相关文件、工作区信息），按 价值 / token 数 从高到低依次放入预算；
+        代码部分放不下时截断到剩余预算（以光标所在行为中心），不再重复已被覆盖的部分
+        （如放入整个文件后的光标周围代码）。token 数为本地估算值。
+        
+        Args:
+            context: build_context 返回的上下文字典
+            max_tokens: token 预算
+        
+        Returns:
+            {"text": 格式化的上下文, "tokens": 使用的 token 数, "budget": 预算,
+             "sections": [{"name", "tokens", "value", "status", ...}]}
+            status 为 included、truncated 或 dropped（附 reason 和原始 token 数 full_tokens）
+        """
+        candidates = {}
+        for name in SECTION_ORDER:
+            section = self._render_section(name, context)
+            if section is not None:
+                candidates[name] = section
+        
+        for section in candidates.values():
+            section["tokens"] = estimate_tokens(section["text"])
+            section["full_tokens"] = section["tokens"]
+        
+        remaining = max_tokens
+        chosen = {}
+        dropped = {}
+        order = sorted(
+            candidates,
+            key=lambda n: SECTION_VALUES[n] / max(candidates[n]["tokens"], 1),
+            reverse=True
+        )
+        for name in order:
+            section = candidates[name]
+            covered_by = next(
+                (other for other in chosen
+                 if name in SECTION_COVERS.get(other, ()) and not chosen[other].get("truncated")),
+                None
+            )
+            if covered_by is not None:
+                dropped[name] = {"reason": f"covered by {covered_by}"}
+                continue
+            
+            if section["tokens"] > remaining:
+                truncated = self._truncate_section(section, remaining)
+                if truncated is None:
+                    dropped[name] = {"reason": "over budget"}
+                    continue
+                section = truncated
+            
+            chosen[name] = section
+            remaining -= section["tokens"]
+            # 放入的部分覆盖了已经放入的部分：移除重复内容，归还预算
+            for covered in SECTION_COVERS.get(name, ()):
+                if covered in chosen and not section.get("truncated"):
+                    remaining += chosen.pop(covered)["tokens"]
+                    dropped[covered] = {"reason": f"covered by {name}"}
+        
+        sections = []
+        for name in SECTION_ORDER:
+            if name in chosen:
+                section = chosen[name]
+                sections.append({
+                    "name": name,
+                    "tokens": section["tokens"],
+                    "full_tokens": section["full_tokens"],
+                    "value": SECTION_VALUES[name],
+                    "status": "truncated" if section.get("truncated") else "included",
+                })
+            elif name in dropped:
+                sections.append({
+                    "name": name,
+                    "tokens": 0,
+                    "full_tokens": candidates[name]["full_tokens"],
+                    "value": SECTION_VALUES[name],
+                    "status": "dropped",
+                    "reason": dropped[name]["reason"],
+                })
+        
+        parts = [chosen[name]["text"] for name in SECTION_ORDER if name in chosen]
+        return {
+            "text": '\n\n'.join(parts),
+            "tokens": max_tokens - remaining,
+            "budget": max_tokens,
+            "sections": sections,
+        }
+    
+    def _render_section(self, name: str, context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        把上下文中的一部分格式化为文本
+        
+        代码部分返回 header / code / footer / center（截断时保留的中心行，相对于 code 的 0-based 行号）
+        """
+        language = context.get("current_file", {}).get("language", "")
+        cursor_line = (context.get("cursor_position") or {}).get("line")
+        
+        if name == "current_file" and "current_file" in context:
+            file_info = context["current_file"]
+            lines = [f"## Current File: {file_info['path']}", f"Language: {file_info['language']}"]
+            if "line_count" in file_info:
+                lines.append(f"Lines: {file_info['line_count']}")
+            return {"text": '\n'.join(lines)}
+        
+        if name == "selected_code" and "selected_code" in context:
+            return self._code_section("## Selected Code:", context["selected_code"]["content"], language)
+        
+        if name == "enclosing_symbol" and "enclosing_symbol" in context:
+            symbol = context["enclosing_symbol"]
+            return self._code_section(
+                f"## Enclosing {symbol['type'].capitalize()}: {symbol['name']} "
+                f"(lines {symbol['start_line']}-{symbol['end_line']})",
+                symbol["content"],
+                language,
+                center=cursor_line - symbol["start_line"] if cursor_line else None
+            )
+        
+        if name == "surrounding_code" and "surrounding_code" in context:
+            surrounding = context["surrounding_code"]
+            return self._code_section(
+                f"## Code Context (lines {surrounding['start_line']}-{surrounding['end_line']}):",
+                surrounding["content"],
+                language,
+                footer=f"(Cursor at line {surrounding['cursor_line']})",
+                center=surrounding["cursor_line"] - surrounding["start_line"]
+            )
+        
+        if name == "file_content" and context.get("current_file", {}).get("content"):
+            return self._code_section(
+                "## File Content:",
+                context["current_file"]["content"],
+                language,
+                center=cursor_line - 1 if cursor_line else None
+            )
+        
+        if name == "related_files" and context.get("related_files"):
+            return {"text": '\n'.join(["## Related Files:"] + [f"- {path}" for path in context["related_files"]])}
+        
+        if name == "workspace" and "workspace" in context:
+            ws = context["workspace"]
+            lines = [f"## Workspace: {ws['name']}"]
+            if ws.get("project_types"):
+                lines.append(f"Project types: {', '.join(ws['project_types'])}")
+            return {"text": '\n'.join(lines)}
+        
+        return None
+    
+    def _code_section(
+        self,
+        header: str,
+        code: str,
+        language: str,
+        footer: str = "",
+        center: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """代码部分（代码块 + 可选的说明行）"""
+        section = {"header": header, "code": code, "language": language, "footer": footer, "center": center}
+        section["text"] = self._format_code(section, code)
+        return section
+    
+    def _format_code(self, section: Dict[str, Any], code: str) -> str:
+        lines = [section["header"], "```" + section["language"], code, "```"]
+        if section["footer"]:
+            lines.append(section["footer"])
+        return '\n'.join(lines)
+    
+    def _truncate_section(self, section: Dict[str, Any], max_tokens: int) -> Optional[Dict[str, Any]]:
+        """
+        把代码部分截断到 max_tokens 以内
+        
+        从中心行（光标所在行，没有时为第一行）向两侧扩展，直到放不下为止；
+        不是代码部分或剩余预算太少时返回 None
+        """
+        if "code" not in section or max_tokens < MIN_TRUNCATED_TOKENS:
+            return None
+        
+        lines = section["code"].split('\n')
+        center = min(max(section["center"] or 0, 0), len(lines) - 1)
+        # 代码块框架和省略标记的开销
+        budget = max_tokens - estimate_tokens(self._format_code(section, "")) - 16
+        costs = [estimate_tokens(line) + 1 for line in lines]
+        
+        start = end = center
+        used = costs[center]
+        if used > budget:
+            return None
+        while True:
+            grown = False
+            # 交替向下和向上扩展
+            for step in ("down", "up"):
+                if step == "down" and end + 1 < len(lines) and used + costs[end + 1] <= budget:
+                    end += 1
+                    used += costs[end]
+                    grown = True
+                elif step == "up" and start > 0 and used + costs[start - 1] <= budget:
+                    start -= 1
+                    used += costs[start]
+                    grown = True
+            if not grown:
+                break
+        
+        kept = lines[start:end + 1]
+        if start > 0:
+            kept.insert(0, f"... ({start} lines omitted)")
+        if end + 1 < len(lines):
+            kept.append(f"... ({len(lines) - end - 1} lines omitted)")
+        text = self._format_code(section, '\n'.join(kept))
+        tokens = estimate_tokens(text)
+        if tokens > max_tokens:
+            return None
+        return {**section, "text": text, "tokens": tokens, "truncated": True}
 
@@ -4,8 +4,12 @@ LLM 客户端
 """
 import os
 import logging
+import threading
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional, Iterator
-from dataclasses import dataclass
+from dataclasses import astuple, dataclass
+
+from .resilience import RetryPolicy, call_with_retry, get_circuit_breaker, status_code
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +24,10 @@ class LLMConfig:
     temperature: float = 0.7
     max_tokens: int = 4000
     stream: bool = False
+    timeout: Optional[float] = None  # HTTP 请求超时（秒），None 使用 SDK 默认值
+    max_retries: int = 3  # 暂时性故障（429/5xx/连接错误）的重试次数
+    circuit_failure_threshold: int = 5  # 连续故障达到该次数后熔断
+    circuit_reset_timeout: float = 30.0  # 熔断后多久放行探测请求（秒）
 
 
 class LLMClient:
@@ -36,6 +44,14 @@ class LLMClient:
         self._client = None
         self._initialize_client()
         
+        # 重试和熔断由 resilience 统一处理（SDK 自带的重试已关闭，避免重试次数相乘）
+        self.retry_policy = RetryPolicy(max_retries=self.config.max_retries)
+        self.circuit_breaker = get_circuit_breaker(
+            self.config.provider,
+            failure_threshold=self.config.circuit_failure_threshold,
+            reset_timeout=self.config.circuit_reset_timeout
+        )
+        
         logger.info(f"LLMClient initialized: {self.config.provider}/{self.config.model}")
     
     def _load_default_config(self) -> LLMConfig:
@@ -71,6 +87,8 @@ class LLMClient:
                 base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
                 temperature=self.config.temperature,
                 max_tokens=self.config.max_tokens,
+                timeout=self.config.timeout,
+                max_retries=0,
             )
             logger.info("DashScope client initialized")
         except ImportError:
@@ -91,6 +109,8 @@ class LLMClient:
                 base_url=self.config.api_base,
                 temperature=self.config.temperature,
                 max_tokens=self.config.max_tokens,
+                timeout=self.config.timeout,
+                max_retries=0,
             )
             logger.info("OpenAI client initialized")
         except ImportError:
@@ -100,6 +120,28 @@ class LLMClient:
             logger.error(f"Failed to initialize OpenAI client: {e}")
             self._client = None
     
+    def warm_up(self) -> bool:
+        """
+        预先建立到 API 的 HTTP 连接（DNS、TCP、TLS 握手），第一次模型调用不再付出这部分延迟
+        
+        发送一个轻量的 GET /models 请求，不消耗 token；任何 HTTP 响应（包括 4xx）都说明连接已建立
+        并留在连接池中（同一 API 地址的客户端共用连接池）。
+        
+        Returns:
+            连接是否已建立
+        """
+        root_client = getattr(self._client, "root_client", None)
+        if root_client is None:
+            return False
+        
+        try:
+            root_client.models.list()
+        except Exception as e:
+            if status_code(e) is None:
+                logger.warning(f"Failed to warm up connection for {self.config.model}: {e}")
+                return False
+        return True
+    
     def chat(
         self,
         messages: List[Dict[str, str]],
@@ -136,18 +178,20 @@ class LLMClient:
             
             # 调用 LLM
             if stream:
-                # 流式响应
-                response_chunks = []
-                for chunk in self._client.stream(lc_messages):
-                    content = chunk.content
-                    response_chunks.append(content)
-                    yield content
-                
-                return "".join(response_chunks)
-            else:
-                # 非流式响应
-                response = self._client.invoke(lc_messages)
-                return response.content
+                # 流式响应（拼接为完整文本）
+                return "".join(self.chat_stream(messages))
+            
+            # 非流式响应
+            response = call_with_retry(
+                lambda: self._client.invoke(lc_messages),
+                self.retry_policy,
+                self.circuit_breaker,
+                description=f"LLM request ({self.config.model})"
+            )
+            return response.content
+        
+        except LLMError:
+            raise
         
         except Exception as e:
             logger.error(f"LLM request failed: {e}")
@@ -183,8 +227,22 @@ class LLMClient:
                 else:
                     lc_messages.append(HumanMessage(content=content))
             
-            # 流式调用
-            for chunk in self._client.stream(lc_messages):
+            # 流式调用：只在收到第一个片段之前重试，之后的错误直接抛出（已输出的内容无法撤回）
+            def open_stream():
+                iterator = iter(self._client.stream(lc_messages))
+                return iterator, next(iterator, None)
+            
+            iterator, first = call_with_retry(
+                open_stream,
+                self.retry_policy,
+                self.circuit_breaker,
+                description=f"LLM stream request ({self.config.model})"
+            )
+            if first is None:
+                return
+            if first.content:
+                yield first.content
+            for chunk in iterator:
                 if chunk.content:
                     yield chunk.content
         
@@ -207,24 +265,58 @@ class LLMError(Exception):
     pass
 
 
-# 全局 LLM 客户端实例
+# 全局 LLM 客户端实例（第一个创建的客户端）
 _global_client: Optional[LLMClient] = None
 
+# 按配置复用的客户端（切换回用过的模型时不再重新创建，按最近使用排序）
+_clients: "OrderedDict[tuple, LLMClient]" = OrderedDict()
+_clients_lock = threading.Lock()
+# 最多缓存的客户端数量；每次轮换密钥或调整超时都会产生新配置，超出时丢弃最久未用的
+MAX_CACHED_CLIENTS = 8
+
 
 def get_llm_client(config: Optional[LLMConfig] = None) -> LLMClient:
     """
-    获取全局 LLM 客户端实例
+    获取 LLM 客户端实例
+    
+    不传配置时返回全局客户端；传入配置时返回该配置（LLMConfig 的全部字段，包括 API 密钥和超时）
+    对应的客户端，同一配置只创建一次。缓存最多保留 MAX_CACHED_CLIENTS 个最近使用的客户端。
+    
+    客户端在锁外创建：ModelSwitchMiddleware 每次模型调用都经过这里，创建一个较慢的客户端
+    不能阻塞其他会话。同一配置并发创建时保留先完成的一个。
     
     Args:
-        config: LLM 配置（首次调用时使用）
-        
+        config: LLM 配置
+    
     Returns:
         LLM 客户端实例
     """
     global _global_client
     
-    if _global_client is None:
-        _global_client = LLMClient(config)
+    if config is None:
+        with _clients_lock:
+            if _global_client is not None:
+                return _global_client
+        client = LLMClient()
+        with _clients_lock:
+            if _global_client is None:
+                _global_client = client
+            return _global_client
     
-    return _global_client
+    key = astuple(config)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+    if client is None:
+        created = LLMClient(config)
+        with _clients_lock:
+            client = _clients.setdefault(key, created)
+            _clients.move_to_end(key)
+            while len(_clients) > MAX_CACHED_CLIENTS:
+                _clients.popitem(last=False)
+    with _clients_lock:
+        if _global_client is None:
+            _global_client = client
+    return client
 
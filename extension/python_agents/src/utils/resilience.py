@@ -0,0 +1,309 @@
+"""
+模型调用的容错
+- 可重试的错误（429、5xx、连接错误、超时）按指数退避加随机抖动重试，服务端给出 Retry-After 时遵守它
+- 每个提供商一个熔断器：连续失败达到阈值后在冷却期内直接失败，
+  而不是让每个请求都等满超时；冷却期后放行一个探测请求，成功即恢复
+- 重试不会越过请求的截止时间，请求被取消时立即停止等待；单次调用的 HTTP 超时也不超过剩余的时间
+"""
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 视为暂时性故障的 HTTP 状态码
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+# SDK 和 HTTP 库中表示连接失败/超时的异常类名（避免依赖具体的 SDK 版本）
+_TRANSIENT_ERROR_NAMES = {
+    "APIConnectionError",
+    "APITimeoutError",
+    "ConnectError",
+    "ConnectTimeout",
+    "ReadTimeout",
+    "ReadError",
+    "RemoteProtocolError",
+    "PoolTimeout",
+}
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，调用被直接拒绝"""
+    
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable (circuit open), retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def status_code(error: BaseException) -> Optional[int]:
+    """取出错误对应的 HTTP 状态码（没有时返回 None）"""
+    code = getattr(error, "status_code", None)
+    if code is None:
+        code = getattr(getattr(error, "response", None), "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_transient(error: BaseException) -> bool:
+    """是否为暂时性故障（值得重试）"""
+    code = status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return any(cls.__name__ in _TRANSIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def is_outage(error: BaseException) -> bool:
+    """是否说明服务端不可用（计入熔断器）；限流说明服务端仍在工作，不计入"""
+    return is_transient(error) and status_code(error) not in (429, 409, 425)
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """从响应头读取服务端建议的等待秒数（Retry-After / retry-after-ms）"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    
+    try:
+        value = headers.get("retry-after-ms")
+        if value is not None:
+            return max(0.0, float(value) / 1000)
+        
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            # HTTP 日期格式
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    重试策略
+    
+    Args:
+        max_retries: 最多重试次数（不含首次调用），0 表示不重试
+        base_delay: 首次重试的退避上限（秒）
+        max_delay: 单次等待的上限（秒），也限制服务端给出的 Retry-After
+    """
+    
+    def __init__(self, max_retries: int = 3, base_delay: float = 0.5, max_delay: float = 20.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def delay(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """
+        第 attempt 次重试（从 0 开始）前的等待时间
+        
+        采用 "full jitter"：在 [0, base * 2^attempt] 中均匀取值，避免多个客户端同时重试；
+        服务端给出 Retry-After 时以它为准。
+        """
+        suggested = retry_after(error) if error is not None else None
+        if suggested is not None:
+            return min(suggested, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    熔断器（线程安全）
+    
+    closed: 正常放行；连续 failure_threshold 次故障后 open
+    open: 拒绝所有调用，reset_timeout 秒后 half-open
+    half-open: 只放行一个探测调用，成功则 closed，失败则重新 open
+    """
+    
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._stats = {"rejected": 0, "opened": 0}
+    
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+    
+    def _current_state(self) -> str:
+        if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = "half-open"
+            self._probing = False
+        return self._state
+    
+    def before_call(self):
+        """调用前检查，熔断时抛出 CircuitOpenError"""
+        with self._lock:
+            state = self._current_state()
+            if state == "closed":
+                return
+            if state == "half-open" and not self._probing:
+                self._probing = True
+                return
+            self._stats["rejected"] += 1
+            remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+        raise CircuitOpenError(self.name, max(remaining, 1.0))
+    
+    def record_success(self):
+        with self._lock:
+            if self._state != "closed":
+                logger.info(f"Circuit {self.name} closed")
+            self._state = "closed"
+            self._failures = 0
+            self._probing = False
+    
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == "half-open" or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    self._stats["opened"] += 1
+                    logger.warning(f"Circuit {self.name} opened after {self._failures} failure(s)")
+                self._state = "open"
+                self._opened_at = time.monotonic()
+                self._probing = False
+    
+    def release(self):
+        """调用以非故障的原因结束（如 4xx、取消）：结束探测但不改变状态"""
+        with self._lock:
+            self._probing = False
+    
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {"state": self._current_state(), "failures": self._failures, **self._stats}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str, failure_threshold: int = 5, reset_timeout: float = 30.0) -> CircuitBreaker:
+    """获取（或创建）某个提供商的熔断器；同一提供商的所有客户端和模型共享"""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name, failure_threshold, reset_timeout)
+        return breaker
+
+
+def get_circuit_stats() -> dict:
+    """所有熔断器的状态"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.get_stats() for breaker in breakers}
+
+
+# 当前运行的截止时间和取消令牌（由 agent 运行器设置，LangGraph 在工作线程中复制上下文）
+_call_budget: ContextVar[Tuple[Optional[float], Any]] = ContextVar("resilience_call_budget", default=(None, None))
+
+
+@contextmanager
+def call_budget(deadline: Optional[float] = None, cancel_token: Any = None) -> Iterator[None]:
+    """在此范围内的 call_with_retry 不会等待超过 deadline，取消后不再重试"""
+    token = _call_budget.set((deadline, cancel_token))
+    try:
+        yield
+    finally:
+        _call_budget.reset(token)
+
+
+def remaining_budget() -> Optional[float]:
+    """当前运行距离截止时间的秒数（已过截止时间时为 0，没有截止时间时为 None）"""
+    deadline, _ = _call_budget.get()
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def call_timeout(default: Optional[float] = None) -> Optional[float]:
+    """
+    单次模型调用的 HTTP 超时：剩余预算和 default（LLMConfig.timeout）中较小的一个
+
+    两者都没有时返回 None（使用 SDK 默认值）
+    """
+    remaining = remaining_budget()
+    if remaining is None:
+        return default
+    return remaining if default is None else min(remaining, default)
+
+
+def _wait(seconds: float, cancel_token: Any) -> bool:
+    """等待 seconds 秒；请求被取消时提前返回 False"""
+    wait = getattr(cancel_token, "wait", None)
+    if wait is not None:
+        return not wait(seconds)
+    time.sleep(seconds)
+    return True
+
+
+def call_with_retry(
+    fn: Callable[[], T],
+    policy: RetryPolicy,
+    breaker: Optional[CircuitBreaker] = None,
+    description: str = "call",
+) -> T:
+    """
+    调用 fn，暂时性故障时按策略重试
+    
+    Args:
+        fn: 无参调用
+        policy: 重试策略
+        breaker: 可选的熔断器
+        description: 日志中的描述
+    
+    Raises:
+        CircuitOpenError: 熔断器打开
+        fn 最后一次抛出的异常: 不可重试、重试次数用尽或等待会越过截止时间
+    """
+    deadline, cancel_token = _call_budget.get()
+    attempt = 0
+    while True:
+        if breaker is not None:
+            breaker.before_call()
+        
+        try:
+            result = fn()
+        except Exception as e:
+            if breaker is not None:
+                if is_outage(e):
+                    breaker.record_failure()
+                else:
+                    breaker.release()
+            
+            if not is_transient(e) or attempt >= policy.max_retries:
+                raise
+            
+            delay = policy.delay(attempt, e)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                logger.warning(f"{description} failed ({e}), no time left before the deadline to retry")
+                raise
+            if breaker is not None and breaker.state == "open":
+                # 这次失败触发了熔断，不再继续重试
+                raise
+            
+            logger.warning(f"{description} failed ({type(e).__name__}: {e}), "
+                           f"retry {attempt + 1}/{policy.max_retries} in {delay:.2f}s")
+            if not _wait(delay, cancel_token):
+                raise
+            attempt += 1
+            continue
+        
+        if breaker is not None:
+            breaker.record_success()
+        return result
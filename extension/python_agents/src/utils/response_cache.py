@@ -0,0 +1,265 @@
+"""
+响应缓存
+缓存 explain_code / generate_code / refactor_code 的结果，相同的输入直接返回，不再调用 LLM
+
+- 键：方法名 + 规范化后的输入 + 模型 + 温度 + 系统提示版本 的 SHA-256
+- 内存层：有界 LRU（按条目数和字节数淘汰）
+- 磁盘层（可选）：每个条目一个 JSON 文件，重启后仍可命中，超过容量时删除最旧的文件
+- 两层都按 TTL 过期
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """规范化输入文本：统一换行符，去掉行尾空白和首尾空行（不影响代码语义的差异不应导致缓存未命中）"""
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+
+def make_key(method: str, inputs: Dict[str, Any], model: str, temperature: float, prompt_version: str) -> str:
+    """
+    计算缓存键
+    
+    Args:
+        method: RPC 方法名
+        inputs: 影响结果的请求参数（字符串会被规范化）
+        model: 模型名称
+        temperature: 采样温度
+        prompt_version: 系统提示版本（提示变化后旧条目自然失效）
+    """
+    normalized = {k: normalize_text(v) if isinstance(v, str) else v for k, v in inputs.items()}
+    payload = json.dumps(
+        [method, normalized, model, temperature, prompt_version],
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    两级响应缓存（线程安全）
+    
+    Args:
+        max_entries: 内存层最多条目数
+        max_bytes: 内存层最多字节数（按 JSON 编码后的大小估算）
+        ttl: 条目有效期（秒），0 表示不过期
+        directory: 磁盘层目录，None 表示不使用磁盘层
+        max_disk_bytes: 磁盘层容量
+    """
+    
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_bytes: int = 32 * 1024 * 1024,
+        ttl: float = 3600,
+        directory: Optional[str] = None,
+        max_disk_bytes: int = 0,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = Path(directory) if directory and max_disk_bytes > 0 else None
+        self.max_disk_bytes = max_disk_bytes
+        
+        self._lock = threading.Lock()
+        # key -> (写入时间（time.time，与磁盘层一致）, 值, 大小)
+        self._entries: "OrderedDict[str, Tuple[float, Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0,
+                       "stores": 0, "evictions": 0, "expired": 0}
+        
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+            self._prune_disk()
+    
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+    
+    def get(self, key: str) -> Optional[Any]:
+        """查找条目；未命中或已过期时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry[1]
+                self._remove(key)
+                self._stats["expired"] += 1
+        
+        value = self._disk_get(key)
+        with self._lock:
+            if value is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["disk_hits"] += 1
+            self._insert(key, *value)
+            return value[1]
+    
+    def put(self, key: str, value: Any):
+        """写入条目（值必须可以 JSON 编码）"""
+        try:
+            data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Response not cacheable: {e}")
+            return
+        
+        created = time.time()
+        with self._lock:
+            self._stats["stores"] += 1
+            self._insert(key, created, value, len(data))
+        self._disk_put(key, created, data)
+    
+    def record_bypass(self):
+        """请求要求跳过缓存（结果仍会写入，刷新旧条目）"""
+        with self._lock:
+            self._stats["bypassed"] += 1
+    
+    def clear(self):
+        """清空两层缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.directory is not None:
+            for path, _, _ in self._disk_files():
+                self._discard(path)
+    
+    def _insert(self, key: str, created: float, value: Any, size: int):
+        """写入内存层并按 LRU 淘汰（调用方持有锁）"""
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (created, value, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._stats["evictions"] += 1
+    
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+    
+    # ---- 磁盘层 ----
+    
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+    
+    def _disk_get(self, key: str) -> Optional[Tuple[float, Any, int]]:
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            entry = json.loads(data)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable cache entry {path.name}: {e}")
+            self._discard(path)
+            return None
+        
+        if self._expired(entry["created"]):
+            self._discard(path)
+            with self._lock:
+                self._stats["expired"] += 1
+            return None
+        return entry["created"], entry["value"], len(data)
+    
+    def _disk_put(self, key: str, created: float, data: bytes):
+        if self.directory is None:
+            return
+        path = self._path(key)
+        # 先写临时文件再改名，其他进程（守护进程和 stdio 服务器可能共用缓存目录）不会读到半个文件
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        content = b'{"created": ' + repr(created).encode() + b', "value": ' + data + b'}'
+        try:
+            tmp.write_bytes(content)
+            # 覆盖已有的文件时只计入大小的变化
+            replaced = self._file_size(path)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"Failed to write cache entry: {e}")
+            self._unlink(tmp)
+            return
+        
+        with self._lock:
+            self._disk_bytes += len(content) - replaced
+            over = self._disk_bytes > self.max_disk_bytes
+        if over:
+            self._prune_disk()
+    
+    def _file_size(self, path: Path) -> int:
+        try:
+            return path.stat().st_size
+        except OSError:
+            return 0
+    
+    def _disk_files(self):
+        """磁盘层的文件列表：(路径, 大小, 修改时间)"""
+        files = []
+        if self.directory is None:
+            return files
+        for path in self.directory.glob("*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((path, stat.st_size, stat.st_mtime))
+        return files
+    
+    def _prune_disk(self):
+        """删除过期文件；仍超过容量时从最旧的开始删除，直到降到容量的 80%"""
+        files = sorted(self._disk_files(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+        target = self.max_disk_bytes * 0.8
+        for path, size, mtime in files:
+            if total <= target and not self._expired(mtime):
+                continue
+            self._unlink(path)
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+    
+    def _discard(self, path: Path):
+        """删除磁盘层的一个文件，并从 _disk_bytes 中减去它的大小（文件已被其他线程删除时不重复扣减）"""
+        size = self._file_size(path)
+        try:
+            path.unlink()
+        except OSError:
+            return
+        with self._lock:
+            self._disk_bytes -= size
+    
+    def _unlink(self, path: Path):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+    
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["disk_hits"] + self._stats["misses"]
+            stats = {
+                **self._stats,
+                "hit_rate": round((self._stats["hits"] + self._stats["disk_hits"]) / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+            if self.directory is not None:
+                stats["disk_bytes"] = self._disk_bytes
+        return stats
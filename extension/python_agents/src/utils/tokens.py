@@ -0,0 +1,61 @@
+"""
+Token 估算
+不依赖具体模型的分词器，按字符类别估算文本的 token 数（偏保守），
+用于判断对话历史和上下文是否超出预算
+"""
+import json
+from typing import Any, Iterable
+
+# 每条消息的固定开销（角色、分隔符等）
+MESSAGE_OVERHEAD = 4
+
+
+def _is_wide(char: str) -> bool:
+    """中日韩文字和全角符号：通常每个字符至少一个 token"""
+    code = ord(char)
+    return (
+        0x2E80 <= code <= 0x9FFF      # CJK 部首、符号、假名、统一汉字
+        or 0xAC00 <= code <= 0xD7AF   # 韩文
+        or 0xF900 <= code <= 0xFAFF   # CJK 兼容汉字
+        or 0xFF00 <= code <= 0xFFEF   # 全角字符
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的 token 数
+
+    宽字符每个算一个 token，其余字符按每 4 个一个 token 计算
+    （英文和代码在常见分词器上约为 3.5~4.5 个字符一个 token）。
+    """
+    if not text:
+        return 0
+    wide = sum(1 for char in text if _is_wide(char))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def content_text(content: Any) -> str:
+    """消息内容中的文本（内容块列表只取文本块）"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(
+            block.get("text", "") if isinstance(block, dict) else str(block)
+            for block in content
+            if not isinstance(block, dict) or block.get("type") == "text"
+        )
+    return "" if content is None else str(content)
+
+
+def message_tokens(message: Any) -> int:
+    """估算一条消息的 token 数（内容 + 工具调用参数 + 固定开销）"""
+    tokens = MESSAGE_OVERHEAD + estimate_tokens(content_text(getattr(message, "content", message)))
+    for call in getattr(message, "tool_calls", None) or ():
+        tokens += estimate_tokens(call.get("name", ""))
+        tokens += estimate_tokens(json.dumps(call.get("args", {}), ensure_ascii=False, default=str))
+    return tokens
+
+
+def count_tokens(messages: Iterable[Any]) -> int:
+    """估算消息列表的 token 数"""
+    return sum(message_tokens(message) for message in messages)
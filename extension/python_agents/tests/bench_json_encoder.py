@@ -0,0 +1,98 @@
+"""
+JSON 编码器微基准
+
+对比旧的发送路径（sanitize_for_json 递归清理 + json.dumps）与 codec.encode_json
+在大型嵌套结果上的耗时。
+
+运行: python tests/bench_json_encoder.py [--size-kb 500] [--repeat 20] [--clean]
+
+--clean 生成不含孤立代理字符的负载（常见情况，orjson 不需要回退到标准库）
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from rpc.codec import BACKEND, encode_json, encode_json_stdlib
+from rpc.server import sanitize_for_json
+
+
+def legacy_encode(obj):
+    """旧的发送路径"""
+    return json.dumps(sanitize_for_json(obj), ensure_ascii=False).encode('utf-8')
+
+
+def build_payload(size_kb: int, clean: bool = False) -> dict:
+    """构造类似 Agent 响应的大型嵌套结果（含中文，默认含孤立代理字符）"""
+    paragraph = "这个函数遍历列表并返回排序后的结果。The function sorts items in place. " * 4
+    code_line = "    result = [item for item in items if item is not None]  # 过滤空值\n"
+
+    messages = []
+    size = 0
+    i = 0
+    while size < size_kb * 1024:
+        text = paragraph + ("\ud800" if i % 50 == 0 and not clean else "")
+        messages.append({
+            "role": "assistant" if i % 2 else "tool",
+            "content": text,
+            "code": code_line * 8,
+            "metadata": {"index": i, "tokens": len(text) // 4, "tags": ["explain", "python"]},
+        })
+        size += len(text.encode('utf-8', errors='ignore')) + len(code_line) * 8
+        i += 1
+
+    return {
+        "jsonrpc": "2.0",
+        "id": 1,
+        "result": {
+            "full_response": paragraph * 100,
+            "messages": messages,
+        },
+    }
+
+
+def bench(func, obj, repeat: int) -> float:
+    """返回最快一次的耗时（毫秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(obj)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JSON encoders")
+    parser.add_argument("--size-kb", type=int, default=500, help="approximate payload size")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per encoder")
+    parser.add_argument("--clean", action="store_true", help="payload without lone surrogates")
+    args = parser.parse_args()
+
+    payload = build_payload(args.size_kb, args.clean)
+    expected = json.loads(legacy_encode(payload))
+
+    candidates = [
+        ("legacy (sanitize + json.dumps)", legacy_encode),
+        ("encode_json_stdlib", encode_json_stdlib),
+    ]
+    if BACKEND != "json":
+        candidates.append((f"encode_json ({BACKEND})", encode_json))
+
+    print(f"Payload: ~{len(legacy_encode(payload)) // 1024} KB, best of {args.repeat} runs")
+    print("-" * 60)
+
+    baseline = None
+    for name, func in candidates:
+        # 所有编码器的输出必须等价
+        assert json.loads(func(payload)) == expected, f"{name} produced different output"
+        elapsed = bench(func, payload, args.repeat)
+        baseline = baseline or elapsed
+        print(f"{name:<36} {elapsed:8.2f} ms  {baseline / elapsed:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,492 @@
+"""
+测试 AgentServer（使用按脚本回复的模型，不访问网络）
+
+需要 deepagents: python tests/test_agent_server.py
+"""
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+
+import pytest
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+import utils.llm_client as llm_client
+import agent_server
+from agent_server import AgentServer
+from config.settings import reset_settings
+from rpc import AgentError, InvalidParams
+from rpc import TimeoutError as AgentTimeoutError
+from rpc.connection import Connection
+from rpc.context import RequestContext, _current_request
+from utils.tokens import estimate_tokens
+
+
+# 模型名称 -> 待回复的消息；脚本用完后回复 "answer from <模型名称>"
+_SCRIPTS = {}
+# 每次模型调用的 (模型名称, 调用参数)
+_CALLS = []
+# 模型名称 -> Event：创建该模型的客户端时等待，模拟较慢的客户端创建
+_BLOCK = {}
+
+
+class _ScriptedModel(BaseChatModel):
+    """按 _SCRIPTS 中的脚本回复的聊天模型"""
+
+    model_name: str
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        # 与 ChatOpenAI 一样，其余参数（如 timeout）在调用时传给模型
+        return self.bind(**kwargs)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        _CALLS.append((self.model_name, kwargs))
+        script = _SCRIPTS.get(self.model_name)
+        message = script.popleft() if script else AIMessage(content=f"answer from {self.model_name}")
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def _initialize_client(self):
+    if self.config.model in _BLOCK:
+        _BLOCK[self.config.model].wait(10)
+    self._client = _ScriptedModel(model_name=self.config.model)
+
+
+def _isolate(monkeypatch):
+    """测试专用的环境变量和按脚本回复的模型；客户端缓存和全局配置只在本测试内有效"""
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "test-key")
+    monkeypatch.setenv("CACHE_DIR", tempfile.mkdtemp(prefix="agent-server-test-"))
+    monkeypatch.setenv("AGENT_ENABLE_CACHE", "false")
+    monkeypatch.setenv("LOG_LEVEL", "WARNING")
+    monkeypatch.setattr(llm_client.LLMClient, "_initialize_client", _initialize_client)
+    monkeypatch.setattr(llm_client, "_clients", OrderedDict())
+    monkeypatch.setattr(llm_client, "_global_client", None)
+    reset_settings()
+
+
+@pytest.fixture(autouse=True)
+def _scripted_environment(monkeypatch):
+    _isolate(monkeypatch)
+    yield
+    reset_settings()
+
+
+def _server():
+    """创建服务器并等待后台初始化完成，通知记录在 server.notifications 中"""
+    server = AgentServer(tempfile.mkdtemp(prefix="workspace-"))
+    server.notifications = []
+    lock = threading.Lock()
+
+    def send_notification(method, params, connection=None):
+        with lock:
+            server.notifications.append((method, params))
+
+    server.rpc_server.send_notification = send_notification
+    server._ready.result(timeout=120)
+    return server
+
+
+def _tool_call(name, args, call_id):
+    return AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": call_id}])
+
+
+def test_chat_progress_notifications():
+    """工具调用以 chat.progress 通知发出，带 conversationId，工具耗时计入统计"""
+    server = _server()
+    _SCRIPTS[server.settings.llm_model] = deque([
+        _tool_call("ls", {"path": "/"}, "c1"),
+        _tool_call("glob", {"pattern": "*.py"}, "c2"),
+        AIMessage(content="done"),
+    ])
+
+    result = server.chat({"message": "explore", "conversation_id": "progress"})
+    assert result["full_response"] == "done"
+
+    progress = [params for method, params in server.notifications if method == "chat.progress"]
+    assert all(params["conversationId"] == "progress" for params in progress)
+    assert [(params["type"], params["tool"]) for params in progress] == [
+        ("tool_start", "ls"), ("tool_end", "ls"),
+        ("tool_start", "glob"), ("tool_end", "glob"),
+    ]
+    assert progress[0]["args"] == {"path": "/"} and progress[0]["runId"] == progress[1]["runId"]
+    assert set(server._tool_stats()) >= {"ls", "glob"}
+
+
+def test_chat_timeout_bounds_model_calls():
+    """请求的 timeout 同时限制每次模型调用的 HTTP 超时（不只在图的步骤之间检查）"""
+    server = _server()
+    _CALLS.clear()
+    server.chat({"message": "hi", "conversation_id": "timeout", "timeout": 5})
+    assert _CALLS and all(0 < kwargs["timeout"] <= 5 for _, kwargs in _CALLS)
+
+    _CALLS.clear()
+    server.chat({"message": "hi", "conversation_id": "timeout"})
+    assert all(kwargs["timeout"] <= server.settings.agent_timeout for _, kwargs in _CALLS)
+
+
+def _messages(server, conversation_id):
+    state = server.unified_agent.get_state({"configurable": {"thread_id": conversation_id}})
+    return state.values.get("messages", [])
+
+
+def test_switch_model_keeps_agent_and_history():
+    """切换默认模型不重建 agent，checkpointer 和对话历史保留，下一次运行使用新模型"""
+    server = _server()
+    default = server.settings.llm_model
+    agent, checkpointer = server.unified_agent, server.checkpointer
+    try:
+        assert server.chat({"message": "q1", "conversation_id": "swap"})["full_response"] == f"answer from {default}"
+
+        result = server.switch_model({"model": "swapped-model"})
+        assert result["old_model"] == default and result["new_model"] == "swapped-model"
+        assert server.chat({"message": "q2", "conversation_id": "swap"})["full_response"] == "answer from swapped-model"
+
+        assert server.unified_agent is agent and server.checkpointer is checkpointer
+        assert [m.content for m in _messages(server, "swap")] == [
+            "q1", f"answer from {default}", "q2", "answer from swapped-model"
+        ]
+    finally:
+        server.switch_model({"model": default})
+
+
+def test_conversation_model_cleared_with_thread():
+    """单独为会话切换的模型只影响该会话，会话删除后一并清除"""
+    server = _server()
+    default = server.settings.llm_model
+    server.switch_model({"model": "own-model", "conversation_id": "own"})
+    assert server.chat({"message": "hi", "conversation_id": "own"})["full_response"] == "answer from own-model"
+    assert server.chat({"message": "hi", "conversation_id": "other"})["full_response"] == f"answer from {default}"
+
+    server.checkpointer.delete_thread("own")
+    assert "own" not in server._conversation_models
+    assert server.chat({"message": "hi", "conversation_id": "own"})["full_response"] == f"answer from {default}"
+
+
+def test_llm_client_cache():
+    """客户端按完整配置缓存（包括密钥和超时）且数量有上限，较慢的客户端创建不阻塞其他模型"""
+    config = llm_client.LLMConfig(model="cached", api_key="k1", timeout=10)
+    client = llm_client.get_llm_client(config)
+    assert llm_client.get_llm_client(llm_client.LLMConfig(model="cached", api_key="k1", timeout=10)) is client
+    assert llm_client.get_llm_client(llm_client.LLMConfig(model="cached", api_key="k2", timeout=10)) is not client
+    assert llm_client.get_llm_client(llm_client.LLMConfig(model="cached", api_key="k1", timeout=20)) is not client
+
+    # 缓存有上限：保留最近使用的客户端，丢弃最久未用的
+    llm_client.get_llm_client(config)
+    for i in range(llm_client.MAX_CACHED_CLIENTS):
+        llm_client.get_llm_client(llm_client.LLMConfig(model=f"rotated-{i}"))
+    assert len(llm_client._clients) == llm_client.MAX_CACHED_CLIENTS
+    assert llm_client.get_llm_client(config) is not client
+
+    _BLOCK["slow-model"] = threading.Event()
+    slow = threading.Thread(target=llm_client.get_llm_client, args=(llm_client.LLMConfig(model="slow-model"),))
+    slow.start()
+    try:
+        fast = threading.Thread(target=llm_client.get_llm_client, args=(llm_client.LLMConfig(model="fast-model"),))
+        fast.start()
+        fast.join(5)
+        assert not fast.is_alive(), "creating a client was blocked by another client's construction"
+    finally:
+        _BLOCK.pop("slow-model").set()
+        slow.join(5)
+
+
+def _patched_get_llm_client(before):
+    """替换 agent_server 使用的 get_llm_client：先调用 before(config) 再创建客户端，返回恢复函数"""
+    original = agent_server.get_llm_client
+
+    def get_llm_client(config=None):
+        before(config)
+        return original(config)
+
+    agent_server.get_llm_client = get_llm_client
+    return lambda: setattr(agent_server, "get_llm_client", original)
+
+
+def test_request_waits_for_initialization():
+    """初始化完成前到达的请求等待初始化完成后执行；超过请求的 timeout 仍未完成时返回超时错误"""
+    release = threading.Event()
+    restore = _patched_get_llm_client(lambda config: release.wait(10))
+    try:
+        server = AgentServer(tempfile.mkdtemp(prefix="workspace-"))
+        assert server.health_check({})["init"]["ready"] is False
+
+        try:
+            server.chat({"message": "hi", "conversation_id": "early", "timeout": 0.2})
+            assert False, "request should time out while the agent is initializing"
+        except AgentTimeoutError as e:
+            assert e.data["phase"] == "llm_client"
+
+        results = []
+        waiting = threading.Thread(
+            target=lambda: results.append(server.chat({"message": "hi", "conversation_id": "early"}))
+        )
+        waiting.start()
+        waiting.join(0.3)
+        assert waiting.is_alive() and not results
+
+        release.set()
+        waiting.join(30)
+        assert results and results[0]["full_response"] == f"answer from {server.settings.llm_model}"
+        assert server.health_check({})["init"]["ready"] is True
+    finally:
+        release.set()
+        restore()
+
+
+def test_initialization_failure_reported_to_requests():
+    """后台初始化失败时，等待中和之后的请求都收到初始化错误，health_check 报告失败"""
+    started = threading.Event()
+
+    def fail(config):
+        started.set()
+        time.sleep(0.2)
+        raise RuntimeError("missing api key")
+
+    restore = _patched_get_llm_client(fail)
+    try:
+        server = AgentServer(tempfile.mkdtemp(prefix="workspace-"))
+        started.wait(10)
+        for _ in range(2):
+            try:
+                server.chat({"message": "hi", "conversation_id": "broken"})
+                assert False, "request should fail when initialization failed"
+            except AgentError as e:
+                assert "initialization failed" in e.message and "missing api key" in e.message
+
+        init = server.health_check({})["init"]
+        assert init["phase"] == "failed" and init["ready"] is False
+    finally:
+        restore()
+
+
+def test_prewarm_failure_does_not_abort_startup():
+    """预热失败只记录在 health_check 中，服务器正常就绪并处理请求"""
+    original = llm_client.LLMClient.warm_up
+
+    def warm_up(self):
+        raise ConnectionError("network unreachable")
+
+    llm_client.LLMClient.warm_up = warm_up
+    try:
+        server = _server()
+        model = server.settings.llm_model
+        deadline = time.monotonic() + 10
+        while server._prewarm_status.get(model, {}).get("state") in (None, "warming") and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        health = server.health_check({})
+        assert health["init"]["ready"] is True
+        assert health["models"][model]["state"] == "failed"
+        assert "network unreachable" in health["models"][model]["error"]
+        assert server.chat({"message": "hi", "conversation_id": "prewarm"})["full_response"] == f"answer from {model}"
+    finally:
+        llm_client.LLMClient.warm_up = original
+
+
+def test_warm_up_connection_errors():
+    """warm_up 只在无法建立连接时返回 False；HTTP 错误响应（如 401）说明连接已建立"""
+    class _Models:
+        def __init__(self, error):
+            self.error = error
+
+        def list(self):
+            if self.error is not None:
+                raise self.error
+
+    class _HTTPError(Exception):
+        status_code = 401
+
+    client = llm_client.LLMClient(llm_client.LLMConfig(model="warm-up"))
+    assert client.warm_up() is False  # 没有 root_client 的模型
+
+    for error, connected in ((None, True), (_HTTPError("unauthorized"), True), (ConnectionError("refused"), False)):
+        client._client = type("_Chat", (), {"root_client": type("_Root", (), {"models": _Models(error)})()})()
+        assert client.warm_up() is connected
+
+
+def test_chat_context_within_budget():
+    """chat 的编辑器上下文在预算内组装后放在消息前面：大文件只放入光标所在的函数，工作区外的文件不读取"""
+    server = _server()
+    budget = server.settings.agent_context_max_tokens
+    server.settings.agent_context_max_tokens = 300
+    try:
+        body = "\n".join(f"def helper_{i}(value):\n    return value * {i}\n" for i in range(400))
+        with open(os.path.join(server.workspace_root, "big.py"), "w", encoding="utf-8") as f:
+            f.write(body + "\ndef target(x):\n    return helper_3(x) + 1\n")
+        line = body.count("\n") + 2   # target 的函数体（0-based）
+
+        server.chat({
+            "message": "what does this do?",
+            "conversation_id": "context",
+            "context": {"currentFile": "big.py", "cursorPosition": {"line": line, "column": 4}, "language": "python"},
+        })
+        message = _messages(server, "context")[0].content
+        assert message.startswith("## ") and message.endswith("what does this do?")
+        assert "## Current File: big.py" in message and "## Enclosing Function: target" in message
+        assert "helper_100" not in message
+        assert estimate_tokens(message) <= 300 + estimate_tokens("what does this do?") + 10
+
+        with open(os.path.join(os.path.dirname(server.workspace_root), "outside.py"), "w", encoding="utf-8") as f:
+            f.write("SECRET = 1\n")
+        server.chat({
+            "message": "explain",
+            "conversation_id": "outside",
+            "context": {"currentFile": "../outside.py", "selectedCode": "print(1)", "cursorPosition": {"line": 0}},
+        })
+        message = _messages(server, "outside")[0].content
+        assert "print(1)" in message and "SECRET" not in message and "outside.py" not in message
+
+        server.chat({"message": "plain", "conversation_id": "no-context", "context": {}})
+        assert _messages(server, "no-context")[0].content == "plain"
+    finally:
+        server.settings.agent_context_max_tokens = budget
+
+
+def test_snapshots_are_read_only_and_pinned():
+    """快照固定在 checkpointer 中，不能在快照上 chat，只能从快照分出新会话继续"""
+    server = _server()
+    server.chat({"message": "q1", "conversation_id": "snapshot-source"})
+    snapshot_id = server.snapshot_conversation({"conversation_id": "snapshot-source"})["snapshotId"]
+    assert server.checkpointer.is_pinned(snapshot_id)
+
+    try:
+        server.chat({"message": "q2", "conversation_id": snapshot_id})
+        assert False, "chat on a snapshot should be rejected"
+    except InvalidParams as e:
+        assert "read-only snapshot" in e.message
+    assert len(_messages(server, snapshot_id)) == 2
+
+    fork_id = server.fork_conversation({"snapshot_id": snapshot_id})["conversationId"]
+    server.chat({"message": "q2", "conversation_id": fork_id})
+    assert len(_messages(server, fork_id)) == 4 and len(_messages(server, snapshot_id)) == 2
+    assert not server.checkpointer.is_pinned(fork_id)
+
+
+def test_daemon_thread_id_uses_client_id():
+    """守护进程模式下按客户端提供的 clientId 区分会话，与连接编号无关；未提供时使用会话 ID"""
+    server = _server()
+    server.socket_path = "/tmp/agent-server-test.sock"
+
+    def thread_id(connection):
+        token = _current_request.set(RequestContext(id=1, method="chat", connection=connection))
+        try:
+            return server._thread_id("c1")
+        finally:
+            _current_request.reset(token)
+
+    first, second, reconnected = (Connection(None, io.BytesIO()) for _ in range(3))
+    first.client_id = reconnected.client_id = "workspace-a"
+    second.client_id = "workspace-b"
+
+    assert thread_id(first) == thread_id(reconnected) == "client-workspace-a:c1"
+    assert thread_id(second) == "client-workspace-b:c1"
+    assert thread_id(Connection(None, io.BytesIO())) == "c1"
+
+
+def _agent_on(checkpointer):
+    from agents.unified_agent import create_unified_chat_agent
+    return create_unified_chat_agent(_ScriptedModel(model_name="history-model"), checkpointer=checkpointer)
+
+
+def _history(agent, thread_id):
+    return agent.get_state({"configurable": {"thread_id": thread_id}}).values.get("messages", [])
+
+
+def _long_conversation(checkpointer, thread_id, turns=30):
+    agent = _agent_on(checkpointer)
+    for turn in range(turns):
+        agent.invoke({"messages": [{"role": "user", "content": f"q{turn}"}]}, {"configurable": {"thread_id": thread_id}})
+    return agent, [m.content for m in _history(agent, thread_id)]
+
+
+def test_compaction_keeps_agent_history():
+    """
+    压缩真实 agent 对话的检查点后历史不变
+
+    新版 deepagents 的 messages 是 DeltaChannel（每 50 次更新保存一次完整值，其余由祖先重放），
+    压缩只能删除最近的完整值之前的检查点
+    """
+    from agents import SqliteCheckpointer
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "conversations.sqlite3")
+        checkpointer = SqliteCheckpointer(path, keep_checkpoints=3, compact_interval=0)
+        agent, before = _long_conversation(checkpointer, "long")
+        assert len(before) == 60
+
+        assert checkpointer.compact() > 0
+        assert [m.content for m in _history(agent, "long")] == before
+        checkpointer.close()
+
+        reopened = SqliteCheckpointer(path, keep_checkpoints=3, compact_interval=0)
+        assert [m.content for m in _history(_agent_on(reopened), "long")] == before
+        reopened.close()
+
+
+def test_fork_after_compaction_keeps_agent_history():
+    """压缩后的 agent 对话分出的快照和分叉（包括回退一轮）带有完整的消息历史，重启后仍然完整"""
+    from agents import SqliteCheckpointer
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "conversations.sqlite3")
+        checkpointer = SqliteCheckpointer(path, keep_checkpoints=3, compact_interval=0)
+        agent, before = _long_conversation(checkpointer, "long")
+        assert checkpointer.compact() > 0
+
+        checkpointer.fork_thread("long", "snap", pin=True)
+        last_turn = next(c for c in checkpointer.list_checkpoints("long") if c["source"] == "input")
+        checkpointer.fork_thread("long", "retry", last_turn["parent_id"])
+        assert [m.content for m in _history(agent, "snap")] == before
+        assert [m.content for m in _history(agent, "retry")] == before[:-2]
+        checkpointer.close()
+
+        reopened = SqliteCheckpointer(path, keep_checkpoints=3, compact_interval=0)
+        reopened.delete_thread("long")
+        assert [m.content for m in _history(_agent_on(reopened), "snap")] == before
+        reopened.close()
+
+
+if __name__ == "__main__":
+    tests = [
+        test_chat_progress_notifications,
+        test_chat_timeout_bounds_model_calls,
+        test_switch_model_keeps_agent_and_history,
+        test_conversation_model_cleared_with_thread,
+        test_llm_client_cache,
+        test_request_waits_for_initialization,
+        test_initialization_failure_reported_to_requests,
+        test_prewarm_failure_does_not_abort_startup,
+        test_warm_up_connection_errors,
+        test_chat_context_within_budget,
+        test_snapshots_are_read_only_and_pinned,
+        test_daemon_thread_id_uses_client_id,
+        test_compaction_keeps_agent_history,
+        test_fork_after_compaction_keeps_agent_history,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            with pytest.MonkeyPatch.context() as monkeypatch:
+                _isolate(monkeypatch)
+                test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
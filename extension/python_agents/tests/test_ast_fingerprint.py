@@ -0,0 +1,93 @@
+"""
+测试代码指纹（格式和注释不影响指纹，函数级子指纹，非 Python 代码的文本退化）
+
+只依赖标准库，可直接运行: python tests/test_ast_fingerprint.py
+"""
+import os
+import sys
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from tools import ASTTools
+
+ORIGINAL = '''
+class Parser:
+    def parse(self, text):
+        """Parse text."""
+        # split into tokens
+        tokens = text.split()
+        return [t.lower() for t in tokens]
+
+    def reset(self):
+        self.state = None
+'''
+
+REFORMATTED = '''class Parser:
+  def parse(self, text):   # entry point
+    tokens = text.split( )
+
+    return [ t.lower()  for t in tokens ]
+  def reset(self):
+    self.state = None
+'''
+
+
+def test_formatting_and_comments_are_ignored():
+    """缩进、空白和注释不影响指纹；去掉文档字符串后，文档字符串的差异也不影响"""
+    tools = ASTTools()
+    original = tools.fingerprint(ORIGINAL, strip_docstrings=True)
+    assert original.kind == "ast"
+    assert original.digest == tools.fingerprint(REFORMATTED, strip_docstrings=True).digest
+    assert tools.fingerprint(ORIGINAL).digest != tools.fingerprint(REFORMATTED).digest
+
+    changed = ORIGINAL.replace("t.lower()", "t.upper()")
+    assert tools.fingerprint(changed, strip_docstrings=True).digest != original.digest
+
+
+def test_function_fingerprints():
+    """只有修改过的函数子指纹变化；选中带缩进的方法也能解析"""
+    tools = ASTTools()
+    original = tools.fingerprint(ORIGINAL, strip_docstrings=True)
+    assert set(original.functions) == {"Parser.parse", "Parser.reset"}
+
+    changed = tools.fingerprint(ORIGINAL.replace("self.state = None", "self.state = {}"), strip_docstrings=True)
+    assert changed.functions["Parser.parse"] == original.functions["Parser.parse"]
+    assert changed.functions["Parser.reset"] != original.functions["Parser.reset"]
+
+    method = "    def reset(self):\n        self.state = None\n"
+    selected = tools.fingerprint(method)
+    assert selected.kind == "ast"
+    assert selected.functions["reset"] == original.functions["Parser.reset"]
+
+
+def test_text_fallback():
+    """非 Python 代码和无法解析的片段按规范化文本计算"""
+    tools = ASTTools()
+    js = tools.fingerprint("  function f() {\r\n    return 1;   \r\n  }\n\n", language="javascript")
+    assert js.kind == "text" and js.digest.startswith("text:")
+    assert js.digest == tools.fingerprint("function f() {\n  return 1;\n}", language="javascript").digest
+    assert js.digest != tools.fingerprint("function f() {\n  return 2;\n}", language="javascript").digest
+
+    partial = tools.fingerprint("if x:\n    return (", language="python")
+    assert partial.kind == "text" and partial.functions == {}
+
+
+if __name__ == "__main__":
+    tests = [
+        test_formatting_and_comments_are_ignored,
+        test_function_fingerprints,
+        test_text_fallback,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,371 @@
+"""
+测试对话存储（LRU 淘汰、溢出到磁盘和加载、大小统计、SQLite 持久化和压缩、分叉）
+
+需要 langgraph: python tests/test_checkpointer.py
+"""
+import os
+import sys
+import tempfile
+import threading
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from langgraph.checkpoint.base import empty_checkpoint
+from langgraph.checkpoint.memory import InMemorySaver
+
+from agents.checkpointer import BoundedMemorySaver, SqliteCheckpointer
+
+
+def _save(saver, thread_id, text, parent=None):
+    """
+    为对话写入一个检查点，通道值为 text；parent 为父检查点的配置
+
+    text 为 None 时模拟 DeltaChannel：检查点不保存通道值（"empty"），只有待写入记录
+    """
+    checkpoint = empty_checkpoint()
+    checkpoint["channel_values"] = {"messages": text} if text is not None else {}
+    checkpoint["channel_versions"] = {"messages": checkpoint["id"]}
+    config = parent or {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}}
+    saved = saver.put(config, checkpoint, {}, {"messages": checkpoint["id"]})
+    saver.put_writes(saved, [("messages", text or "delta")], task_id="task")
+    return saved
+
+
+def _load(saver, thread_id):
+    result = saver.get_tuple({"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}})
+    return result.checkpoint["channel_values"].get("messages") if result else None
+
+
+def _save_chain(saver, thread_id, texts):
+    """写入一串父子相连的检查点，返回各检查点的 id"""
+    parent = None
+    for text in texts:
+        parent = _save(saver, thread_id, text, parent)
+        yield parent["configurable"]["checkpoint_id"]
+
+
+def test_evicts_least_recently_used_thread():
+    """超过对话数上限时丢弃最久未使用的对话"""
+    saver = BoundedMemorySaver(max_threads=2)
+    _save(saver, "a", "hello a")
+    _save(saver, "b", "hello b")
+    assert _load(saver, "a") == "hello a"   # a 变为最近使用
+    _save(saver, "c", "hello c")
+
+    assert _load(saver, "b") is None
+    assert _load(saver, "a") == "hello a" and _load(saver, "c") == "hello c"
+    stats = saver.get_stats()
+    assert stats["threads"] == 2 and stats["dropped"] == 1
+
+
+def test_byte_limit_and_accounting():
+    """按字节数淘汰，正在写入的对话即使超限也保留；删除对话后大小归零"""
+    saver = BoundedMemorySaver(max_threads=0, max_bytes=5000)
+    _save(saver, "small", "x" * 100)
+    size = saver.get_stats()["largest"]["small"]
+    # 检查点本身、通道值和待写入记录都计入
+    assert size > 200
+
+    _save(saver, "big", "y" * 8000)
+    stats = saver.get_stats()
+    assert list(stats["largest"]) == ["big"] and stats["bytes"] > 8000
+    assert _load(saver, "big") == "y" * 8000
+
+    saver.delete_thread("big")
+    stats = saver.get_stats()
+    assert stats["threads"] == 0 and stats["bytes"] == 0
+
+
+def test_spill_and_restore():
+    """溢出到磁盘的对话再次访问时恢复，大小统计不变"""
+    with tempfile.TemporaryDirectory() as directory:
+        saver = BoundedMemorySaver(max_threads=1, spill_dir=directory)
+        _save(saver, "a", "first")
+        size = saver.get_stats()["bytes"]
+        _save(saver, "b", "second")
+
+        stats = saver.get_stats()
+        assert stats["spilled_threads"] == 1 and stats["spilled_bytes"] == size
+        assert "a" not in saver.storage
+
+        assert _load(saver, "a") == "first"
+        history = list(saver.list({"configurable": {"thread_id": "a"}}))
+        assert len(history) == 1 and history[0].pending_writes[0][2] == "first"
+
+        stats = saver.get_stats()
+        assert stats["restored"] == 1 and stats["largest"] == {"a": size}
+        assert stats["spilled_threads"] == 1   # b 被换出
+
+        saver.delete_thread("b")
+        assert saver.get_stats()["spilled_threads"] == 0
+        assert _load(saver, "b") is None
+
+
+def test_sqlite_persists_and_loads_lazily():
+    """重新打开数据库后不加载任何对话，访问时才加载；大值压缩后原样读出"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "conversations.sqlite3")
+        saver = SqliteCheckpointer(path, compact_interval=0)
+        _save(saver, "a", "a" * 10000)
+        _save(saver, "b", "hello b")
+        size = saver.get_stats()["largest"]["a"]
+        saver.close()
+
+        saver = SqliteCheckpointer(path, max_threads=1, compact_interval=0)
+        stats = saver.get_stats()
+        assert stats["threads"] == 0 and stats["loaded"] == 0
+        # 压缩后数据库远小于内容
+        assert stats["db_bytes"] < 10000 + 64 * 1024
+
+        assert _load(saver, "a") == "a" * 10000
+        history = list(saver.list({"configurable": {"thread_id": "a"}}))
+        assert history[0].pending_writes[0][2] == "a" * 10000
+        assert saver.get_stats()["largest"] == {"a": size}
+
+        # 超出内存限制时卸载，数据仍在数据库中
+        assert _load(saver, "b") == "hello b"
+        assert "a" not in saver.storage and _load(saver, "a") == "a" * 10000
+        assert saver.get_stats()["loaded"] == 3
+
+        saver.delete_thread("a")
+        assert _load(saver, "a") is None
+        saver.close()
+
+
+def test_sqlite_compaction_keeps_latest_checkpoints():
+    """压缩只保留最新的检查点，删除不再引用的通道值，对话内容不变"""
+    with tempfile.TemporaryDirectory() as directory:
+        saver = SqliteCheckpointer(os.path.join(directory, "c.sqlite3"), keep_checkpoints=2, compact_interval=0)
+        config = None
+        for i in range(5):
+            checkpoint = empty_checkpoint()
+            checkpoint["channel_values"] = {"messages": f"step {i}"}
+            checkpoint["channel_versions"] = {"messages": str(i)}
+            config = saver.put(
+                config or {"configurable": {"thread_id": "t", "checkpoint_ns": ""}},
+                checkpoint, {}, {"messages": str(i)}
+            )
+        _save(saver, "short", "unchanged")
+
+        assert saver.compact() == 3
+        assert saver.get_stats()["pruned_checkpoints"] == 3
+
+        count = saver._conn.execute("SELECT COUNT(*) FROM blobs WHERE thread_id = 't'").fetchone()[0]
+        assert count == 2
+        assert len(list(saver.list({"configurable": {"thread_id": "t"}}))) == 2
+        assert _load(saver, "t") == "step 4" and _load(saver, "short") == "unchanged"
+        saver.close()
+
+
+def test_sqlite_compaction_keeps_delta_ancestors():
+    """压缩保留重建 DeltaChannel 通道值所需的祖先，直到最近保存了完整值的检查点"""
+    with tempfile.TemporaryDirectory() as directory:
+        saver = SqliteCheckpointer(os.path.join(directory, "conversations.sqlite3"), keep_checkpoints=2, compact_interval=0)
+        ids = list(_save_chain(saver, "t", ["full a", None, None, "full b", None, None]))
+        assert saver.compact() == 3
+
+        history = saver.list_checkpoints("t")
+        assert [c["checkpoint_id"] for c in history] == ids[:2:-1]
+        assert history[-1]["parent_id"] is None
+        base = saver.get_tuple({"configurable": {"thread_id": "t", "checkpoint_ns": "", "checkpoint_id": ids[3]}})
+        assert base.checkpoint["channel_values"]["messages"] == "full b"
+        assert saver.compact() == 0
+        saver.close()
+
+
+def test_delta_history_loads_evicted_thread():
+    """读取 DeltaChannel 的历史前先加载已卸载的对话（溢出到磁盘或只在数据库中）"""
+    if not hasattr(InMemorySaver, "get_delta_channel_history"):
+        return  # langgraph-checkpoint 4 之前没有 DeltaChannel
+    with tempfile.TemporaryDirectory() as directory:
+        for saver in (
+            BoundedMemorySaver(max_threads=1, spill_dir=directory),
+            SqliteCheckpointer(os.path.join(directory, "c.sqlite3"), max_threads=1, compact_interval=0),
+        ):
+            list(_save_chain(saver, "a", ["full", None, None]))
+            _save(saver, "b", "other")   # a 被卸载
+            assert "a" not in saver._sizes
+
+            history = saver.get_delta_channel_history(
+                config={"configurable": {"thread_id": "a", "checkpoint_ns": ""}}, channels=["messages"]
+            )["messages"]
+            assert history["seed"] == "full"
+            assert [write[2] for write in history["writes"]] == ["full", "delta"]
+
+
+def test_running_threads_are_not_evicted():
+    """正在运行的对话不被淘汰，运行结束后按 LRU 正常淘汰"""
+    saver = BoundedMemorySaver(max_threads=1)
+    with saver.running("busy"):
+        _save(saver, "busy", "in progress")
+        _save(saver, "other", "hello")
+        assert _load(saver, "busy") == "in progress"
+    _save(saver, "third", "hello")
+    assert _load(saver, "busy") is None
+
+
+def test_sqlite_compaction_defers_running_threads():
+    """有运行中的 agent 的对话不压缩，也不从内存中卸载，留到下一次压缩"""
+    with tempfile.TemporaryDirectory() as directory:
+        saver = SqliteCheckpointer(os.path.join(directory, "c.sqlite3"), keep_checkpoints=2, compact_interval=0)
+        list(_save_chain(saver, "busy", [f"busy {i}" for i in range(5)]))
+        list(_save_chain(saver, "idle", [f"idle {i}" for i in range(5)]))
+
+        with saver.running("busy"):
+            assert saver.compact() == 3
+            assert "busy" in saver._sizes and "idle" not in saver._sizes
+            assert len(saver.list_checkpoints("busy")) == 5
+        assert saver.get_stats()["deferred_compactions"] == 1
+
+        assert saver.compact() == 3
+        assert len(saver.list_checkpoints("busy")) == 2 and _load(saver, "busy") == "busy 4"
+        saver.close()
+
+
+def test_sqlite_compaction_does_not_block_reads():
+    """压缩在单独的连接上执行，不持有内存缓存的锁：压缩期间其他对话照常读取（包括从数据库加载）"""
+    with tempfile.TemporaryDirectory() as directory:
+        saver = SqliteCheckpointer(os.path.join(directory, "c.sqlite3"), max_threads=1, keep_checkpoints=2, compact_interval=0)
+        list(_save_chain(saver, "long", [f"step {i}" for i in range(5)]))
+        _save(saver, "cached", "in memory")
+        _save(saver, "stored", "in database")   # cached 被卸载，只在数据库中
+
+        compacting, release = threading.Event(), threading.Event()
+        compact_thread = saver._compact_thread
+
+        def slow_compact_thread(conn, thread_id, checkpoint_ns):
+            compacting.set()
+            release.wait(10)
+            return compact_thread(conn, thread_id, checkpoint_ns)
+
+        saver._compact_thread = slow_compact_thread
+        pruned = []
+        worker = threading.Thread(target=lambda: pruned.append(saver.compact()))
+        worker.start()
+        try:
+            assert compacting.wait(10)
+            assert _load(saver, "cached") == "in memory" and _load(saver, "stored") == "in database"
+        finally:
+            release.set()
+            worker.join(10)
+        assert pruned == [3]
+        saver.close()
+
+
+def test_fork_shares_checkpoint_chain():
+    """分叉复制分叉点及其祖先链，序列化数据与源对话共用，之后各自独立"""
+    saver = BoundedMemorySaver(max_threads=0)
+    first, middle, last = _save_chain(saver, "src", ["one", "two", "three"])
+
+    history = saver.list_checkpoints("src")
+    assert [c["checkpoint_id"] for c in history] == [last, middle, first]
+    assert history[0]["parent_id"] == middle and history[-1]["parent_id"] is None
+
+    assert saver.fork_thread("src", "fork", middle) == [middle, first]
+    assert _load(saver, "fork") == "two"
+    assert [c["checkpoint_id"] for c in saver.list_checkpoints("fork")] == [middle, first]
+    assert saver.storage["fork"][""][middle][0][1] is saver.storage["src"][""][middle][0][1]
+    assert saver.writes[("fork", "", first)] == saver.writes[("src", "", first)]
+
+    # 新对话的写入不影响源对话
+    _save(saver, "fork", "two bis", {"configurable": {"thread_id": "fork", "checkpoint_ns": "", "checkpoint_id": middle}})
+    assert _load(saver, "fork") == "two bis" and _load(saver, "src") == "three"
+    assert saver.get_stats()["largest"]["fork"] > 0
+
+    for args, error in [(("missing", "x"), KeyError), (("src", "y", "nope"), KeyError), (("src", "fork"), ValueError)]:
+        try:
+            saver.fork_thread(*args)
+            assert False, f"{args} should fail"
+        except error:
+            pass
+
+
+def test_sqlite_fork_persists():
+    """SQLite 中分叉按行复制（不解压），重新打开后新对话的祖先链完整，删除源对话不影响新对话"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "conversations.sqlite3")
+        saver = SqliteCheckpointer(path, compact_interval=0)
+        first, middle, _ = _save_chain(saver, "src", ["one", "two" * 1000, "three"])
+        saver.fork_thread("src", "fork")
+        saver.close()
+
+        saver = SqliteCheckpointer(path, compact_interval=0)
+        assert _load(saver, "fork") == "three"
+        history = saver.list_checkpoints("fork")
+        assert len(history) == 3 and history[-1]["checkpoint_id"] == first
+        forked = saver.get_tuple({"configurable": {"thread_id": "fork", "checkpoint_ns": "", "checkpoint_id": middle}})
+        assert forked.checkpoint["channel_values"]["messages"] == "two" * 1000
+        assert forked.pending_writes[0][2] == "two" * 1000
+
+        saver.delete_thread("src")
+        assert _load(saver, "fork") == "three"
+        saver.close()
+
+
+def test_pinned_threads_are_not_evicted():
+    """固定的对话（快照）不被淘汰，删除后解除固定"""
+    saver = BoundedMemorySaver(max_threads=1)
+    _save(saver, "src", "frozen")
+    saver.fork_thread("src", "snap", pin=True)
+    _save(saver, "a", "hello a")
+    _save(saver, "b", "hello b")
+    assert _load(saver, "snap") == "frozen" and _load(saver, "src") is None
+
+    saver.delete_thread("snap")
+    _save(saver, "snap", "reused")
+    _save(saver, "c", "hello c")
+    assert _load(saver, "snap") is None
+
+
+def test_sqlite_pinned_threads_survive_compaction_and_restart():
+    """SQLite 中固定的对话重启后仍不被压缩，但可以从内存中卸载"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "conversations.sqlite3")
+        saver = SqliteCheckpointer(path, max_threads=1, keep_checkpoints=2, compact_interval=0)
+        list(_save_chain(saver, "src", [f"step {i}" for i in range(5)]))
+        saver.fork_thread("src", "snap", pin=True)
+        _save(saver, "other", "hello")
+        assert "snap" not in saver._sizes
+        saver.close()
+
+        saver = SqliteCheckpointer(path, max_threads=1, keep_checkpoints=2, compact_interval=0)
+        assert saver.is_pinned("snap") and not saver.is_pinned("src")
+        assert saver.compact() == 3
+        assert len(saver.list_checkpoints("snap")) == 5 and len(saver.list_checkpoints("src")) == 2
+
+        saver.delete_thread("snap")
+        assert not saver.is_pinned("snap")
+        assert saver._conn.execute("SELECT COUNT(*) FROM pinned").fetchone()[0] == 0
+        saver.close()
+
+
+if __name__ == "__main__":
+    tests = [
+        test_evicts_least_recently_used_thread,
+        test_byte_limit_and_accounting,
+        test_spill_and_restore,
+        test_sqlite_persists_and_loads_lazily,
+        test_sqlite_compaction_keeps_latest_checkpoints,
+        test_sqlite_compaction_keeps_delta_ancestors,
+        test_delta_history_loads_evicted_thread,
+        test_running_threads_are_not_evicted,
+        test_sqlite_compaction_defers_running_threads,
+        test_sqlite_compaction_does_not_block_reads,
+        test_fork_shares_checkpoint_chain,
+        test_sqlite_fork_persists,
+        test_pinned_threads_are_not_evicted,
+        test_sqlite_pinned_threads_survive_compaction_and_restart,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
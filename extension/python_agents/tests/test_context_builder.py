@@ -0,0 +1,102 @@
+"""
+测试上下文组装（token 预算、按价值选择、截断和覆盖关系）
+
+可直接运行: python tests/test_context_builder.py
+"""
+import os
+import sys
+import tempfile
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from utils.context_builder import ContextBuilder
+
+
+def _workspace(function_count):
+    """创建包含一个 Python 文件的工作区，每个函数 5 行"""
+    root = tempfile.mkdtemp()
+    lines = []
+    for i in range(function_count):
+        lines += [f"def function_{i}(value):", f"    '''function number {i}'''", f"    result = value * {i}",
+                  "    return result", ""]
+    with open(os.path.join(root, "big.py"), "w") as f:
+        f.write("\n".join(lines))
+    return ContextBuilder(root)
+
+
+def _sections(assembled):
+    return {section["name"]: section for section in assembled["sections"]}
+
+
+def test_large_file_fits_budget():
+    """5000 行的文件：结果不超过预算，选中的代码和所在函数优先，整个文件被截断"""
+    builder = _workspace(1000)
+    context = builder.build_context(
+        current_file="big.py",
+        selected_code="result = value * 500",
+        cursor_position={"line": 2503, "column": 4}
+    )
+    assert context["enclosing_symbol"]["name"] == "function_500"
+
+    assembled = builder.assemble_context(context, 600)
+    sections = _sections(assembled)
+    assert assembled["tokens"] <= 600
+    assert sections["selected_code"]["status"] == "included"
+    assert sections["enclosing_symbol"]["status"] == "included"
+    assert sections["file_content"]["status"] in ("truncated", "dropped")
+    assert sections["file_content"]["full_tokens"] > 10000
+    # 截断的文件内容以光标为中心
+    if sections["file_content"]["status"] == "truncated":
+        assert "function_500" in assembled["text"] and "lines omitted" in assembled["text"]
+    assert "function_0(" not in assembled["text"]
+
+
+def test_small_file_covers_surrounding_code():
+    """预算足够放入整个文件时，光标周围的代码和所在函数不再重复"""
+    builder = _workspace(5)
+    context = builder.build_context(current_file="big.py", cursor_position={"line": 8, "column": 0})
+    assembled = builder.assemble_context(context, 4000)
+    sections = _sections(assembled)
+
+    assert sections["file_content"]["status"] == "included"
+    assert sections["surrounding_code"]["status"] == "dropped"
+    assert sections["surrounding_code"]["reason"] == "covered by file_content"
+    assert sections["enclosing_symbol"]["status"] == "dropped"
+    assert assembled["text"].count("def function_1(") == 1
+
+
+def test_tiny_budget_drops_sections():
+    """预算太小时代码部分被舍弃，只保留小的元信息；不指定预算时格式不变"""
+    builder = _workspace(50)
+    context = builder.build_context(current_file="big.py", selected_code="x = 1\n" * 400)
+    assembled = builder.assemble_context(context, 40)
+    sections = _sections(assembled)
+
+    assert assembled["tokens"] <= 40
+    assert sections["current_file"]["status"] == "included"
+    assert sections["selected_code"]["status"] == "dropped"
+    assert sections["selected_code"]["reason"] == "over budget"
+
+    assert "## Selected Code:" in builder.format_context_for_prompt(context)
+    assert builder.format_context_for_prompt(context, max_tokens=40) == assembled["text"]
+
+
+if __name__ == "__main__":
+    tests = [
+        test_large_file_fits_budget,
+        test_small_file_covers_surrounding_code,
+        test_tiny_budget_drops_sections,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
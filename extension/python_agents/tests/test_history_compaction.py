@@ -0,0 +1,115 @@
+"""
+测试对话历史压缩（token 估算、截断旧的工具输出、摘要较早的轮次）
+
+需要 langchain: python tests/test_history_compaction.py
+"""
+import os
+import sys
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, ToolMessage
+
+from agents.middleware import HistoryCompactionMiddleware, SUMMARY_MARKER
+from utils.tokens import count_tokens, estimate_tokens
+
+
+class _FailingModel:
+    def invoke(self, messages, config=None):
+        raise ConnectionError("offline")
+
+
+def _turn(i, tool_output="ok"):
+    """一轮对话：用户提问、模型调用工具、工具结果、回答"""
+    return [
+        HumanMessage(content=f"question {i}", id=f"h{i}"),
+        AIMessage(content="", id=f"a{i}", tool_calls=[{"name": "read_file", "args": {"path": f"f{i}.py"}, "id": f"c{i}"}]),
+        ToolMessage(content=tool_output, id=f"t{i}", tool_call_id=f"c{i}", name="read_file"),
+        AIMessage(content=f"answer {i}", id=f"r{i}"),
+    ]
+
+
+def _middleware(model=None, **kwargs):
+    model = model or FakeListChatModel(responses=["the user read files f0..f3"])
+    return HistoryCompactionMiddleware(lambda name: None, model, **kwargs)
+
+
+def test_estimate_tokens():
+    """宽字符每个一个 token，其余约 4 个字符一个 token"""
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd" * 10) == 10
+    assert estimate_tokens("你好世界") == 4
+    assert count_tokens([HumanMessage(content="abcd")]) == 5
+
+
+def test_under_budget_is_untouched():
+    middleware = _middleware(max_tokens=10000)
+    assert middleware.before_model({"messages": _turn(0) + _turn(1)}, None) is None
+
+
+def test_truncates_old_tool_outputs_first():
+    """截断够用时只替换较早轮次的工具结果（同 id），当前轮次保持原样"""
+    middleware = _middleware(max_tokens=1500, keep_tokens=200, tool_output_chars=100)
+    messages = _turn(0, "x" * 8000) + _turn(1, "y" * 200)
+    update = middleware.before_model({"messages": messages}, None)
+
+    replaced = update["messages"]
+    assert [m.id for m in replaced] == ["t0"]
+    assert replaced[0].content.startswith("x" * 100) and "omitted" in replaced[0].content
+    # 已截断的输出不会再次截断
+    assert middleware._truncate(replaced[0]) is replaced[0]
+    assert middleware.get_stats()["truncations"] == 1
+
+
+def test_summarizes_older_turns():
+    """截断不够时把较早的轮次总结为一条摘要，保留完整的最近轮次"""
+    middleware = _middleware(max_tokens=150, keep_tokens=40, tool_output_chars=100)
+    messages = [m for i in range(4) for m in _turn(i, "z" * 400)] + [HumanMessage(content="current", id="now")]
+    before = count_tokens(messages)
+    update = middleware.before_model({"messages": messages}, None)
+
+    new_messages = update["messages"]
+    assert isinstance(new_messages[0], RemoveMessage)
+    summary = new_messages[1]
+    assert summary.additional_kwargs[SUMMARY_MARKER] and "f0..f3" in summary.content
+    # 最近历史从轮次边界开始，工具调用和结果没有被拆开
+    recent = new_messages[2:]
+    assert recent[0].type == "human" and recent[-1].id == "now"
+    assert count_tokens(new_messages[1:]) < before
+
+    stats = middleware.get_stats()
+    assert stats["summaries"] == 1 and stats["tokens_saved"] > 0
+
+
+def test_summary_failure_falls_back_to_truncation():
+    middleware = _middleware(_FailingModel(), max_tokens=150, keep_tokens=40, tool_output_chars=100)
+    messages = [m for i in range(4) for m in _turn(i, "z" * 400)] + [HumanMessage(content="current", id="now")]
+    update = middleware.before_model({"messages": messages}, None)
+
+    assert not any(isinstance(m, RemoveMessage) for m in update["messages"])
+    assert {m.id for m in update["messages"]} == {"t0", "t1", "t2", "t3"}
+    assert middleware.get_stats()["failures"] == 1
+
+
+if __name__ == "__main__":
+    tests = [
+        test_estimate_tokens,
+        test_under_budget_is_untouched,
+        test_truncates_old_tool_outputs_first,
+        test_summarizes_older_turns,
+        test_summary_failure_falls_back_to_truncation,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,161 @@
+"""
+测试模型调用的容错（抖动退避、Retry-After、熔断器、截止时间）
+
+可直接运行: python tests/test_resilience.py
+"""
+import os
+import sys
+import time
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from utils.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+    call_budget,
+    call_with_retry,
+)
+
+
+class _Response:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+class _APIError(Exception):
+    """模拟 SDK 的 HTTP 错误"""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = _Response(headers)
+
+
+def _flaky(errors, result="ok"):
+    """依次抛出 errors 中的异常，之后返回 result"""
+    calls = []
+
+    def fn():
+        calls.append(time.monotonic())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return fn, calls
+
+
+def test_retries_transient_errors():
+    """5xx 和连接错误会重试，4xx 不重试"""
+    policy = RetryPolicy(max_retries=3, base_delay=0.01)
+    fn, calls = _flaky([_APIError(503), ConnectionError("reset")])
+    assert call_with_retry(fn, policy) == "ok"
+    assert len(calls) == 3
+
+    fn, calls = _flaky([_APIError(400)])
+    try:
+        call_with_retry(fn, policy)
+        assert False, "should raise"
+    except _APIError:
+        pass
+    assert len(calls) == 1
+
+    fn, calls = _flaky([_APIError(500)] * 5)
+    try:
+        call_with_retry(fn, policy)
+        assert False, "should raise"
+    except _APIError:
+        pass
+    assert len(calls) == 4
+
+
+def test_delay_jitter_and_retry_after():
+    """退避在 [0, base * 2^n] 内随机，Retry-After 优先且受 max_delay 限制"""
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+    delays = [policy.delay(2) for _ in range(200)]
+    assert all(0 <= d <= 4.0 for d in delays)
+    assert len(set(delays)) > 1
+    assert all(policy.delay(10) <= 5.0 for _ in range(50))
+
+    assert policy.delay(0, _APIError(429, {"retry-after": "2"})) == 2.0
+    assert policy.delay(0, _APIError(429, {"retry-after-ms": "250"})) == 0.25
+    assert policy.delay(0, _APIError(429, {"retry-after": "60"})) == 5.0
+
+
+def test_retry_stops_at_deadline():
+    """等待会越过截止时间时不再重试"""
+    policy = RetryPolicy(max_retries=5)
+    fn, calls = _flaky([_APIError(429, {"retry-after": "3"})] * 5)
+    start = time.monotonic()
+    with call_budget(deadline=time.monotonic() + 1):
+        try:
+            call_with_retry(fn, policy)
+            assert False, "should raise"
+        except _APIError:
+            pass
+    assert len(calls) == 1
+    assert time.monotonic() - start < 0.5
+
+
+def test_circuit_breaker_opens_and_recovers():
+    """连续故障后熔断，冷却后放行一个探测请求，成功即恢复；429 不计入"""
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0.1)
+    policy = RetryPolicy(max_retries=0)
+
+    for _ in range(3):
+        fn, _ = _flaky([_APIError(429)])
+        try:
+            call_with_retry(fn, policy, breaker)
+        except _APIError:
+            pass
+    assert breaker.state == "closed"
+
+    for _ in range(2):
+        fn, _ = _flaky([_APIError(502)])
+        try:
+            call_with_retry(fn, policy, breaker)
+        except _APIError:
+            pass
+    assert breaker.state == "open"
+
+    fn, calls = _flaky([])
+    try:
+        call_with_retry(fn, policy, breaker)
+        assert False, "should raise"
+    except CircuitOpenError as e:
+        assert e.retry_after >= 0
+    assert calls == []
+
+    time.sleep(0.15)
+    assert breaker.state == "half-open"
+    breaker.before_call()
+    try:
+        breaker.before_call()
+        assert False, "only one probe is allowed"
+    except CircuitOpenError:
+        pass
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.get_stats()["opened"] == 1
+
+
+if __name__ == "__main__":
+    tests = [
+        test_retries_transient_errors,
+        test_delay_jitter_and_retry_after,
+        test_retry_stops_at_deadline,
+        test_circuit_breaker_opens_and_recovers,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,136 @@
+"""
+测试响应缓存（键规范化、LRU 和大小淘汰、TTL、磁盘层）
+
+可直接运行: python tests/test_response_cache.py
+"""
+import os
+import sys
+import time
+import tempfile
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from utils.response_cache import ResponseCache, make_key
+
+
+def _key(code, model="qwen-max", temperature=0.7, version="v1", method="explain_code"):
+    return make_key(method, {"code": code, "language": "python"}, model, temperature, version)
+
+
+def test_key_normalization():
+    """行尾空白和换行符差异不影响键，模型、温度、提示版本和方法会影响"""
+    base = _key("def f():\n    return 1\n")
+    assert _key("def f():   \r\n    return 1") == base
+    assert _key("def f():\n    return 2\n") != base
+    assert _key("def f():\n    return 1\n", model="qwen-plus") != base
+    assert _key("def f():\n    return 1\n", temperature=0.2) != base
+    assert _key("def f():\n    return 1\n", version="v2") != base
+    assert _key("def f():\n    return 1\n", method="refactor_code") != base
+
+
+def test_lru_and_size_eviction():
+    """超过条目数时淘汰最久未用的条目，超过字节数时同样淘汰"""
+    cache = ResponseCache(max_entries=2, max_bytes=1000)
+    cache.put("a", {"v": 1})
+    cache.put("b", {"v": 2})
+    assert cache.get("a") == {"v": 1}
+    cache.put("c", {"v": 3})
+    assert cache.get("b") is None
+    assert cache.get("a") == {"v": 1} and cache.get("c") == {"v": 3}
+
+    cache.put("big", {"v": "x" * 600})
+    cache.put("big2", {"v": "y" * 600})
+    assert cache.get("big") is None and cache.get("big2") is not None
+    cache.put("huge", {"v": "z" * 2000})
+    assert cache.get("huge") is None
+
+    stats = cache.get_stats()
+    assert stats["evictions"] >= 3
+    assert stats["bytes"] <= 1000
+    assert stats["hits"] == 4 and stats["misses"] == 3
+
+
+def test_ttl_expiry():
+    """过期的条目视为未命中"""
+    cache = ResponseCache(ttl=0.05)
+    cache.put("a", {"v": 1})
+    assert cache.get("a") == {"v": 1}
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.get_stats()["expired"] == 1
+
+
+def test_disk_tier_survives_restart():
+    """磁盘层在新实例中仍可命中，超过容量时删除最旧的文件"""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ResponseCache(directory=tmp, max_disk_bytes=10000)
+        cache.put("a", {"summary": "代码解释"})
+
+        reopened = ResponseCache(directory=tmp, max_disk_bytes=10000)
+        assert reopened.get("a") == {"summary": "代码解释"}
+        assert reopened.get_stats()["disk_hits"] == 1
+
+        for i in range(10):
+            reopened.put(f"k{i}", {"v": "x" * 2000})
+            time.sleep(0.01)
+        assert reopened.get_stats()["disk_bytes"] <= 10000
+        assert sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp)) <= 10000
+        assert os.path.exists(os.path.join(tmp, "k9.json"))
+
+        # 内存层未启用磁盘时不写文件
+        ResponseCache(directory=tmp, max_disk_bytes=0).put("memory-only", {"v": 1})
+        assert not os.path.exists(os.path.join(tmp, "memory-only.json"))
+
+
+def test_disk_bytes_on_overwrite():
+    """覆盖同一个键的文件时磁盘大小只计入变化，不会提前触发清理"""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ResponseCache(directory=tmp, max_disk_bytes=10000)
+        for i in range(20):
+            cache.put("same", {"v": "x" * 1000, "i": i})
+        size = os.path.getsize(os.path.join(tmp, "same.json"))
+        assert cache.get_stats()["disk_bytes"] == size
+        assert ResponseCache(directory=tmp, max_disk_bytes=10000).get_stats()["disk_bytes"] == size
+
+
+def test_disk_bytes_on_discard():
+    """删除损坏的文件和清空缓存时从磁盘大小中减去删除的文件"""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ResponseCache(directory=tmp, max_disk_bytes=10000)
+        cache.put("kept", {"v": 1})
+        kept = cache.get_stats()["disk_bytes"]
+        with open(os.path.join(tmp, "broken.json"), "wb") as f:
+            f.write(b"{not json")
+        reopened = ResponseCache(directory=tmp, max_disk_bytes=10000)
+        assert reopened.get_stats()["disk_bytes"] == kept + 9
+
+        assert reopened.get("broken") is None
+        assert not os.path.exists(os.path.join(tmp, "broken.json"))
+        assert reopened.get_stats()["disk_bytes"] == kept
+
+        reopened.clear()
+        assert reopened.get_stats()["disk_bytes"] == 0
+
+
+if __name__ == "__main__":
+    tests = [
+        test_key_normalization,
+        test_lru_and_size_eviction,
+        test_ttl_expiry,
+        test_disk_tier_survives_restart,
+        test_disk_bytes_on_overwrite,
+        test_disk_bytes_on_discard,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,95 @@
+"""
+测试 JSON 编解码
+
+只依赖标准库（安装了 orjson 时同时覆盖快速后端），可直接运行: python tests/test_rpc_codec.py
+"""
+import os
+import sys
+import json
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from rpc.codec import encode_json, encode_json_stdlib, decode_json
+from rpc.server import sanitize_for_json
+
+
+def _legacy_encode(obj):
+    """旧的发送路径：递归清理后再序列化"""
+    return json.dumps(sanitize_for_json(obj), ensure_ascii=False).encode('utf-8')
+
+
+SAMPLE = {
+    "jsonrpc": "2.0",
+    "id": 1,
+    "result": {
+        "full_response": "解释：\ud800这是一个函数\n```python\nprint('hi')\n```",
+        "items": [{"line": i, "text": f"行 {i} \udfff"} for i in range(3)],
+        "nested": ({"a": None, "b": True, "c": 1.5},),
+        "emoji": "🚀",
+    },
+}
+
+
+def test_encoders_drop_lone_surrogates():
+    """两种编码器的结果与旧路径一致，孤立代理字符被丢弃"""
+    expected = json.loads(_legacy_encode(SAMPLE))
+
+    for encoder in (encode_json, encode_json_stdlib):
+        payload = encoder(SAMPLE)
+        assert isinstance(payload, bytes)
+        payload.decode('utf-8')  # 必须是合法的 UTF-8
+        assert json.loads(payload) == expected, encoder.__name__
+
+
+def test_encode_non_str_keys_and_errors():
+    """非字符串键与标准库行为一致，不可序列化对象抛出 TypeError"""
+    assert json.loads(encode_json({1: "a"})) == {"1": "a"}
+
+    try:
+        encode_json({"x": object()})
+    except TypeError:
+        pass
+    else:
+        raise AssertionError("Expected TypeError for unserializable object")
+
+
+def test_decode_accepts_bytes_and_views():
+    """解码支持 str、bytes 和 memoryview"""
+    text = '{"method": "chat", "params": {"message": "你好"}}'
+    expected = json.loads(text)
+
+    assert decode_json(text) == expected
+    assert decode_json(text.encode('utf-8')) == expected
+    assert decode_json(memoryview(bytearray(text.encode('utf-8')))) == expected
+
+
+def test_decode_errors():
+    """非法 JSON 和非法 UTF-8 抛出标准库的异常类型"""
+    for data, error in ((b"{bad", json.JSONDecodeError), (b'"\xff"', UnicodeDecodeError)):
+        try:
+            decode_json(data)
+        except error:
+            continue
+        raise AssertionError(f"Expected {error.__name__} for {data!r}")
+
+
+if __name__ == "__main__":
+    tests = [
+        test_encoders_drop_lone_surrogates,
+        test_encode_non_str_keys_and_errors,
+        test_decode_accepts_bytes_and_views,
+        test_decode_errors,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
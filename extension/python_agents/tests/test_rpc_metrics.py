@@ -0,0 +1,113 @@
+"""
+测试 RPC 指标（延迟直方图、server.stats）
+
+只依赖标准库，可直接运行: python tests/test_rpc_metrics.py
+"""
+import io
+import os
+import sys
+import json
+import time
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from rpc import JSONRPCServer, LatencyHistogram, AgentError
+
+
+def _request(method, params=None, request_id=None):
+    """构造一行 JSON-RPC 请求"""
+    message = {"jsonrpc": "2.0", "method": method, "params": params or {}}
+    if request_id is not None:
+        message["id"] = request_id
+    return json.dumps(message)
+
+
+def _run_server(server, lines):
+    """用给定的输入行运行服务器，返回按 id 索引的响应"""
+    saved = sys.stdin, sys.stdout
+    sys.stdin = io.TextIOWrapper(io.BytesIO(("\n".join(lines) + "\n").encode("utf-8")), encoding="utf-8")
+    sys.stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+    try:
+        server.run()
+        output = sys.stdout.buffer.getvalue()
+    finally:
+        sys.stdin, sys.stdout = saved
+
+    messages = [json.loads(line) for line in output.splitlines()]
+    return {m["id"]: m for m in messages if "id" in m}
+
+
+def test_histogram_percentiles():
+    """百分位数的误差不超过一个桶（25%），且不超过最大值"""
+    histogram = LatencyHistogram()
+    for value in range(1, 1001):
+        histogram.record(float(value))
+
+    summary = histogram.summary()
+    assert summary["count"] == 1000
+    assert 500 <= summary["p50_ms"] <= 500 * 1.25
+    assert 950 <= summary["p95_ms"] <= 1000
+    assert 990 <= summary["p99_ms"] <= 1000
+    assert summary["max_ms"] == 1000
+    assert LatencyHistogram().summary()["p99_ms"] == 0.0
+
+
+def test_server_stats_per_method():
+    """server.stats 按方法返回调用次数、错误数、延迟和字节数"""
+    server = JSONRPCServer()
+
+    def slow(params):
+        time.sleep(0.05)
+        return "x" * 1000
+
+    def fail(params):
+        raise AgentError("boom")
+
+    server.register_method("slow", slow)
+    server.register_method("fail", fail)
+    server.add_stats_source("extra", lambda: {"answer": 42})
+    server.add_stats_source("broken", lambda: 1 / 0)
+
+    responses = _run_server(server, [
+        _request("slow", {}, 1),
+        _request("slow", {}, 2),
+        _request("fail", {}, 3),
+        _request("missing", {}, 4),
+        _request("server.stats", {}, 5),
+    ])
+
+    stats = responses[5]["result"]
+    slow_stats = stats["methods"]["slow"]
+    assert slow_stats["calls"] == 2 and slow_stats["errors"] == 0 and slow_stats["in_flight"] == 0
+    assert slow_stats["latency"]["p50_ms"] >= 50
+    assert slow_stats["bytes_in"] > 0 and slow_stats["bytes_out"] > 2000
+    assert stats["methods"]["fail"]["errors"] == 1
+    assert stats["methods"]["$unknown"]["errors"] == 1
+    assert "missing" not in stats["methods"]
+
+    assert stats["extra"] == {"answer": 42}
+    assert "error" in stats["broken"]
+    assert "cancellation" in stats and "output" in stats
+
+    # server.ready 等通知也计入输出字节
+    assert stats["methods"]["server.ready"]["messages_out"] == 1
+
+
+if __name__ == "__main__":
+    tests = [
+        test_histogram_percentiles,
+        test_server_stats_per_method,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
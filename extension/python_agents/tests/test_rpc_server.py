@@ -0,0 +1,621 @@
+"""
+测试 JSON-RPC 服务器的消息分派
+
+只依赖标准库，可直接运行: python tests/test_rpc_server.py
+"""
+import io
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import tempfile
+import threading
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from rpc import JSONRPCServer, get_current_request, get_current_connection
+
+
+def _request(method, params=None, request_id=None):
+    """构造一行 JSON-RPC 请求"""
+    message = {"jsonrpc": "2.0", "method": method, "params": params or {}}
+    if request_id is not None:
+        message["id"] = request_id
+    return json.dumps(message)
+
+
+def _capture_stdio(stdin_bytes=b""):
+    """用内存中的二进制流替换 stdin/stdout（与真实 stdio 一样带 buffer 属性）"""
+    stdin = io.TextIOWrapper(io.BytesIO(stdin_bytes), encoding="utf-8")
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+    return stdin, stdout
+
+
+def _run_server_raw(server, stdin_bytes):
+    """用给定的原始输入运行服务器，返回 stdout 的原始字节"""
+    saved = sys.stdin, sys.stdout
+    sys.stdin, sys.stdout = _capture_stdio(stdin_bytes)
+    try:
+        server.run()
+        return sys.stdout.buffer.getvalue()
+    finally:
+        sys.stdin, sys.stdout = saved
+
+
+def _run_server(server, lines):
+    """用给定的输入行运行服务器，返回解析后的输出消息"""
+    output = _run_server_raw(server, ("\n".join(lines) + "\n").encode("utf-8"))
+    messages = [json.loads(line) for line in output.decode("utf-8").splitlines() if line.strip()]
+    # 跳过启动时的 server.ready 通知
+    return [m for m in messages if not (isinstance(m, dict) and m.get("method") == "server.ready")]
+
+
+def _responses(messages):
+    """过滤出带 id 的响应"""
+    return [m for m in messages if "id" in m]
+
+
+def test_process_message_serial():
+    """串行模式下 process_message 直接写出响应"""
+    server = JSONRPCServer()
+    server.register_method("echo", lambda params: params)
+
+    saved = sys.stdin, sys.stdout
+    sys.stdin, sys.stdout = _capture_stdio()
+    try:
+        server.process_message(_request("echo", {"x": 1}, 7))
+        output = sys.stdout.buffer.getvalue()
+    finally:
+        sys.stdin, sys.stdout = saved
+
+    response = json.loads(output)
+    assert response == {"jsonrpc": "2.0", "result": {"x": 1}, "id": 7}
+
+
+def test_slow_request_does_not_block_others():
+    """慢请求不会阻塞后续的快请求"""
+    server = JSONRPCServer(max_workers=4)
+
+    def slow(params):
+        time.sleep(0.3)
+        return "slow"
+
+    server.register_method("slow", slow)
+    server.register_method("fast", lambda params: "fast")
+
+    messages = _run_server(server, [
+        _request("slow", {}, 1),
+        _request("fast", {}, 2),
+    ])
+
+    ids = [m["id"] for m in _responses(messages)]
+    assert ids == [2, 1], f"Expected fast response first, got {ids}"
+
+
+def test_same_conversation_is_serialized():
+    """同一会话的请求按到达顺序串行执行"""
+    server = JSONRPCServer(max_workers=4)
+    order = []
+    active = []
+    overlap = threading.Event()
+
+    def chat(params):
+        if active:
+            overlap.set()
+        active.append(params["message"])
+        time.sleep(0.05)
+        order.append(params["message"])
+        active.pop()
+        return params["message"]
+
+    server.register_method("chat", chat)
+
+    messages = _run_server(server, [
+        _request("chat", {"conversationId": "a", "message": i}, i)
+        for i in range(5)
+    ])
+
+    assert not overlap.is_set(), "Requests of the same conversation overlapped"
+    assert order == list(range(5))
+    assert len(_responses(messages)) == 5
+
+
+def test_different_conversations_run_concurrently():
+    """不同会话的请求可以并发执行"""
+    server = JSONRPCServer(max_workers=4)
+    barrier = threading.Barrier(2, timeout=2)
+
+    def chat(params):
+        # 两个请求都到达屏障才能返回，串行执行会超时
+        barrier.wait()
+        return params["conversation_id"]
+
+    server.register_method("chat", chat)
+
+    messages = _run_server(server, [
+        _request("chat", {"conversation_id": "a"}, 1),
+        _request("chat", {"conversation_id": "b"}, 2),
+    ])
+
+    results = sorted(m["result"] for m in _responses(messages))
+    assert results == ["a", "b"]
+
+
+def test_inline_method_and_errors():
+    """inline 方法、未知方法和非法 JSON 的处理"""
+    server = JSONRPCServer(max_workers=2)
+    server.register_method("ping", lambda params: "pong", inline=True)
+
+    messages = _run_server(server, [
+        _request("ping", {}, 1),
+        _request("missing", {}, 2),
+        "{not json",
+    ])
+
+    by_id = {m.get("id"): m for m in messages}
+    assert by_id[1]["result"] == "pong"
+    assert by_id[2]["error"]["code"] == -32601
+    assert by_id[None]["error"]["code"] == -32700
+
+
+def test_cancel_running_request():
+    """$/cancelRequest 中断正在执行的请求"""
+    server = JSONRPCServer(max_workers=2)
+    started = threading.Event()
+
+    def long_running(params):
+        started.set()
+        token = get_current_request().token
+        for _ in range(200):
+            token.check()
+            time.sleep(0.01)
+        return "finished"
+
+    def cancel_when_started(params):
+        started.wait(timeout=2)
+        server.process_message(_request("$/cancelRequest", {"id": 1}))
+        return "sent"
+
+    server.register_method("long", long_running)
+    server.register_method("cancel_when_started", cancel_when_started)
+
+    messages = _run_server(server, [
+        _request("long", {}, 1),
+        _request("cancel_when_started", {}, 2),
+    ])
+
+    by_id = {m.get("id"): m for m in messages}
+    assert by_id[1]["error"]["code"] == -32800
+    stats = server.get_cancellation_stats()
+    assert stats["cancelled"] == 1
+    assert stats["cancelled_before_start"] == 0
+
+
+def test_cancel_queued_request():
+    """排队中的请求被取消后不再执行"""
+    server = JSONRPCServer(max_workers=1)
+    executed = []
+    release = threading.Event()
+
+    def work(params):
+        executed.append(params["n"])
+        release.wait(timeout=2)
+        return params["n"]
+
+    server.register_method("work", work)
+
+    def cancel_then_release(params):
+        server._cancel_request({"id": 2})
+        release.set()
+
+    server.register_method("cancel_then_release", cancel_then_release, inline=True)
+
+    messages = _run_server(server, [
+        _request("work", {"n": 1}, 1),
+        _request("work", {"n": 2}, 2),
+        _request("cancel_then_release", {}),
+    ])
+
+    by_id = {m.get("id"): m for m in messages}
+    assert by_id[1]["result"] == 1
+    assert by_id[2]["error"]["code"] == -32800
+    assert executed == [1]
+    assert server.get_cancellation_stats()["cancelled_before_start"] == 1
+
+
+def test_batch_request():
+    """批量请求并发执行，合并为一行响应"""
+    server = JSONRPCServer(max_workers=4)
+    notified = []
+
+    def slow(params):
+        time.sleep(0.2)
+        return params["n"]
+
+    server.register_method("slow", slow)
+    server.register_method("notify", lambda params: notified.append(True))
+
+    batch = [
+        json.loads(_request("slow", {"n": 1}, 1)),
+        json.loads(_request("slow", {"n": 2}, 2)),
+        json.loads(_request("notify", {})),
+        {"jsonrpc": "1.0", "method": "slow", "id": 3},
+    ]
+
+    start = time.monotonic()
+    messages = _run_server(server, [json.dumps(batch)])
+    elapsed = time.monotonic() - start
+
+    assert len(messages) == 1 and isinstance(messages[0], list)
+    by_id = {m.get("id"): m for m in messages[0]}
+    assert by_id[1]["result"] == 1
+    assert by_id[2]["result"] == 2
+    assert by_id[None]["error"]["code"] == -32600
+    assert len(messages[0]) == 3, "Notifications must not produce batch entries"
+    assert notified == [True]
+    assert elapsed < 0.35, f"Batch entries did not run concurrently ({elapsed:.2f}s)"
+
+
+def test_batch_edge_cases():
+    """空批量返回错误，全部为通知的批量不返回内容"""
+    server = JSONRPCServer()
+    server.register_method("notify", lambda params: None)
+
+    messages = _run_server(server, [
+        "[]",
+        json.dumps([json.loads(_request("notify", {}))]),
+    ])
+
+    assert len(messages) == 1
+    assert messages[0]["error"]["code"] == -32600
+
+
+def test_batch_rejects_configure():
+    """批量请求中的 $/configure 返回 InvalidRequest，不切换分帧，其他条目照常执行"""
+    server = JSONRPCServer()
+    server.register_method("echo", lambda params: params)
+
+    batch = [
+        json.loads(_request("$/configure", {"framing": "content-length"}, 1)),
+        json.loads(_request("echo", {"n": 2}, 2)),
+    ]
+    messages = _run_server(server, [json.dumps(batch), _request("echo", {"n": 3}, 3)])
+
+    by_id = {m.get("id"): m for m in messages[0]}
+    assert by_id[1]["error"]["code"] == -32600 and "$/configure" in by_id[1]["error"]["message"]
+    assert by_id[2]["result"] == {"n": 2}
+    # 仍然按行分帧
+    assert messages[1]["result"] == {"n": 3}
+
+
+def _frame(message):
+    """按 Content-Length 分帧"""
+    body = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+
+def _read_frames(data):
+    """解析 Content-Length 分帧的输出"""
+    messages = []
+    while data:
+        header, _, rest = data.partition(b"\r\n\r\n")
+        length = int(header.split(b":")[1])
+        messages.append(json.loads(rest[:length]))
+        data = rest[length:]
+    return messages
+
+
+def test_content_length_framing():
+    """Content-Length 模式下消息体可以包含换行，大消息会扩容缓冲区"""
+    server = JSONRPCServer(framing="content-length")
+    server.register_method("echo", lambda params: params["code"])
+
+    code = "def f():\n    return '中文'\n" * 10000
+    output = _run_server_raw(server, b"".join([
+        _frame({"jsonrpc": "2.0", "method": "echo", "params": {"code": code}, "id": 1}),
+        _frame({"jsonrpc": "2.0", "method": "echo", "params": {"code": "x"}, "id": 2}),
+    ]))
+
+    messages = _read_frames(output)
+    assert messages[0]["method"] == "server.ready"
+    assert messages[0]["params"]["framing"]["current"] == "content-length"
+    assert messages[1] == {"jsonrpc": "2.0", "result": code, "id": 1}
+    assert messages[2]["result"] == "x"
+
+
+def test_configure_switches_framing():
+    """$/configure 的响应使用旧分帧，之后的消息使用新分帧"""
+    server = JSONRPCServer()
+    server.register_method("echo", lambda params: params["value"])
+
+    configure = _request("$/configure", {"framing": "content-length"}, 1)
+    output = _run_server_raw(server, configure.encode("utf-8") + b"\n" + _frame(
+        {"jsonrpc": "2.0", "method": "echo", "params": {"value": "a\nb"}, "id": 2}
+    ))
+
+    lines = output.split(b"\n", 2)
+    assert json.loads(lines[0])["method"] == "server.ready"
+    assert json.loads(lines[1]) == {"jsonrpc": "2.0", "result": {"framing": "content-length"}, "id": 1}
+    assert _read_frames(lines[2]) == [{"jsonrpc": "2.0", "result": "a\nb", "id": 2}]
+
+
+def test_configure_rejects_unknown_framing():
+    """不支持的分帧模式返回 InvalidParams"""
+    server = JSONRPCServer()
+
+    messages = _run_server(server, [_request("$/configure", {"framing": "xml"}, 1)])
+
+    assert messages[0]["error"]["code"] == -32602
+    assert server.framing == "line"
+
+
+def test_configure_client_id():
+    """$/configure 的 clientId 保存在连接上供处理器读取，非字符串返回 InvalidParams"""
+    server = JSONRPCServer()
+    server.register_method("whoami", lambda params: get_current_connection().client_id)
+
+    messages = _run_server(server, [
+        _request("whoami", {}, 1),
+        _request("$/configure", {"clientId": "workspace-a"}, 2),
+        _request("whoami", {}, 3),
+        _request("$/configure", {"clientId": ""}, 4),
+        _request("$/configure", {"clientId": 42}, 5),
+        _request("whoami", {}, 6),
+    ])
+    by_id = {m["id"]: m for m in messages}
+
+    assert by_id[1]["result"] is None
+    assert by_id[2]["result"] == {"framing": "line", "clientId": "workspace-a"}
+    assert by_id[3]["result"] == "workspace-a"
+    assert by_id[4]["error"]["code"] == -32602
+    assert by_id[5]["error"]["code"] == -32602
+    assert by_id[6]["result"] == "workspace-a"
+
+
+def test_async_handler_in_thread_mode():
+    """线程模式下 async 处理器在 worker 线程的事件循环中执行"""
+    server = JSONRPCServer(max_workers=2)
+
+    async def echo(params):
+        await asyncio.sleep(0.01)
+        return params["value"]
+
+    server.register_method("echo", echo)
+
+    messages = _run_server(server, [_request("echo", {"value": "async"}, 1)])
+    assert messages == [{"jsonrpc": "2.0", "result": "async", "id": 1}]
+
+    try:
+        server.register_method("bad", echo, inline=True)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Inline coroutine handlers must be rejected")
+
+
+def test_asyncio_mode_mixed_handlers():
+    """asyncio 模式下 async 处理器共享事件循环并发执行，同步处理器在线程池中执行"""
+    server = JSONRPCServer(max_workers=1, use_asyncio=True)
+    order = []
+
+    async def wait(params):
+        await asyncio.sleep(0.2)
+        return params["n"]
+
+    async def chat(params):
+        await asyncio.sleep(0.02)
+        order.append(params["n"])
+        return params["n"]
+
+    server.register_method("wait", wait)
+    server.register_method("chat", chat)
+    server.register_method("sync", lambda params: threading.current_thread().name)
+
+    start = time.monotonic()
+    messages = _run_server(server, [
+        *[_request("wait", {"n": i}, i) for i in range(1, 5)],
+        _request("sync", {}, 5),
+        *[_request("chat", {"conversationId": "a", "n": i}, i) for i in range(6, 9)],
+    ])
+    elapsed = time.monotonic() - start
+
+    by_id = {m["id"]: m["result"] for m in _responses(messages)}
+    assert [by_id[i] for i in range(1, 5)] == [1, 2, 3, 4]
+    assert by_id[5].startswith("rpc-worker")
+    assert order == [6, 7, 8], f"Conversation order not preserved: {order}"
+    # 4 个 async 请求只用 1 个 worker 线程也能并发完成
+    assert elapsed < 0.5, f"Async handlers did not run concurrently ({elapsed:.2f}s)"
+
+
+def test_asyncio_mode_cancel_over_pipe():
+    """asyncio 模式从真实管道读取，$/cancelRequest 直接取消 async 处理器"""
+    server = JSONRPCServer(use_asyncio=True)
+    started = threading.Event()
+
+    async def long_running(params):
+        started.set()
+        await asyncio.sleep(5)
+        return "finished"
+
+    server.register_method("long", long_running)
+
+    read_fd, write_fd = os.pipe()
+    saved = sys.stdin, sys.stdout
+    sys.stdin = io.TextIOWrapper(os.fdopen(read_fd, "rb"), encoding="utf-8")
+    sys.stdout = _capture_stdio()[1]
+    thread = threading.Thread(target=server.run)
+    try:
+        thread.start()
+        with os.fdopen(write_fd, "wb") as pipe:
+            pipe.write(_request("long", {}, 1).encode("utf-8") + b"\n")
+            pipe.flush()
+            assert started.wait(timeout=2), "Handler did not start"
+            pipe.write(_request("$/cancelRequest", {"id": 1}).encode("utf-8") + b"\n")
+        thread.join(timeout=2)
+        assert not thread.is_alive(), "Server did not stop after cancellation"
+        output = sys.stdout.buffer.getvalue()
+    finally:
+        sys.stdin, sys.stdout = saved
+
+    messages = [json.loads(line) for line in output.splitlines()]
+    assert messages[0]["method"] == "server.ready"
+    assert messages[1]["id"] == 1 and messages[1]["error"]["code"] == -32800
+    assert server.get_cancellation_stats()["cancelled_before_start"] == 0
+
+
+class _SocketClient:
+    """守护进程测试用的简单客户端"""
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.reader = self.sock.makefile("rb")
+
+    def send(self, method, params=None, request_id=None):
+        self.sock.sendall(_request(method, params, request_id).encode("utf-8") + b"\n")
+
+    def receive(self):
+        return json.loads(self.reader.readline())
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+def _start_daemon(server):
+    """在后台线程中启动守护进程，返回 (socket 路径, 线程)"""
+    path = os.path.join(tempfile.mkdtemp(), "agent.sock")
+    thread = threading.Thread(target=server.serve_unix, args=(path, 0.05), daemon=True)
+    thread.start()
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.01)
+    return path, thread
+
+
+def test_daemon_isolates_clients():
+    """守护进程模式下每个客户端的响应、通知、请求 id 和会话状态互不影响"""
+    server = JSONRPCServer(max_workers=4)
+    connected, disconnected = [], []
+
+    def on_connect(connection):
+        connection.state["name"] = f"client-{len(connected)}"
+        connected.append(connection.id)
+
+    server.on_connect(on_connect)
+    server.on_disconnect(lambda connection: disconnected.append(connection.id))
+
+    def whoami(params):
+        connection = get_current_connection()
+        server.send_notification("progress", {"name": connection.state["name"]})
+        for _ in range(20):
+            get_current_request().token.check()
+            time.sleep(0.01)
+        return connection.state["name"]
+
+    server.register_method("whoami", whoami)
+    path, thread = _start_daemon(server)
+
+    clients = [_SocketClient(path), _SocketClient(path)]
+    try:
+        ready = [client.receive() for client in clients]
+        assert all(m["method"] == "server.ready" and m["params"]["mode"] == "daemon" for m in ready)
+        assert ready[0]["params"]["clientId"] != ready[1]["params"]["clientId"]
+
+        # 两个客户端使用相同的请求 id；第二个客户端取消自己的请求不影响第一个
+        clients[0].send("whoami", {}, 1)
+        clients[1].send("whoami", {}, 1)
+        second = [clients[1].receive()]
+        clients[1].send("$/cancelRequest", {"id": 1})
+        second.append(clients[1].receive())
+        first = [clients[0].receive(), clients[0].receive()]
+    finally:
+        for client in clients:
+            client.close()
+
+    assert first[0] == {"jsonrpc": "2.0", "method": "progress", "params": {"name": "client-0"}}
+    assert first[1] == {"jsonrpc": "2.0", "result": "client-0", "id": 1}
+    assert second[0]["params"] == {"name": "client-1"}
+    assert second[1]["error"]["code"] == -32800
+
+    for _ in range(100):
+        if len(disconnected) == 2:
+            break
+        time.sleep(0.01)
+    assert sorted(disconnected) == sorted(connected)
+
+    server.stop()
+    thread.join(timeout=2)
+    assert not thread.is_alive() and not os.path.exists(path)
+
+
+def test_daemon_refuses_second_instance():
+    """同一 socket 上已有守护进程时拒绝启动，残留的 socket 文件会被清理"""
+    server = JSONRPCServer()
+    path, thread = _start_daemon(server)
+    try:
+        other = JSONRPCServer()
+        try:
+            other.serve_unix(path)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("Second daemon must not start on the same socket")
+    finally:
+        server.stop()
+        thread.join(timeout=2)
+
+    # 模拟异常退出后残留的 socket 文件
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+
+    server = JSONRPCServer()
+    path, thread = _start_daemon(server)
+    client = _SocketClient(path)
+    try:
+        assert client.receive()["method"] == "server.ready"
+    finally:
+        client.close()
+        server.stop()
+        thread.join(timeout=2)
+
+
+if __name__ == "__main__":
+    tests = [
+        test_process_message_serial,
+        test_slow_request_does_not_block_others,
+        test_same_conversation_is_serialized,
+        test_different_conversations_run_concurrently,
+        test_inline_method_and_errors,
+        test_cancel_running_request,
+        test_cancel_queued_request,
+        test_batch_request,
+        test_batch_edge_cases,
+        test_batch_rejects_configure,
+        test_content_length_framing,
+        test_configure_switches_framing,
+        test_configure_rejects_unknown_framing,
+        test_configure_client_id,
+        test_async_handler_in_thread_mode,
+        test_asyncio_mode_mixed_handlers,
+        test_asyncio_mode_cancel_over_pipe,
+        test_daemon_isolates_clients,
+        test_daemon_refuses_second_instance,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,145 @@
+"""
+测试大结果溢出（临时文件引用、释放、过期清理）
+
+只依赖标准库，可直接运行: python tests/test_rpc_spill.py
+"""
+import io
+import os
+import sys
+import json
+import mmap
+import time
+import hashlib
+import tempfile
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from rpc import JSONRPCServer, Connection, SpillStore
+
+
+def _read_spill(reference):
+    """按扩展的方式读取溢出文件：mmap 后校验大小和哈希"""
+    with open(reference["path"], "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            assert len(data) == reference["size"]
+            assert hashlib.sha256(data).hexdigest() == reference["sha256"]
+            return data[:].decode(reference["encoding"])
+
+
+def test_spill_store_replaces_large_strings():
+    """只替换超过阈值的字符串，文件可以释放，目录外的路径被拒绝"""
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SpillStore(tmp, threshold=1024)
+        result = {"full_response": "代码" * 1000, "summary": "ok", "files": [{"diff": "+" * 2000}]}
+
+        spilled = store.spill(result, owner=1)
+
+        assert spilled["summary"] == "ok"
+        assert _read_spill(spilled["full_response"]["$spill"]) == result["full_response"]
+        assert _read_spill(spilled["files"][0]["diff"]["$spill"]) == result["files"][0]["diff"]
+        # 原结果不被修改，小结果原样返回
+        assert isinstance(result["full_response"], str)
+        small = {"a": ["b", "c"]}
+        assert store.spill(small) is small
+
+        path = spilled["full_response"]["$spill"]["path"]
+        assert store.release(path)
+        assert not os.path.exists(path)
+        assert not store.release(__file__)
+
+        store.release_owner(1)
+        assert os.listdir(tmp) == []
+        stats = store.get_stats()
+        assert stats["spilled"] == 2 and stats["released"] == 1 and stats["pending"] == 0
+
+
+def test_spill_store_removes_expired_files():
+    """遗留的过期文件在清理时删除，新文件保留"""
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SpillStore(tmp, threshold=10, max_age=60)
+        old = store.spill("x" * 100)["$spill"]["path"]
+        new = store.spill("y" * 100)["$spill"]["path"]
+        os.utime(old, (time.time() - 120, time.time() - 120))
+
+        assert store.cleanup() == 1
+        assert not os.path.exists(old) and os.path.exists(new)
+
+
+def test_server_spills_when_client_opts_in():
+    """客户端开启 spillover 后大结果以引用返回，断开后未释放的文件被删除"""
+    with tempfile.TemporaryDirectory() as tmp:
+        server = JSONRPCServer(max_workers=2, spill_store=SpillStore(tmp, threshold=1024))
+        server.register_method("big", lambda params: {"full_response": "x" * params["size"]})
+
+        def request(method, params, request_id=None):
+            message = {"jsonrpc": "2.0", "method": method, "params": params}
+            if request_id is not None:
+                message["id"] = request_id
+            return json.dumps(message)
+
+        lines = [
+            request("big", {"size": 4096}, 1),
+            request("$/configure", {"spillover": True}, 2),
+            request("big", {"size": 4096}, 3),
+            request("big", {"size": 10}, 4),
+        ]
+        saved = sys.stdin, sys.stdout
+        sys.stdin = io.TextIOWrapper(io.BytesIO(("\n".join(lines) + "\n").encode("utf-8")), encoding="utf-8")
+        sys.stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+        try:
+            server.run()
+            output = sys.stdout.buffer.getvalue()
+        finally:
+            sys.stdin, sys.stdout = saved
+
+        messages = [json.loads(line) for line in output.splitlines()]
+        assert messages[0]["params"]["spillover"] == {"threshold": 1024}
+        responses = {m["id"]: m["result"] for m in messages if "id" in m}
+
+        # 开启之前内联返回
+        assert responses[1]["full_response"] == "x" * 4096
+        assert responses[2] == {"framing": "line", "spillover": True}
+        reference = responses[3]["full_response"]["$spill"]
+        assert reference["size"] == 4096
+        assert responses[4]["full_response"] == "x" * 10
+
+        # 连接关闭时删除未释放的文件
+        assert not os.path.exists(reference["path"])
+        assert os.listdir(tmp) == []
+
+
+def test_configure_spillover_without_store():
+    """服务器未启用溢出时，开启请求返回 false，结果仍然内联"""
+    server = JSONRPCServer()
+    server.register_method("big", lambda params: "x" * 100000)
+
+    output = io.BytesIO()
+    connection = Connection(None, output)
+    server.process_message(json.dumps({"jsonrpc": "2.0", "method": "$/configure", "params": {"spillover": True}, "id": 1}), connection)
+    server.process_message(json.dumps({"jsonrpc": "2.0", "method": "big", "params": {}, "id": 2}), connection)
+
+    messages = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert messages[0]["result"]["spillover"] is False
+    assert messages[1]["result"] == "x" * 100000
+
+
+if __name__ == "__main__":
+    tests = [
+        test_spill_store_replaces_large_strings,
+        test_spill_store_removes_expired_files,
+        test_server_spills_when_client_opts_in,
+        test_configure_spillover_without_store,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,189 @@
+"""
+测试输出写线程（合并、背压、顺序）
+
+只依赖标准库，可直接运行: python tests/test_rpc_writer.py
+"""
+import io
+import os
+import sys
+import json
+import time
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from rpc import JSONRPCServer
+from rpc.codec import encode_json
+from rpc.connection import Connection, merge_stream_notifications
+from rpc.transport import LineTransport
+from rpc.writer import OutputWriter
+
+
+class _SlowStream(io.BytesIO):
+    """每次 flush 都变慢的输出流，模拟读取缓慢的扩展"""
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+        time.sleep(self.delay)
+
+
+def _stream(conversation_id, chunk, done=False):
+    """构造一条 chat.stream 通知"""
+    return {
+        "jsonrpc": "2.0",
+        "method": "chat.stream",
+        "params": {"conversationId": conversation_id, "chunk": chunk, "done": done},
+    }
+
+
+def _put(writer, message):
+    """按服务器的方式提交消息（chat.stream 可合并）"""
+    key = ("chat.stream", message["params"]["conversationId"]) if message.get("method") == "chat.stream" else None
+    writer.put(encode_json(message), key, message if key else None)
+
+
+def _lines(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_coalesces_consecutive_chunks():
+    """同一会话的连续片段合并，不同会话或中间插入其他消息时不合并"""
+    output = io.BytesIO()
+    writer = OutputWriter(LineTransport(None, output), merge=merge_stream_notifications, coalesce_window=0.2)
+
+    # 先入队再启动写线程，保证所有消息都在队列中
+    for i in range(5):
+        _put(writer, _stream("a", str(i)))
+    _put(writer, _stream("b", "x"))
+    _put(writer, {"jsonrpc": "2.0", "result": "ok", "id": 1})
+    _put(writer, _stream("a", "5", done=True))
+    writer.start()
+    writer.close()
+
+    messages = _lines(output)
+    assert [m.get("params", {}).get("chunk") for m in messages] == ["01234", "x", None, "5"]
+    assert messages[-1]["params"]["done"] is True
+
+    stats = writer.get_stats()
+    assert stats["messages"] == 8 and stats["writes"] == 4 and stats["coalesced"] == 4
+
+
+def test_window_merges_chunks_from_producer():
+    """生产者持续发送小片段时，时间窗口内的片段合并为较少的写出"""
+    output = io.BytesIO()
+    writer = OutputWriter(LineTransport(None, output), merge=merge_stream_notifications, coalesce_window=0.05)
+    writer.start()
+
+    for i in range(200):
+        _put(writer, _stream("a", "字", done=i == 199))
+        time.sleep(0.001)
+    writer.close()
+
+    messages = _lines(output)
+    assert "".join(m["params"]["chunk"] for m in messages) == "字" * 200
+    assert messages[-1]["params"]["done"] is True
+    assert len(messages) < 50, f"Chunks were not coalesced ({len(messages)} writes)"
+
+
+def test_progress_todos_are_throttled():
+    """连续的待办列表更新只写出最新的一条，工具调用的开始和结束事件不合并"""
+    output = io.BytesIO()
+    connection = Connection(None, output, coalesce_window=0.2)
+    connection.start_writer()
+
+    def progress(event):
+        connection.write({"jsonrpc": "2.0", "method": "chat.progress", "params": {"requestId": 7, **event}})
+
+    for i in range(5):
+        progress({"type": "todos", "todos": [{"content": "step", "status": f"v{i}"}]})
+    progress({"type": "tool_start", "tool": "ls", "runId": "r"})
+    progress({"type": "tool_end", "tool": "ls", "runId": "r"})
+    progress({"type": "todos", "todos": [{"content": "step", "status": "done"}]})
+    connection.close()
+
+    events = [m["params"] for m in _lines(output)]
+    assert [e["type"] for e in events] == ["todos", "tool_start", "tool_end", "todos"]
+    assert events[0]["todos"][0]["status"] == "v4" and events[-1]["todos"][0]["status"] == "done"
+
+
+def test_backpressure_bounds_pending_bytes():
+    """扩展读取过慢时生产者阻塞，积压不超过上限"""
+    output = _SlowStream(delay=0.02)
+    writer = OutputWriter(LineTransport(None, output), max_pending_bytes=4096)
+    writer.start()
+
+    payload = encode_json({"jsonrpc": "2.0", "result": "x" * 1000, "id": 1})
+    for _ in range(20):
+        writer.put(payload)
+    writer.close()
+
+    stats = writer.get_stats()
+    assert stats["blocked"] > 0
+    assert stats["max_pending_bytes"] <= 4096
+    assert len(output.getvalue().splitlines()) == 20
+
+
+def test_server_output_is_not_interleaved():
+    """多个 worker 并发发送大消息和流式片段，输出逐行完整且片段顺序不变"""
+    server = JSONRPCServer(max_workers=4)
+
+    def stream(params):
+        for i in range(100):
+            server.send_notification("chat.stream", {
+                "conversationId": params["conversationId"],
+                "chunk": f"{i},",
+                "done": i == 99
+            })
+        return "x" * 100000
+
+    server.register_method("stream", stream)
+
+    saved = sys.stdin, sys.stdout
+    lines = "".join(
+        json.dumps({"jsonrpc": "2.0", "method": "stream", "params": {"conversationId": c}, "id": n}) + "\n"
+        for n, c in enumerate("abcd")
+    )
+    sys.stdin = io.TextIOWrapper(io.BytesIO(lines.encode("utf-8")), encoding="utf-8")
+    sys.stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+    try:
+        server.run()
+        output = sys.stdout.buffer.getvalue()
+    finally:
+        sys.stdin, sys.stdout = saved
+
+    messages = [json.loads(line) for line in output.splitlines()]
+    responses = [m for m in messages if "id" in m]
+    assert sorted(m["id"] for m in responses) == [0, 1, 2, 3]
+    assert all(len(m["result"]) == 100000 for m in responses)
+
+    for conversation_id in "abcd":
+        chunks = [m["params"]["chunk"] for m in messages
+                  if m.get("method") == "chat.stream" and m["params"]["conversationId"] == conversation_id]
+        assert "".join(chunks) == "".join(f"{i}," for i in range(100))
+
+
+if __name__ == "__main__":
+    tests = [
+        test_coalesces_consecutive_chunks,
+        test_progress_todos_are_throttled,
+        test_window_merges_chunks_from_producer,
+        test_backpressure_bounds_pending_bytes,
+        test_server_output_is_not_interleaved,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,256 @@
+"""
+测试 agent 运行器（token 转发和过滤、工具调用和待办事项的进度事件、截止时间和步数上限）
+
+需要 langgraph: python tests/test_runner.py
+"""
+import os
+import sys
+import time
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.tools import tool
+from langgraph.constants import TAG_NOSTREAM
+from langchain.agents.middleware.types import ModelRequest
+from langgraph.graph import END, START, MessagesState, StateGraph
+
+from agents.middleware import ResilientModelMiddleware
+from agents.runner import AgentBudgetExceededError, DeadlineExceededError, run_agent
+from utils.resilience import RetryPolicy, call_budget
+
+
+def _model(*replies):
+    return GenericFakeChatModel(messages=iter([AIMessage(content=reply) for reply in replies]))
+
+
+class _TodoState(MessagesState):
+    todos: list
+
+
+@tool
+def read_file(path: str) -> str:
+    """Read a file."""
+    return "x" * 300
+
+
+@tool
+def broken(path: str) -> str:
+    """Always fails."""
+    raise ValueError("disk on fire")
+
+
+def _graph(nodes, state=MessagesState):
+    """按顺序执行 nodes（名称 -> 函数）的图"""
+    graph = StateGraph(state)
+    previous = START
+    for name, node in nodes:
+        graph.add_node(name, node)
+        graph.add_edge(previous, name)
+        previous = name
+    graph.add_edge(previous, END)
+    return graph.compile()
+
+
+def _user(text):
+    return {"messages": [{"role": "user", "content": text}]}
+
+
+def test_tokens_forwarded_and_filtered():
+    """只转发模型生成的文本：带 nostream 标记的调用（历史摘要）和工具结果不转发，不同模型消息之间插入空行"""
+    summarizer = _model("summary of history")
+    model = _model("first answer", "second answer")
+
+    def summarize(state):
+        summarizer.invoke("summarize", config={"tags": [TAG_NOSTREAM]})
+        return {}
+
+    def answer(state):
+        return {"messages": [model.invoke(state["messages"])]}
+
+    def tool(state):
+        return {"messages": [ToolMessage(content="tool output", tool_call_id="call")]}
+
+    agent = _graph([("summarize", summarize), ("answer", answer), ("tool", tool), ("answer_again", answer)])
+    tokens = []
+    state = run_agent(agent, _user("hi"), on_token=tokens.append)
+
+    assert len(tokens) > 2
+    assert "".join(tokens) == "first answer\n\nsecond answer"
+    assert state["messages"][-1].content == "second answer"
+
+
+def test_node_messages_are_not_tokens():
+    """节点直接返回的完整消息（不是模型流式生成的）不作为 token 转发"""
+    agent = _graph([("answer", lambda state: {"messages": [AIMessage(content="precomputed")]})])
+    tokens = []
+    state = run_agent(agent, _user("hi"), on_token=tokens.append)
+    assert tokens == [] and state["messages"][-1].content == "precomputed"
+
+
+def test_progress_events():
+    """工具调用的开始、结束和失败以及待办列表的变化转换为进度事件；待办列表未变化时不重复发送"""
+    todos = [{"content": "read the file", "status": "in_progress"}]
+
+    def call_tools(state):
+        read_file.invoke({"path": "a" * 500})
+        try:
+            broken.invoke({"path": "b.py"})
+        except ValueError:
+            pass
+        return {}
+
+    agent = _graph([
+        ("plan", lambda state: {"todos": todos}),
+        ("tools", call_tools),
+        ("replan", lambda state: {"todos": list(todos)}),
+        ("finish", lambda state: {"todos": [{"content": "read the file", "status": "completed"}]}),
+    ], _TodoState)
+    events = []
+    run_agent(agent, _user("hi"), on_progress=events.append)
+
+    kinds = [event["type"] for event in events]
+    assert kinds == ["todos", "tool_start", "tool_end", "tool_start", "tool_error", "todos"]
+
+    start, end = events[1], events[2]
+    assert start["tool"] == "read_file" and start["runId"] == end["runId"]
+    assert start["args"]["path"].endswith("...(500 chars)")
+    assert end["outputSize"] == 300 and end["durationMs"] >= 0
+    assert events[4]["tool"] == "broken" and "disk on fire" in events[4]["error"]
+    assert events[0]["todos"] == todos and events[-1]["todos"][0]["status"] == "completed"
+
+
+def test_progress_emit_failure_does_not_abort_run():
+    """发送进度失败只记录日志，不中断运行"""
+    def emit(event):
+        if event["type"].startswith("tool"):
+            raise BrokenPipeError("client went away")
+
+    agent = _graph([("tools", lambda state: {"messages": [AIMessage(content=read_file.invoke({"path": "a"}))]})])
+    state = run_agent(agent, _user("hi"), on_progress=emit)
+    assert state["messages"][-1].content == "x" * 300
+
+
+def _budget_error(agent, **kwargs) -> AgentBudgetExceededError:
+    try:
+        run_agent(agent, _user("hi"), **kwargs)
+    except AgentBudgetExceededError as e:
+        return e
+    raise AssertionError("run should have exceeded its budget")
+
+
+def test_deadline_returns_partial_answer():
+    """超过截止时间时在下一步之前停止，带上本次运行已生成的回答"""
+    model = _model("partial answer", "never generated")
+
+    def slow(state):
+        time.sleep(0.3)
+        return {}
+
+    agent = _graph([
+        ("answer", lambda state: {"messages": [model.invoke(state["messages"])]}),
+        ("slow", slow),
+        ("answer_again", lambda state: {"messages": [model.invoke(state["messages"])]}),
+    ])
+    error = _budget_error(agent, deadline=time.monotonic() + 0.15)
+    assert error.reason == "deadline" and error.partial == "partial answer"
+    assert error.state["messages"][-1].content == "partial answer"
+
+
+def test_deadline_without_answer():
+    """还没有生成任何回答时部分回答为空（历史中已有的回答不算）"""
+    def slow(state):
+        time.sleep(0.2)
+        return {"messages": [ToolMessage(content="tool output", tool_call_id="call")]}
+
+    agent = _graph([("slow", slow), ("never", lambda state: {"messages": [AIMessage(content="too late")]})])
+    history = {"messages": [{"role": "assistant", "content": "old answer", "id": "old"}]}
+    try:
+        run_agent(agent, history, deadline=time.monotonic() + 0.1)
+        assert False, "run should have exceeded its deadline"
+    except AgentBudgetExceededError as e:
+        assert e.reason == "deadline" and e.partial == ""
+
+
+def test_max_steps_returns_partial_answer():
+    """超过步数上限时停止，部分回答为最后一条带文本的模型消息"""
+    counter = iter(range(100))
+    graph = StateGraph(MessagesState)
+    graph.add_node("think", lambda state: {"messages": [AIMessage(content=f"thought {next(counter)}")]})
+    graph.add_edge(START, "think")
+    graph.add_edge("think", "think")
+    agent = graph.compile()
+
+    error = _budget_error(agent, max_steps=3)
+    assert error.reason == "max_steps" and error.partial == "thought 2"
+
+
+def test_model_call_timeout_bounded_by_deadline():
+    """单次模型调用的 HTTP 超时不超过剩余预算；截止时间已过时不再调用模型"""
+    middleware = ResilientModelMiddleware(RetryPolicy(max_retries=0), timeout=30)
+    request = ModelRequest(model=_model("x"), messages=[], model_settings={"temperature": 0})
+    seen = []
+
+    def handler(request):
+        seen.append(request.model_settings)
+        return "response"
+
+    assert middleware.wrap_model_call(request, handler) == "response"
+    assert seen[-1] == {"temperature": 0, "timeout": 30}
+
+    with call_budget(time.monotonic() + 2):
+        middleware.wrap_model_call(request, handler)
+    assert 0 < seen[-1]["timeout"] <= 2 and seen[-1]["temperature"] == 0
+
+    with call_budget(time.monotonic() - 1):
+        try:
+            middleware.wrap_model_call(request, handler)
+            assert False, "expired deadline should stop the call"
+        except DeadlineExceededError:
+            pass
+    assert len(seen) == 2
+
+
+def test_model_timeout_at_deadline_becomes_deadline_exceeded():
+    """调用因超时失败且已到截止时间时转换为 DeadlineExceededError（run_agent 据此返回部分回答）"""
+    middleware = ResilientModelMiddleware(RetryPolicy(max_retries=3), timeout=30)
+    request = ModelRequest(model=_model("x"), messages=[])
+
+    def handler(request):
+        time.sleep(request.model_settings["timeout"])
+        raise TimeoutError("read timed out")
+
+    with call_budget(time.monotonic() + 0.1):
+        try:
+            middleware.wrap_model_call(request, handler)
+            assert False, "timed out call should raise"
+        except DeadlineExceededError as e:
+            assert isinstance(e.__cause__, TimeoutError)
+
+
+if __name__ == "__main__":
+    tests = [
+        test_tokens_forwarded_and_filtered,
+        test_node_messages_are_not_tokens,
+        test_progress_events,
+        test_progress_emit_failure_does_not_abort_run,
+        test_deadline_returns_partial_answer,
+        test_deadline_without_answer,
+        test_max_steps_returns_partial_answer,
+        test_model_call_timeout_bounded_by_deadline,
+        test_model_timeout_at_deadline_becomes_deadline_exceeded,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,101 @@
+"""
+测试启动性能报告（-X importtime 解析、报告比较）
+
+只依赖标准库，可直接运行: python tests/test_startup_profile.py
+"""
+import os
+import sys
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from startup_profile import parse_importtime, summarize_imports, compare_reports, main
+
+
+IMPORTTIME = """\
+import time: self [us] | cumulative | imported package
+import time:       100 |        100 |   _io
+import time:      2000 |       2000 |     pkg.sub
+import time:      1000 |       3000 |   pkg
+import time:       500 |       3600 | app
+some other stderr line
+import time:       300 |        300 | json
+"""
+
+
+def _report(phases, by_package, imports_ms=100.0):
+    return {
+        "server_ready_ms": 200.0,
+        "agent_ready_ms": 4000.0,
+        "phases": phases,
+        "imports": {"total_ms": imports_ms, "count": 1, "by_package": by_package, "slowest": []},
+    }
+
+
+def test_parse_importtime():
+    """解析出每个模块的耗时、层级和父模块，忽略表头和其他输出"""
+    modules = parse_importtime(IMPORTTIME.splitlines())
+    by_name = {m["module"]: m for m in modules}
+
+    assert len(modules) == 5
+    assert by_name["pkg.sub"]["self_ms"] == 2.0 and by_name["pkg.sub"]["depth"] == 2
+    assert by_name["pkg.sub"]["parent"] == "pkg"
+    assert by_name["pkg"]["parent"] == "app" and by_name["_io"]["parent"] == "app"
+    assert by_name["app"]["depth"] == 0 and by_name["app"]["parent"] is None
+
+    summary = summarize_imports(modules)
+    # 只累计顶层导入，避免重复计算
+    assert summary["total_ms"] == 3.9
+    assert summary["by_package"]["pkg"] == 3.0
+    assert summary["slowest"][0]["module"] == "app"
+
+
+def test_compare_reports():
+    """超过百分比阈值且超过绝对下限的变慢才算退化"""
+    baseline = _report({"imports": 1000.0, "agent_graph": 100.0}, {"openai": 800.0, "tiny": 1.0})
+    current = _report({"imports": 1500.0, "agent_graph": 130.0}, {"openai": 800.0, "tiny": 10.0, "new": 300.0})
+
+    lines, regressions = compare_reports(baseline, current, threshold=20, min_ms=50)
+    # agent_graph 慢了 30%，但只差 30ms；tiny 翻了很多倍，但绝对值很小
+    assert regressions == ["phase.imports", "package.new"]
+    assert any("REGRESSION" in line and "phase.imports" in line for line in lines)
+
+    _, regressions = compare_reports(baseline, baseline)
+    assert regressions == []
+
+
+def test_compare_command_exit_code():
+    """compare 命令有退化时退出码为 1"""
+    import json
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        base = os.path.join(directory, "base.json")
+        slow = os.path.join(directory, "slow.json")
+        with open(base, "w") as f:
+            json.dump(_report({"imports": 1000.0}, {}), f)
+        with open(slow, "w") as f:
+            json.dump(_report({"imports": 2000.0}, {}), f)
+
+        assert main(["compare", base, base]) == 0
+        assert main(["compare", base, slow]) == 1
+
+
+if __name__ == "__main__":
+    tests = [
+        test_parse_importtime,
+        test_compare_reports,
+        test_compare_command_exit_code,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"[PASS] {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"[FAIL] {test.__name__}: {e}")
+
+    print(f"\nTotal: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
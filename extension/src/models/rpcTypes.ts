@@ -42,6 +42,8 @@ export enum RpcMethod {
     AnalyzeProject = 'analyze_project',
     HealthCheck = 'health_check',
     SwitchModel = 'switch_model',  // 🆕 模型切换
+    SnapshotConversation = 'conversation.snapshot',
+    ForkConversation = 'conversation.fork',
     Shutdown = 'shutdown'
 }
 
@@ -54,6 +56,7 @@ export enum RpcErrorCode {
     MethodNotFound = -32601,
     InvalidParams = -32602,
     InternalError = -32603,
+    RequestCancelled = -32800,
     AgentError = -32000,
     LlmError = -32001,
     FileSystemError = -32002,
@@ -38,6 +38,12 @@ export class JsonRpcClient extends EventEmitter {
             const timeoutMs = timeout || this.DEFAULT_TIMEOUT;
             const timer = setTimeout(() => {
                 this.pendingRequests.delete(id);
+                // 通知 Python 端停止处理，避免继续消耗 LLM token
+                try {
+                    this.notify('$/cancelRequest', { id });
+                } catch (error) {
+                    Logger.warn(`Failed to send cancel for request ${id}`, error);
+                }
                 reject(new Error(`Request timeout after ${timeoutMs}ms: ${method}`));
             }, timeoutMs);
 
@@ -253,6 +253,15 @@ export class PythonProcessService extends EventEmitter {
             try {
                 const message = JSON.parse(line);
                 
+                // 批量请求的响应：逐条分发
+                if (Array.isArray(message)) {
+                    Logger.info(`Received batch response with ${message.length} entries`);
+                    for (const entry of message) {
+                        this.emit('response', entry);
+                    }
+                    return;
+                }
+                
                 // 如果是通知（没有 id）
                 if (!message.id && message.method) {
                     Logger.info(`Received notification: ${message.method}`);